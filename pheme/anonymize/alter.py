@@ -1,8 +1,122 @@
 import datetime
+import functools
+import hashlib
 import random
 import string
 
+from pheme.anonymize.termcache import config_value
 from pheme.anonymize.termcache import lookup_term, store_term
+from pheme.anonymize.termcache import lookup_terms, store_new_term
+from pheme.anonymize.termcache import store_new_terms, store_terms
+from pheme.anonymize.termcache import tag_terms
+
+
+PARTITION_FACTOR = 100  # min values left to each worker to partition
+
+
+class RandomStreams(object):
+    """Independent random number streams for the value generators
+
+    Each kind of generator (i.e. 10 digit strings) draws from its own
+    `random.Random` instance, rather than the shared state of the
+    `random` module.  Unseeded, streams are seeded from the operating
+    system.  Given a seed, every stream is derived from the seed, the
+    worker ID and the stream name, so runs may be replayed, and
+    parallel workers given distinct, reproducible streams.  Seeds are
+    for replaying a single run only; any run reusing a seed draws the
+    same values for whatever new terms it sees.
+
+    With more than one worker, values are partitioned by worker ID:
+    the trailing characters of each value encode a number congruent
+    to the worker ID, modulo the number of workers, so no two workers
+    ever generate the same new value.  Values too short to leave each
+    worker `PARTITION_FACTOR` possibilities (i.e. single digits) are
+    left unpartitioned, as partitioning would all but fix them; new
+    terms are then only kept consistent by the cache's set-if-absent.
+
+    :param seed: optional seed for the run
+    :param worker: zero based ID of this worker
+    :param workers: total number of workers
+
+    """
+    def __init__(self, seed=None, worker=0, workers=1):
+        self.streams = {}
+        self.reseed(seed, worker, workers)
+
+    def _seed_for(self, name):
+        if self.seed is None:
+            return None
+        digest = hashlib.md5('%s|%d|%s' % (self.seed, self.worker, name))
+        return int(digest.hexdigest(), 16)
+
+    def reseed(self, seed=None, worker=0, workers=1):
+        """reseed all streams, for the given run seed and worker"""
+        if not 0 <= worker < workers:
+            raise ValueError("worker %d not in 0 through %d" %
+                             (worker, workers - 1))
+        self.seed, self.worker, self.workers = seed, worker, workers
+        for name, stream in self.streams.iteritems():
+            stream.seed(self._seed_for(name))
+
+    def stream(self, name):
+        """returns the random.Random instance for the named stream"""
+        if name not in self.streams:
+            self.streams[name] = random.Random(self._seed_for(name))
+        return self.streams[name]
+
+    def partition(self, rand, chars, alphabet, skip=''):
+        """rewrite the tail of chars into this worker's partition
+
+        :param rand: the stream to draw from
+        :param chars: list of generated characters, altered in place
+        :param alphabet: the characters generated
+        :param skip: characters that aren't generated (i.e. '.'),
+          left untouched
+
+        """
+        if self.workers == 1:
+            return chars
+        positions = [i for i in xrange(len(chars) - 1, -1, -1)
+                     if chars[i] not in skip]
+        base, width = len(alphabet), 1
+        if base ** len(positions) < self.workers * PARTITION_FACTOR:
+            return chars  # too few values to divide among the workers
+        while base ** width < self.workers:
+            width += 1
+        tail = rand.randrange(base ** width // self.workers) * \
+            self.workers + self.worker
+        for i in positions[:width]:
+            chars[i] = alphabet[tail % base]
+            tail //= base
+        return chars
+
+
+# never seeded from the config: a seed reused across runs repeats the
+# same values for different terms, and reveals the date delta to any
+# who know it.  Seeds are given per run, see `anonymize_file --seed`
+streams = RandomStreams(None, config_value('worker', 0),
+                        config_value('workers', 1))
+
+
+def seed_streams(seed=None, worker=0, workers=1):
+    """seed the random streams of all generators, see
+    :py:class:`RandomStreams`"""
+    streams.reseed(seed, worker, workers)
+
+
+def parse_worker(value):
+    """parse worker 'i/N' (i from 1 to N)
+
+    returns (worker, workers) tuple, with the worker zero based.
+
+    """
+    try:
+        i, n = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise ValueError("worker must match 'i/N', not '%s'" % value)
+    if not 1 <= i <= n:
+        raise ValueError("worker %d not in 1 through %d" % (i, n))
+    return i - 1, n
 
 
 def fixed_length_string(length, prefix=''):
@@ -19,15 +133,27 @@ def fixed_length_string(length, prefix=''):
     """
     if (length < len(prefix)):
         raise ValueError("length of prefix exceeds total string length")
+    rand = streams.stream('string-%d-%s' % (length, prefix))
+    letters = string.ascii_lowercase
 
     def fixed_len(initial):
         "returns string of fixed len - initial is ignored"
         assert(initial)  # don't populate non existing field
-        result = list(prefix)
-        while len(result) < length:
-            result.append(random.choice(string.ascii_lowercase))
-        return ''.join(result).capitalize()
-
+        result = [rand.choice(letters) for i in xrange(length - len(prefix))]
+        streams.partition(rand, result, letters)
+        return (prefix + ''.join(result)).capitalize()
+
+    def bulk(initials):
+        "returns list of fixed len strings, one per initial"
+        if streams.workers > 1:
+            return [fixed_len(initial) for initial in initials]
+        choice = rand.choice
+        count = length - len(prefix)
+        return [(prefix + ''.join([choice(letters) for i in
+                                   xrange(count)])).capitalize()
+                for initial in initials]
+
+    fixed_len.bulk = bulk
     return fixed_len
 
 
@@ -53,22 +179,33 @@ def fixed_length_digits(length, pointfrequency=None):
             pointchoice = range(*pointfrequency)
     else:
         pointchoice = [length]
+    rand = streams.stream('digits-%d-%s' % (length, pointfrequency))
 
     def fixed_len(initial):
         "returns string of digits and dots of fixed len"
         assert(initial)  # don't populate non existing field
         result = []
         i = 0
-        nextpoint = random.choice(pointchoice)
+        nextpoint = rand.choice(pointchoice)
         while i < length:
             if i == nextpoint:
                 result.append('.')
-                nextpoint = i + 1 + random.choice(pointchoice)
+                nextpoint = i + 1 + rand.choice(pointchoice)
             else:
-                result.append(random.choice(string.digits))
+                result.append(rand.choice(string.digits))
             i += 1
+        streams.partition(rand, result, string.digits, skip='.')
         return ''.join(result)
 
+    def bulk(initials):
+        "returns list of fixed len digit strings, one per initial"
+        if pointfrequency or streams.workers > 1:
+            return [fixed_len(initial) for initial in initials]
+        choice, digits = rand.choice, string.digits
+        return [''.join([choice(digits) for i in xrange(length)])
+                for initial in initials]
+
+    fixed_len.bulk = bulk
     return fixed_len
 
 
@@ -95,6 +232,7 @@ def random_date_delta(delta_ballpark, format=None):
 
     """
     cached_key = "date_delta-%s" % delta_ballpark
+    rand = streams.stream(cached_key)
 
     def calculate_delta(ballpark_seconds):
         ballpark_seconds = delta_ballpark.total_seconds()
@@ -103,14 +241,14 @@ def random_date_delta(delta_ballpark, format=None):
             raise ValueError("insignificant ballpark, increase delta "
                              "magnitude to ensure unpredictable results")
         fudge = .10 * ballpark_seconds
-        delta = random.triangular(ballpark_seconds - fudge,
-                                  ballpark_seconds + fudge)
-        store_term(cached_key, delta)
-        return delta
+        delta = rand.triangular(ballpark_seconds - fudge,
+                                ballpark_seconds + fudge)
+        return store_new_term(cached_key, delta)
 
     delta = lookup_term(cached_key)
     if delta is None:
         delta = calculate_delta(delta_ballpark)
+    tag_terms([cached_key], 'date_delta')
 
     def datetime_shift(initial):
         """returns initial datetime modified by delta
@@ -132,9 +270,23 @@ def random_date_delta(delta_ballpark, format=None):
         result = initial + datetime.timedelta(seconds=delta)
         return result.strftime(format) if format else result
 
+    datetime_shift.bulk = lambda(initials): map(datetime_shift, initials)
     return datetime_shift
 
 
+def tag(func, terms):
+    """tag terms with the namespace of func, if it has one
+
+    Anon functions with a `namespace` attribute group the terms they
+    anonymize for the retention policy, see
+    :py:mod:`pheme.anonymize.retention`.
+
+    """
+    namespace = getattr(func, 'namespace', None)
+    if namespace is not None:
+        tag_terms(terms, namespace)
+
+
 def anon_term(term, func):
     """lookup or anonomize any term, cache and return cached values
 
@@ -152,11 +304,200 @@ def anon_term(term, func):
         termlen = 1
     if term is None or termlen == 0:
         return term
+    tag(func, [term])
+    if hasattr(func, 'parts'):
+        # composites look up and cache term along with its parts
+        return anon_composite(term, *func.parts(term))
 
     cached = lookup_term(term)
     if cached is not None:
         return cached
     else:
-        value = func(term)
-        store_term(term, value)
+        # should another process sharing the cache have stored a
+        # value in the meantime, the value it stored is returned
+        return store_new_term(term, func(term))
+
+
+def composite(split):
+    """decorator building a composite anon function from split
+
+    :param split: function given a composite term, returning the
+      (parts, combine) pair :py:func:`anon_composite` requires
+
+    A composite anonymizes a term made up of other terms, each of
+    which is cached on its own so it matches the same value found
+    elsewhere.  Called directly, the returned function anonymizes
+    and caches just the parts of the term.  :py:func:`anon_term` and
+    :py:func:`anon_terms` recognize composites by their `parts`
+    attribute, and cache the term itself along with its parts,
+    rather than wrapping the composite in another lookup and store.
+
+    """
+    @functools.wraps(split)
+    def anonymize(initial):
+        if not initial:
+            return initial
+        parts, combine = split(initial)
+        return anon_composite(None, parts, combine)
+
+    anonymize.parts = split
+    return anonymize
+
+
+def anon_composite(term, parts, combine):
+    """lookup or anonymize a composite term and its parts, atomically
+
+    :param term: the composite term to anonymize, or None to only
+      cache its parts
+    :param parts: sequence of (part, func) pairs, each part a term
+      within the composite to be anonymized and cached on its own.
+      Empty parts are passed through unchanged.
+    :param combine: callable given the list of anonymized parts,
+      returning the anonymized composite
+
+    The term and all its parts are looked up in a single bulk
+    request, and every new mapping is committed in a single bulk
+    store, so a composite is never cached without its parts.
+
+    """
+    keys = [part for part, func in parts if part]
+    for part, func in parts:
+        if part and part != term:
+            tag(func, [part])
+    if term is not None:
+        keys.append(term)
+    found = lookup_terms(keys)
+    if term is not None and term in found:
+        return found[term]
+
+    generated = {}
+    for part, func in parts:
+        if part and part not in found and part not in generated:
+            generated[part] = func(part)
+    value = combine([found.get(part, generated.get(part, part))
+                     for part, func in parts])
+    if term is not None and term not in generated:
+        generated[term] = value
+    if not generated:
         return value
+
+    held = store_new_terms(generated)
+    found.update(held)
+    if term is not None and held[term] != generated[term]:
+        # another process cached the composite first
+        return held[term]
+    if any(held[key] != generated[key] for key in generated
+           if key != term):
+        # another process cached some part first, rebuild from the
+        # values held so the composite matches its parts
+        value = combine([found.get(part, part) for part, func in parts])
+        if term is not None:
+            store_term(term, value)
+    return value
+
+
+def anon_composites(terms, split):
+    """bulk version of anon_composite
+
+    :param terms: the distinct composite terms to anonymize
+    :param split: the `parts` of the composite anon function, see
+      :py:func:`composite`
+
+    Every term and all their parts are looked up in a single bulk
+    request, and all new mappings committed in a single bulk store.
+    Returns a dict mapping each term to its anonymized value.
+
+    """
+    splits = dict((term, split(term)) for term in terms)
+    keys = set(splits)
+    namespaced = {}  # func -> parts, to tag
+    for term, (parts, combine) in splits.iteritems():
+        for part, func in parts:
+            if part:
+                keys.add(part)
+                if part != term:
+                    namespaced.setdefault(func, []).append(part)
+    for func, parts in namespaced.iteritems():
+        tag(func, parts)
+    found = lookup_terms(keys)
+
+    generated = {}
+    for term, (parts, combine) in splits.iteritems():
+        if term in found:
+            continue
+        for part, func in parts:
+            if part and part not in found and part not in generated:
+                generated[part] = func(part)
+    values = {}
+    for term, (parts, combine) in splits.iteritems():
+        if term in found:
+            continue
+        values[term] = combine([found.get(part, generated.get(part, part))
+                                for part, func in parts])
+        if term not in generated:
+            generated[term] = values[term]
+    if not generated:
+        return dict((term, found[term]) for term in splits)
+
+    held = store_new_terms(generated)
+    found.update(held)
+    rebuilt = {}
+    for term, value in values.iteritems():
+        parts, combine = splits[term]
+        if held[term] != generated[term]:
+            values[term] = held[term]  # another process cached it first
+        elif any(held[part] != generated[part] for part, func in parts
+                 if part and part != term and part in generated):
+            # another process cached some part first, rebuild from the
+            # values held so the composite matches its parts
+            rebuilt[term] = values[term] = combine(
+                [found.get(part, part) for part, func in parts])
+    if rebuilt:
+        store_terms(rebuilt)
+    return dict((term, values[term] if term in values else found[term])
+                for term in splits)
+
+
+def generate_many(func, initials):
+    """generate anonymized values for each of initials
+
+    Uses the bulk API of generators built by this module, falling
+    back to calling func once per initial.
+
+    """
+    bulk = getattr(func, 'bulk', None)
+    if bulk is not None:
+        return bulk(initials)
+    return [func(initial) for initial in initials]
+
+
+def anon_terms(terms, func):
+    """bulk version of anon_term
+
+    :param terms: iterable of terms to anonymize
+    :param func: callable to produce appropriate random version of
+      any term not already cached
+
+    All terms are looked up in the cache at once, and any new values
+    generated are stored at once.  Returns a dict mapping each
+    (non empty) term to its anonymized value.
+
+    """
+    unique = set()
+    for term in terms:
+        try:
+            termlen = len(term)
+        except TypeError:
+            termlen = 1
+        if term is not None and termlen > 0:
+            unique.add(term)
+
+    tag(func, unique)
+    if hasattr(func, 'parts'):
+        # composites commit each term along with its parts
+        return anon_composites(unique, func.parts)
+    found = lookup_terms(unique)
+    misses = [term for term in unique if term not in found]
+    generated = dict(zip(misses, generate_many(func, misses)))
+    found.update(store_new_terms(generated))
+    return found
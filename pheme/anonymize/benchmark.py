@@ -0,0 +1,589 @@
+"""Benchmarks for the anonymize pipeline
+
+Synthetic, but realistic, MBDS message mixes are generated to measure
+the cost of anonymization.  All benchmarks run against a scratch term
+cache, so the configured production cache is never polluted with the
+synthetic terms.
+
+"""
+import argparse
+from contextlib import contextmanager
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from pheme.anonymize.pipeline import percentile
+import pheme.anonymize.termcache as termcache
+
+
+HEADER = "MSH|^~\&|%(app)s^%(app_id)s|%(facility)s^%(facility_id)s^NPI|"\
+    "receivingapp^RAID^ISO|receivingfacility^RFID^ISO|"\
+    "%(timestamp)s||ADT^A08^ADT_A01|"\
+    "%(source)s%(timestamp)s%(counter)04d|P|2.5|||||||||"\
+    "Biosurveillance-1.0"
+
+SEGMENTS = (
+    "EVN|A08|%(timestamp)s|||||%(facility)s^%(facility_id)s^NPI",
+    "PID|1||%(patient)s^^^&%(facility_id)s&NPI||\"\"||%(birth)s|M||"
+    "2106-3^White^CDCREC^^^L|^^^WA^%(zip)s|||||||%(visit)s^^^&"
+    "%(facility_id)s&NPI",
+    "NK1|1|DOE^JANE^^^^^L|MTH^Mother^HL70063^^^L|123 MAIN ST^^SEATTLE"
+    "^WA^98101|^PRN^PH^^^206^5551234",
+    "PV1|1|E^Emergency^HL70004^E^^L|^%(room)s^bed^%(facility)s^^^main^2|"
+    "2^Urgent^UB04FL14^UR^^L|||||||||||||||%(visit)s^^^&"
+    "%(facility_id)s&NPI|||||||||||||||||||||||||%(timestamp)s|"
+    "%(timestamp)s",
+    "PR1|1||99283^EMERGENCY DEPT VISIT^C4|||%(timestamp)s",
+    "AL1|1|DA^Drug allergy^HL70127|70618^Penicillin^RXNORM|MO^Moderate",
+    "IN1|1|PLAN01^Health Plan^L|INSCO01|INSURANCE CO^^SEATTLE^WA",
+    "DG1|1||592.0^CALCULUS OF KIDNEY^I9||%(timestamp)s|A^Admitting^HL70052",
+    "OBR|1|%(order)s^%(facility_id)s^ISO|%(order)s^%(facility_id)s^ISO|"
+    "8661-1^Chief complaint^LN|||%(timestamp)s",
+    "OBX|1|NM|21612-7^Age Time Patient Reported^LN||%(age)s|a^year^UCUM"
+    "|||||F|||%(timestamp)s",
+    "OBX|2|NM|8310-5^Body temperature^LN||%(temperature)s|Cel^Celsius^UCUM"
+    "|||||F|||%(timestamp)s",
+    "OBX|3|CWE|8661-1^Chief complaint^LN||^^^^^^^^FEVER AND COUGH||||||F",
+    "ZXX|1|%(facility)s|local extension data",
+    )
+
+
+def sample_messages(count, facilities=5, patients=1000, seed=0):
+    """Generate a realistic mix of MBDS messages
+
+    :param count: number of messages to generate
+    :param facilities: number of distinct sending facilities.  Small
+      values, like production feeds, generate high term repetition.
+    :param patients: number of distinct patients (and visits)
+    :param seed: seed for the random source, for repeatable mixes
+
+    returns a list of message strings, segments separated by '\\r'.
+
+    """
+    rand = random.Random(seed)
+    messages = []
+    for i in range(count):
+        facility = rand.randrange(facilities)
+        patient = rand.randrange(patients)
+        values = {'app': 'app%d' % facility,
+                  'app_id': '2.16.840.1.%d' % facility,
+                  'facility': 'facility%d' % facility,
+                  'facility_id': '1.3.6.1.4.1.%d' % facility,
+                  'source': '%010d' % facility,
+                  'timestamp': '2013%02d%02d%02d%02d%02d' % (
+                      rand.randint(1, 12), rand.randint(1, 28),
+                      rand.randint(0, 23), rand.randint(0, 59),
+                      rand.randint(0, 59)),
+                  'counter': i % 10000,
+                  'patient': 'P%07d' % patient,
+                  'visit': 'V%07d' % patient,
+                  'birth': '19%02d%02d' % (rand.randint(20, 99),
+                                           rand.randint(1, 12)),
+                  'zip': '98%03d' % rand.randrange(200),
+                  'room': 'room%d' % rand.randrange(40),
+                  'order': 'ORD%08d' % i,
+                  'age': str(rand.randint(1, 99)),
+                  'temperature': '%.1f' % rand.uniform(35.5, 41),
+                  }
+        segments = [HEADER % values]
+        segments.extend(segment % values for segment in SEGMENTS)
+        messages.append('\r'.join(segments))
+    return messages
+
+
+OBSERVATION = "OBX|%(set_id)d|%(type)s|%(code)s^%(name)s^LN||%(value)s|"\
+    "%(units)s^%(units)s^UCUM|||||F|||%(timestamp)s"
+
+LAB_TESTS = (
+    ('NM', '2345-7', 'Glucose', 'mg/dL', lambda(rand): str(
+        rand.randint(60, 400))),
+    ('NM', '2160-0', 'Creatinine', 'mg/dL', lambda(rand): '%.2f' %
+        rand.uniform(0.4, 9)),
+    ('NM', '6690-2', 'Leukocytes', '10*3/uL', lambda(rand): '%.1f' %
+        rand.uniform(1, 30)),
+    ('NM', '718-7', 'Hemoglobin', 'g/dL', lambda(rand): '%.1f' %
+        rand.uniform(6, 18)),
+    ('NM', '2951-2', 'Sodium', 'mmol/L', lambda(rand): str(
+        rand.randint(120, 160))),
+    ('NM', '777-3', 'Platelets', '10*3/uL', lambda(rand): str(
+        rand.randint(20, 800))),
+    ('NM', '5902-2', 'Prothrombin time', 's', lambda(rand): '%.1f' %
+        rand.uniform(9, 60)),
+    ('ST', '5778-6', 'Color of Urine', '1', lambda(rand): rand.choice(
+        ('YELLOW', 'AMBER', 'STRAW', 'RED'))),
+    )
+
+
+def lab_messages(count, observations=20, seed=0):
+    """Generate OBX heavy lab result messages
+
+    :param count: number of messages to generate
+    :param observations: number of OBX segments per message
+    :param seed: seed for the random source, for repeatable mixes
+
+    returns a list of message strings, segments separated by '\\r'.
+
+    """
+    rand = random.Random(seed)
+    header = sample_messages(1)[0].split('\r')[0]
+    messages = []
+    for i in range(count):
+        segments = [header, "PID|1||P%07d^^^&1.3.6.1.4.1.0&NPI" %
+                    rand.randrange(1000)]
+        for set_id in range(1, observations + 1):
+            kind, code, name, units, value = rand.choice(LAB_TESTS)
+            segments.append(OBSERVATION % {
+                'set_id': set_id, 'type': kind, 'code': code, 'name': name,
+                'value': value(rand), 'units': units,
+                'timestamp': '20130102030405'})
+        messages.append('\r'.join(segments))
+    return messages
+
+
+@contextmanager
+def scratch_directory():
+    """Context manager yielding a temporary directory, removed on exit"""
+    directory = tempfile.mkdtemp()
+    try:
+        yield directory
+    finally:
+        shutil.rmtree(directory)
+
+
+@contextmanager
+def term_cache(cachefile, **kwargs):
+    """Context manager to run with the given term cache
+
+    The module level term cache singleton is replaced for the
+    duration, and restored on exit.  Additional keyword arguments
+    are passed to the :py:class:`TermCache` constructor.
+
+    """
+    original = termcache.tc
+    termcache.tc = termcache.TermCache(cachefile, **kwargs)
+    try:
+        yield termcache.tc
+    finally:
+        termcache.tc.close()
+        termcache.tc = original
+
+
+@contextmanager
+def scratch_cache(**kwargs):
+    """Context manager to run with an empty, temporary term cache"""
+    with scratch_directory() as directory:
+        with term_cache(os.path.join(directory, 'cache'), **kwargs) as tc:
+            yield tc
+
+
+def timed(func, *args, **kwargs):
+    """returns (elapsed seconds, result) of calling func"""
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+
+def anonymize_all(messages, lazy=True):
+    """anonymize every message, returning list of results"""
+    from pheme.anonymize.mbds_hl7 import MBDS_anon
+    return [MBDS_anon(msg, lazy=lazy).anonymize() for msg in messages]
+
+
+def bench_lazy(args):
+    """compare full hl7.parse against lazy per-segment parsing"""
+    messages = sample_messages(args.messages)
+    with scratch_cache():
+        # warm the cache, so both runs only measure parsing overhead
+        anonymize_all(messages)
+        eager, eager_results = timed(anonymize_all, messages, lazy=False)
+        lazy, lazy_results = timed(anonymize_all, messages, lazy=True)
+    if eager_results != lazy_results:
+        raise AssertionError("lazy and eager parsing results differ")
+    report("eager parse", eager, len(messages))
+    report("lazy parse", lazy, len(messages))
+    print "speedup: %.2fx" % (eager / lazy)
+
+
+def latencies(messages, seconds):
+    """anonymize messages for up to `seconds`, returning latencies"""
+    from pheme.anonymize.mbds_hl7 import MBDS_anon
+    results = []
+    deadline = time.time() + seconds
+    for msg in messages:
+        start = time.time()
+        MBDS_anon(msg).anonymize()
+        results.append(time.time() - start)
+        if start > deadline:
+            break
+    return results
+
+
+def bench_prewarm(args):
+    """compare cold versus prewarmed first minute latency"""
+    messages = sample_messages(args.messages, patients=args.messages)
+    with scratch_directory() as directory:
+        cachefile = os.path.join(directory, 'cache')
+        with term_cache(cachefile, prewarm_keys=args.keys):
+            # populate the cache and the hot key sidecar
+            anonymize_all(messages)
+        # set the sidecar aside for the cold start, restoring it
+        # for the prewarmed run
+        hotfile = cachefile + '.hot'
+        os.rename(hotfile, hotfile + '.saved')
+        for label in ('cold start', 'prewarmed'):
+            with term_cache(cachefile, prewarm_keys=args.keys) as tc:
+                results = latencies(messages, args.seconds)
+                loaded = len(tc.hot)
+            if label == 'cold start':
+                os.rename(hotfile + '.saved', hotfile)
+            print "%-12s %6d msgs  hot keys %6d  mean %.3fms  p50 %.3fms"\
+                "  p99 %.3fms" % (
+                    label, len(results), loaded,
+                    1000 * sum(results) / len(results),
+                    1000 * percentile(results, 50),
+                    1000 * percentile(results, 99))
+
+
+def bench_batch(args):
+    """compare cache round trips, message at a time versus windowed"""
+    from pheme.anonymize.mbds_hl7 import anonymize_window
+    messages = sample_messages(args.messages)
+
+    def windowed(messages):
+        return [result for start in range(0, len(messages), args.window)
+                for result in anonymize_window(
+                    messages[start:start + args.window])]
+
+    for label, func in (('message at a time', anonymize_all),
+                        ('window of %d' % args.window, windowed)):
+        with scratch_cache(prewarm_keys=0) as tc:
+            elapsed, ignore = timed(func, messages)
+            operations = sum(tc.operations.values())
+        report(label, elapsed, len(messages))
+        print "%-24s %8d cache round trips" % ('', operations)
+
+
+def bench_compact(args):
+    """compare memory use of a dict of str against the CompactStore"""
+    from pheme.anonymize.compact import CompactStore
+    terms = [('P%015d' % i, 'Anonymized%06d' % i)
+             for i in xrange(args.terms)]
+    as_dict = dict(terms)
+    dict_bytes = sys.getsizeof(as_dict) + sum(
+        sys.getsizeof(k) + sys.getsizeof(v) for k, v in terms)
+    store = CompactStore()
+    for key, value in terms:
+        store[key] = value
+
+    keys = [key for key, value in terms]
+    dict_time, ignore = timed(lambda: [as_dict[key] for key in keys])
+    compact_time, ignore = timed(lambda: [store[key] for key in keys])
+    print "dict of str   %8.1f bytes/entry" % (
+        float(dict_bytes) / len(terms))
+    print "compact store %8.1f bytes/entry" % store.bytes_per_entry()
+    report("dict lookups", dict_time, len(keys), 'lookup')
+    report("compact lookups", compact_time, len(keys), 'lookup')
+
+
+def bench_obx(args):
+    """throughput of OBX-5 value anonymization, cold and warm cache"""
+    from pheme.anonymize.field_map import type_and_magnitude
+    from pheme.anonymize.mbds_hl7 import MBDS_anon
+    messages = lab_messages(args.messages, args.observations)
+    values = [segment.split('|')[5].split('^')[0] for msg in messages
+              for segment in msg.split('\r') if segment.startswith('OBX')]
+    with scratch_cache(prewarm_keys=0):
+        for label in ('OBX-5 values, cold', 'OBX-5 values, warm'):
+            elapsed, ignore = timed(map, type_and_magnitude, values)
+            report(label, elapsed, len(values), 'value')
+        elapsed, ignore = timed(lambda: [MBDS_anon(msg).anonymize()
+                                         for msg in messages])
+        report("lab messages, warm", elapsed, len(messages))
+
+
+def bench_codec(args):
+    """encode and decode cost, and bytes per entry, of the value codecs"""
+    import cPickle as pickle
+    import datetime
+    from pheme.anonymize.codec import BinaryCodec, PickleCodec
+    rand = random.Random(0)
+    values = []
+    for i in xrange(args.terms):
+        kind = i % 20
+        if kind == 0:
+            values.append(rand.uniform(1.5e8, 1.6e8))  # date deltas
+        elif kind == 1:
+            values.append(rand.randrange(10 ** 9, 2 * 10 ** 9))
+        elif kind == 2:
+            values.append(datetime.datetime(2013, 1, 1) + datetime.timedelta(
+                seconds=rand.randrange(10 ** 8)))
+        else:
+            values.append('Anonymized%06d' % i)
+    for codec in (PickleCodec(), PickleCodec(pickle.HIGHEST_PROTOCOL),
+                  BinaryCodec()):
+        label = codec.name if codec.name != 'pickle' else \
+            'pickle protocol %d' % codec.protocol
+        elapsed, encoded = timed(map, codec.encode, values)
+        report('%s encode' % label, elapsed, len(values), 'value')
+        elapsed, decoded = timed(map, codec.decode, encoded)
+        report('%s decode' % label, elapsed, len(values), 'value')
+        if decoded != values:
+            raise AssertionError("%s round trip differs" % label)
+        print "%-24s %8.1f bytes/entry" % (
+            '', float(sum(map(len, encoded))) / len(values))
+
+
+def current_rss():
+    """returns the current resident set size in bytes
+
+    Read from /proc where available, otherwise the peak is returned.
+
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return peak_rss()
+    return pages * resource.getpagesize()
+
+
+def peak_rss():
+    """returns the peak resident set size of the process in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak  # reported in bytes, rather than KiB
+    return peak * 1024
+
+
+def memory_used(func, *args):
+    """calls func, returning (peak RSS growth, peak traced bytes)
+
+    Python allocations are traced when the tracemalloc module is
+    available, otherwise the traced bytes are None.  As the peak RSS
+    never falls, run in a fresh process, see :py:func:`in_process`.
+
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+    baseline = current_rss()
+    if tracemalloc:
+        tracemalloc.start()
+    func(*args)
+    traced = None
+    if tracemalloc:
+        traced = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return max(0, peak_rss() - baseline), traced
+
+
+def in_process(func, *args):
+    """returns result of func(*args), called in a new child process"""
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(func, args)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def write_batch(path, count):
+    """write a batch file of count sample messages, 1000 at a time"""
+    with open(path, 'wb') as batch:
+        for start in xrange(0, count, 1000):
+            for msg in sample_messages(min(1000, count - start),
+                                       seed=start):
+                batch.write(msg.replace('\r', '\n') + '\n')
+
+
+def write_static_data(path, count):
+    """write a YAML file of count sample facilities"""
+    import yaml
+    from pheme.anonymize.db_static_data import Dumper
+    import pheme.longitudinal.tables as tables
+    objects = [tables.Facility(county='county %d' % (i % 40),
+                               npi=1000000000 + i, zip='98101',
+                               organization_name='General %d' % i,
+                               local_code='L%d' % i)
+               for i in xrange(count)]
+    with open(path, 'wb') as static:
+        static.write(yaml.dump(objects, Dumper=Dumper,
+                               default_flow_style=False))
+
+
+def memory_split(path):
+    """memory used splitting the batch file at path"""
+    from pheme.anonymize.mbds_hl7 import message_at_a_time
+
+    def split():
+        with open(path) as batch:
+            for msg in message_at_a_time(batch):
+                pass
+    return memory_used(split)
+
+
+def memory_anonymize(count):
+    """memory used anonymizing count messages, one at a time"""
+    from pheme.anonymize.mbds_hl7 import MBDS_anon
+    messages = sample_messages(count, patients=count)
+    with scratch_cache(prewarm_keys=0):
+        def anonymize():
+            for msg in messages:
+                MBDS_anon(msg).anonymize()
+        return memory_used(anonymize)
+
+
+def memory_cache(terms):
+    """memory used caching terms with a writeback shelf"""
+    with scratch_cache(prewarm_keys=0, shards=1, server='',
+                       resident=0) as tc:
+        def populate():
+            for start in xrange(0, terms, 1000):
+                tc.set_many(dict(('P%015d' % i, 'Anonymized%06d' % i)
+                                 for i in xrange(start, min(start + 1000,
+                                                            terms))))
+            for i in xrange(terms):
+                tc['P%015d' % i]
+        return memory_used(populate)
+
+
+def memory_static_data(path, stream):
+    """memory used anonymizing the static data file at path"""
+    from pheme.anonymize.db_static_data import anonymize_objects
+    with scratch_cache(prewarm_keys=0):
+        def anonymize():
+            with open(path) as static, open(os.devnull, 'wb') as output:
+                anonymize_objects(static, output, stream)
+        return memory_used(anonymize)
+
+
+def bench_memory(args):
+    """peak memory per message and per cached term, against budgets"""
+    directory = tempfile.mkdtemp()
+    cases = []
+    for count in args.messages:
+        path = os.path.join(directory, 'batch-%d.hl7' % count)
+        write_batch(path, count)
+        cases.append(('split', count, 'msg', memory_split, (path,)))
+        cases.append(('anonymize', count, 'msg', memory_anonymize,
+                      (count,)))
+    for terms in args.terms:
+        cases.append(('cache', terms, 'term', memory_cache, (terms,)))
+    for count in args.objects:
+        path = os.path.join(directory, 'static-%d.yaml' % count)
+        in_process(write_static_data, path, count)
+        cases.append(('static', count, 'object', memory_static_data,
+                      (path, False)))
+        cases.append(('static-stream', count, 'object',
+                      memory_static_data, (path, True)))
+
+    budgets = {}
+    for budget in args.budget:
+        name, limit = budget.split('=')
+        budgets[name] = float(limit)
+
+    exceeded = []
+    try:
+        for name, count, unit, func, func_args in cases:
+            peak, traced = in_process(func, *func_args)
+            per_unit = float(peak) / count
+            print "%-14s %8d %-6s  peak rss %12d  traced %12s  %10.1f "\
+                "bytes/%s" % (name, count, unit, peak,
+                              'n/a' if traced is None else traced,
+                              per_unit, unit)
+            if name in budgets and per_unit > budgets[name]:
+                exceeded.append("%s of %d: %.1f bytes/%s exceeds budget "
+                                "of %.1f" % (name, count, per_unit, unit,
+                                             budgets[name]))
+    finally:
+        shutil.rmtree(directory)
+    if exceeded:
+        print >> sys.stderr, '\n'.join(exceeded)
+        sys.exit(1)
+
+
+def report(label, elapsed, count, unit='msg'):
+    """print throughput summary line"""
+    rate = count / elapsed if elapsed else float('inf')
+    print "%-24s %8.3fs %10.1f %s/s" % (label, elapsed, rate, unit)
+
+
+def main():
+    """Entry point to run anonymize benchmarks
+
+    parameters are read from the command line.  call with '-h' for
+    options and documentation
+
+    """
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+
+    lazy = subparsers.add_parser(
+        'lazy', help="full versus lazy per-segment message parsing")
+    lazy.add_argument("-n", "--messages", type=int, default=5000,
+                      help="number of messages in the sample mix")
+    lazy.set_defaults(func=bench_lazy)
+
+    prewarm = subparsers.add_parser(
+        'prewarm', help="cold versus prewarmed term cache latency")
+    prewarm.add_argument("-n", "--messages", type=int, default=20000,
+                         help="number of messages in the sample mix")
+    prewarm.add_argument("-k", "--keys", type=int, default=1000,
+                         help="number of hot keys to prewarm")
+    prewarm.add_argument("-s", "--seconds", type=float, default=60,
+                         help="measure latency over the first 'seconds'")
+    prewarm.set_defaults(func=bench_prewarm)
+
+    batch = subparsers.add_parser(
+        'batch', help="message at a time versus windowed bulk resolution")
+    batch.add_argument("-n", "--messages", type=int, default=5000,
+                       help="number of messages in the sample mix")
+    batch.add_argument("-w", "--window", type=int, default=500,
+                       help="number of messages per window")
+    batch.set_defaults(func=bench_batch)
+
+    compact = subparsers.add_parser(
+        'compact', help="bytes per entry, dict versus compact store")
+    compact.add_argument("-t", "--terms", type=int, default=100000,
+                         help="number of terms to store")
+    compact.set_defaults(func=bench_compact)
+
+    obx = subparsers.add_parser(
+        'obx', help="OBX-5 type and magnitude anonymization throughput")
+    obx.add_argument("-n", "--messages", type=int, default=2000,
+                     help="number of lab result messages")
+    obx.add_argument("-o", "--observations", type=int, default=20,
+                     help="number of OBX segments per message")
+    obx.set_defaults(func=bench_obx)
+
+    codec = subparsers.add_parser(
+        'codec', help="pickle versus binary value encoding")
+    codec.add_argument("-t", "--terms", type=int, default=100000,
+                       help="number of values to encode")
+    codec.set_defaults(func=bench_codec)
+
+    memory = subparsers.add_parser(
+        'memory', help="peak memory per message and per cached term")
+    memory.add_argument("-n", "--messages", type=int, nargs='*',
+                        default=[1000, 10000],
+                        help="numbers of messages to split and anonymize")
+    memory.add_argument("-t", "--terms", type=int, nargs='*',
+                        default=[10000, 100000],
+                        help="numbers of terms to cache")
+    memory.add_argument("-o", "--objects", type=int, nargs='*', default=[],
+                        help="numbers of static data objects to anonymize")
+    memory.add_argument("-b", "--budget", action='append', default=[],
+                        metavar='CASE=BYTES',
+                        help="fail if the peak bytes per unit of a case "
+                        "(split, anonymize, cache, static, static-stream) "
+                        "exceed BYTES")
+    memory.set_defaults(func=bench_memory)
+
+    args = parser.parse_args()
+    args.func(args)
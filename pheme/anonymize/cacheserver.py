@@ -0,0 +1,336 @@
+"""Term cache server, sharing one cache among many processes
+
+Only a single process can safely hold a shelve based term cache open.
+The cache server holds the entire mapping in memory, persists every
+change to an append-only log, and serves any number of local clients
+over a Unix domain socket.  Configure clients by setting the
+'cacheserver' value in the 'anonymize' config section to the socket
+path; see :py:class:`RemoteStore`.
+
+Requests and responses are length prefixed pickles, so clients may
+pipeline any number of requests before reading the responses, which
+are returned in request order.  The socket is only accessible to the
+owning user, as pickles must never be accepted from untrusted peers.
+
+Set-if-absent requests ('setnx', 'msetnx') return the value actually
+held once the request completes, so two clients missing on the same
+term always receive the same anonymized value.
+
+"""
+import argparse
+import cPickle as pickle
+import os
+import socket
+import SocketServer
+import struct
+import sys
+import threading
+
+from pheme.util.config import Config
+
+HEADER = struct.Struct('!I')
+
+
+def send_frame(fileobj, obj):
+    """write obj to fileobj as a length prefixed pickle"""
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    fileobj.write(HEADER.pack(len(data)))
+    fileobj.write(data)
+
+
+def recv_frame(fileobj):
+    """read a length prefixed pickle from fileobj, None at EOF"""
+    header = fileobj.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    size, = HEADER.unpack(header)
+    data = fileobj.read(size)
+    if len(data) < size:
+        raise IOError("truncated frame")
+    return pickle.loads(data)
+
+
+class RemoteStore(object):
+    """Term cache backend, client of a running cache server
+
+    Implements the mapping protocol :py:class:`TermCache` expects of
+    its store, along with bulk ('mget') and set-if-absent ('setnx',
+    'msetnx') requests.  The connection is made on first use, and
+    is safe to share among threads.
+
+    :param socket_path: path of the cache server's Unix socket
+
+    """
+    WINDOW = 128  # max requests in flight
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+        self.rfile = self.sock.makefile('rb')
+        self.wfile = self.sock.makefile('wb')
+
+    def pipeline(self, requests):
+        """send all requests, then read all responses
+
+        :param requests: sequence of tuples, operation name followed
+          by its arguments, i.e. ('get', 'term')
+
+        returns list of results in request order.  raises the first
+        error returned by the server.
+
+        Requests are sent in windows, so neither side blocks writing
+        to a full socket buffer while the other is doing the same.
+        Should sending or receiving fail partway, the connection is
+        dropped, as responses to the requests already sent would
+        otherwise be read by the next call; it reconnects instead.
+
+        """
+        responses = []
+        with self.lock:
+            if self.sock is None:
+                self._connect()
+            try:
+                for start in range(0, len(requests), self.WINDOW):
+                    window = requests[start:start + self.WINDOW]
+                    for request in window:
+                        send_frame(self.wfile, request)
+                    self.wfile.flush()
+                    for request in window:
+                        response = recv_frame(self.rfile)
+                        if response is None:
+                            raise IOError("cache server closed the "
+                                          "connection")
+                        responses.append(response)
+            except:
+                self._disconnect()
+                raise
+        results = []
+        for response in responses:
+            ok, result = response
+            if not ok:
+                raise result
+            results.append(result)
+        return results
+
+    def _call(self, *request):
+        return self.pipeline([request])[0]
+
+    def __contains__(self, key):
+        return self._call('get', key) is not None
+
+    def __getitem__(self, key):
+        value = self._call('get', key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self._call('get', key)
+        return default if value is None else value
+
+    def __setitem__(self, key, value):
+        self._call('set', key, value)
+
+    def __delitem__(self, key):
+        self._call('delete', key)
+
+    def mget(self, keys):
+        return self._call('mget', list(keys))
+
+    def setnx(self, key, value):
+        return self._call('setnx', key, value)
+
+    def msetnx(self, mapping):
+        return self._call('msetnx', mapping)
+
+    def keys(self):
+        return self._call('keys')
+
+    def sync(self):
+        """no-op, the server persists every write"""
+
+    def _disconnect(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass  # already closed by the server
+        for fileobj in (self.rfile, self.wfile, self.sock):
+            try:
+                fileobj.close()
+            except socket.error:
+                pass  # unsent requests, dropped with the connection
+        self.sock = None
+
+    def close(self):
+        with self.lock:
+            if self.sock is not None:
+                self._disconnect()
+
+
+class TermStore(object):
+    """In memory term mapping, persisted to an append-only log
+
+    :param logfile: path to the log.  Any existing log is replayed on
+      construction; a trailing partial record (say from a crash
+      mid-write) is truncated.
+    :param fsync: if set, the log is fsync'd after every write, not
+      just flushed to the operating system.
+
+    """
+    def __init__(self, logfile, fsync=False):
+        self.terms = {}
+        self.lock = threading.Lock()
+        self.fsync = fsync
+        self.replay(logfile)
+        self.log = open(logfile, 'ab')
+
+    def replay(self, logfile):
+        if not os.path.exists(logfile):
+            return
+        with open(logfile, 'r+b') as log:
+            good = 0
+            while True:
+                try:
+                    record = pickle.load(log)
+                except (EOFError, pickle.UnpicklingError, ValueError,
+                        IndexError):
+                    break
+                good = log.tell()
+                if record[0] == 'set':
+                    self.terms[record[1]] = record[2]
+                else:
+                    self.terms.pop(record[1], None)
+            log.truncate(good)
+
+    def _append(self, records):
+        for record in records:
+            pickle.dump(record, self.log, pickle.HIGHEST_PROTOCOL)
+        self.log.flush()
+        if self.fsync:
+            os.fsync(self.log.fileno())
+
+    def get(self, key):
+        return self.terms.get(key)
+
+    def mget(self, keys):
+        return [self.terms.get(key) for key in keys]
+
+    def set(self, key, value):
+        with self.lock:
+            self.terms[key] = value
+            self._append([('set', key, value)])
+        return value
+
+    def setnx(self, key, value):
+        return self.msetnx({key: value})[key]
+
+    def msetnx(self, mapping):
+        """set each absent key, returns the values held for all keys"""
+        with self.lock:
+            records = []
+            for key, value in mapping.iteritems():
+                if key not in self.terms:
+                    self.terms[key] = value
+                    records.append(('set', key, value))
+            self._append(records)
+            return dict((key, self.terms[key]) for key in mapping)
+
+    def delete(self, key):
+        with self.lock:
+            if key not in self.terms:
+                raise KeyError(key)
+            del self.terms[key]
+            self._append([('del', key)])
+
+    def keys(self):
+        return self.terms.keys()
+
+    def close(self):
+        self.log.close()
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    """serve requests from a single client connection, in order"""
+    OPERATIONS = ('get', 'mget', 'set', 'setnx', 'msetnx', 'delete', 'keys')
+
+    def handle(self):
+        store = self.server.store
+        while True:
+            request = recv_frame(self.rfile)
+            if request is None:
+                break
+            op, args = request[0], request[1:]
+            try:
+                if op not in self.OPERATIONS:
+                    raise ValueError("unknown operation '%s'" % op)
+                response = (True, getattr(store, op)(*args))
+            except Exception, e:
+                response = (False, e)
+            send_frame(self.wfile, response)
+            self.wfile.flush()
+
+
+class TermCacheServer(SocketServer.ThreadingMixIn,
+                      SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, store):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.store = store
+        previous = os.umask(0077)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, socket_path,
+                                                   RequestHandler)
+        finally:
+            os.umask(previous)
+
+
+def serve_ep():
+    """entry point to run the term cache server
+
+    parameters are read from the command line.  call with '-h' for
+    options and documentation
+
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--socket",
+                        help="socket path, by default the configured "
+                        "'cacheserver' value")
+    parser.add_argument("-l", "--log",
+                        help="append-only log persisting the cache, by "
+                        "default the configured 'cachefile' + '.log'")
+    parser.add_argument("--import-cache", action='store_true',
+                        help="import all terms from the configured shelve "
+                        "cache not already in the log")
+    parser.add_argument("--fsync", action='store_true',
+                        help="fsync the log after every write")
+    args = parser.parse_args()
+
+    from pheme.anonymize.termcache import config_value, open_store
+    cachefile = Config().get('anonymize', 'cachefile')
+    socket_path = args.socket or config_value('cacheserver')
+    if not socket_path:
+        raise ValueError("no socket path given or configured")
+    store = TermStore(args.log or cachefile + '.log', args.fsync)
+    if args.import_cache:
+        shelf = open_store(cachefile, config_value('cacheshards', 1))
+        store.msetnx(dict((key, shelf[key]) for key in shelf.keys()))
+        shelf.close()
+
+    server = TermCacheServer(socket_path, store)
+    print >> sys.stderr, "Serving %d terms on %s" % (len(store.terms),
+                                                     socket_path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        store.close()
+        os.remove(socket_path)
@@ -0,0 +1,73 @@
+"""Memory bounded distinct count estimation
+
+Used to profile a feed, estimating the number of distinct terms per
+field, and how many of them would be new to the term cache, without
+holding every term in memory.
+
+"""
+import hashlib
+import math
+import struct
+
+_UINT64 = struct.Struct('<Q')
+
+
+def hash64(value):
+    """returns a well mixed 64 bit hash of the str value"""
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return _UINT64.unpack_from(hashlib.md5(value).digest())[0]
+
+
+class HyperLogLog(object):
+    """HyperLogLog distinct count estimator
+
+    :param precision: number of hash bits selecting the register;
+      2**precision one byte registers are held.  The standard error
+      of the estimate is about 1.04 / sqrt(2**precision), roughly 1.6%
+      at the default of 12 (4 KiB).
+
+    """
+    def __init__(self, precision=12):
+        if not 4 <= precision <= 18:
+            raise ValueError("precision must be between 4 and 18")
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(self.m)
+
+    def add(self, value):
+        """add str value to the set being counted"""
+        self.add_hash(hash64(value))
+
+    def add_hash(self, hashed):
+        """add a value by its :py:func:`hash64`, when already known"""
+        width = 64 - self.precision
+        index = hashed >> width
+        # position of the leftmost one bit in the remaining bits
+        rank = width - (hashed & ((1 << width) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, other):
+        """merge other into this estimator, estimating the union"""
+        if other.precision != self.precision:
+            raise ValueError("can't merge differing precision")
+        for i, rank in enumerate(other.registers):
+            if rank > self.registers[i]:
+                self.registers[i] = rank
+
+    def count(self):
+        """returns estimated number of distinct values added"""
+        m = self.m
+        if m >= 128:
+            alpha = 0.7213 / (1 + 1.079 / m)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}[m]
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count('\x00')
+        if estimate <= 2.5 * m and zeros:
+            # small range correction, linear counting
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+    __len__ = count
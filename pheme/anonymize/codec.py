@@ -0,0 +1,177 @@
+"""Value codecs for the term cache
+
+`shelve` pickles every value, although nearly all cached values are
+plain str (with the odd float `date_delta-*` entry), paying the pickle
+framing in every entry on disk and the unpickler on every hit.  The
+:py:class:`BinaryCodec` instead tags each value with a single type
+byte, followed by the raw str, or a fixed width packed int, float or
+datetime.  Any other value is pickled.
+
+Values written by earlier releases (plain pickles) never start with
+one of the type bytes, so are still decoded, and a cache migrates
+transparently: legacy entries remain readable, and all new entries
+use the binary form.  Run `migrate_term_cache` to rewrite the legacy
+entries of an existing cache in place.
+
+The codec is chosen with the 'codec' value in the 'anonymize' config
+section, 'binary' (the default) or 'pickle'.  Either decodes the
+values written by the other, so the setting may be changed at will;
+only new entries use the codec chosen.
+
+"""
+import anydbm
+import cPickle as pickle
+import datetime
+import shelve
+import struct
+import sys
+
+STR, UNICODE, INT, FLOAT, DATETIME = '\x01', '\x02', '\x03', '\x04', '\x05'
+PACKED_INT = struct.Struct('<q')
+PACKED_FLOAT = struct.Struct('<d')
+EPOCH = datetime.datetime(1970, 1, 1)
+MIN_INT, MAX_INT = -2 ** 63, 2 ** 63 - 1
+
+
+TAGS = (STR, UNICODE, INT, FLOAT, DATETIME)
+
+
+class PickleCodec(object):
+    """Encodes values as shelve always has
+
+    Values written by the :py:class:`BinaryCodec` are still decoded,
+    so a cache may be switched back to pickle at any time.
+
+    """
+    name = 'pickle'
+
+    def __init__(self, protocol=0):
+        self.protocol = protocol
+
+    def encode(self, value):
+        return pickle.dumps(value, self.protocol)
+
+    def decode(self, data):
+        if data[:1] in TAGS:  # never the first byte of a pickle
+            return CODECS['binary'].decode(data)
+        return pickle.loads(str(data))
+
+
+class BinaryCodec(object):
+    """Type tagged binary encoding of str, int, float and datetime
+
+    Each encoded value is a type byte followed by the str (raw),
+    unicode (UTF-8), int (8 byte signed), float (8 byte double) or
+    naive datetime (8 byte signed microseconds since the epoch), all
+    little endian.  Other values, and ints too large to pack, are
+    pickled; pickles are decoded whatever their protocol.
+
+    """
+    name = 'binary'
+
+    def encode(self, value):
+        kind = type(value)
+        if kind is str:
+            return STR + value
+        if kind is unicode:
+            return UNICODE + value.encode('utf-8')
+        if kind is int or (kind is long and MIN_INT <= value <= MAX_INT):
+            return INT + PACKED_INT.pack(value)
+        if kind is float:
+            return FLOAT + PACKED_FLOAT.pack(value)
+        if kind is datetime.datetime and value.tzinfo is None:
+            delta = value - EPOCH
+            return DATETIME + PACKED_INT.pack(
+                (delta.days * 86400 + delta.seconds) * 1000000 +
+                delta.microseconds)
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data):
+        tag = data[:1]  # str, even when data is a bytearray
+        if tag == STR:
+            return str(data[1:])
+        if tag == UNICODE:
+            return data[1:].decode('utf-8')
+        if tag == INT:
+            return PACKED_INT.unpack_from(data, 1)[0]
+        if tag == FLOAT:
+            return PACKED_FLOAT.unpack_from(data, 1)[0]
+        if tag == DATETIME:
+            return EPOCH + datetime.timedelta(
+                microseconds=PACKED_INT.unpack_from(data, 1)[0])
+        return pickle.loads(str(data))  # legacy or unsupported type
+
+    def is_legacy(self, data):
+        """True if data wasn't written by this codec's tagged forms"""
+        return data[:1] not in TAGS
+
+
+CODECS = {'binary': BinaryCodec(), 'pickle': PickleCodec()}
+
+
+def get_codec(name='binary'):
+    """returns the codec registered under name"""
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError("unknown codec '%s', not one of %s" % (
+            name, ', '.join(sorted(CODECS))))
+
+
+class CodecShelf(shelve.Shelf):
+    """Shelf encoding its values with a codec, in place of pickle
+
+    :param filename: path of the dbm file, as for `shelve.open`
+    :param flag: dbm open flag, as for `shelve.open`
+    :param writeback: as for `shelve.open`
+    :param codec: the codec, by default the :py:class:`BinaryCodec`
+
+    """
+    def __init__(self, filename, flag='c', writeback=False, codec=None):
+        shelve.Shelf.__init__(self, anydbm.open(filename, flag),
+                              writeback=writeback)
+        self.codec = codec or CODECS['binary']
+
+    def __getitem__(self, key):
+        try:
+            value = self.cache[key]
+        except KeyError:
+            value = self.codec.decode(self.dict[key])
+            if self.writeback:
+                self.cache[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if self.writeback:
+            self.cache[key] = value
+        self.dict[key] = self.codec.encode(value)
+
+    def migrate(self):
+        """re-encode legacy values with the codec, returns the count"""
+        if not hasattr(self.codec, 'is_legacy'):
+            return 0
+        count = 0
+        for key in self.dict.keys():
+            data = self.dict[key]
+            if self.codec.is_legacy(data):
+                self.dict[key] = self.codec.encode(pickle.loads(data))
+                count += 1
+        return count
+
+
+def migrate_ep():
+    """entry point to re-encode the legacy values of the term cache
+
+    The configured cache, held open by the term cache singleton, is
+    migrated in place.
+
+    """
+    from pheme.anonymize import termcache
+    store = getattr(termcache.tc.shelf, 'backing', termcache.tc.shelf)
+    if not hasattr(store, 'migrate'):
+        print >> sys.stderr, "Only local caches may be migrated, run on "\
+            "the cache server's host"
+        sys.exit(1)
+    count = store.migrate()
+    store.sync()
+    print "Migrated %d terms" % count
@@ -0,0 +1,101 @@
+"""Columnar sidecar of selected anonymized fields
+
+Analytics jobs typically need a few dozen fields of each message, and
+shouldn't have to parse the anonymized HL/7 a second time to get
+them.  A :py:class:`ColumnarWriter` takes the chosen fields from each
+message as it's anonymized (see `anonymize_file --columnar`), one row
+per message, one column per segment-element.component field.  Only
+the first occurrence of a repeating segment (i.e. OBX) is used.
+
+Rows are buffered and written a row group at a time, so memory use is
+bounded by the row group size.  The sidecar is written as CSV with a
+header row, or as Parquet when the path ends in '.parquet' and the
+`pyarrow` package is installed.
+
+"""
+import csv
+
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:  # pyarrow unavailable, only CSV may be written
+    pyarrow = None
+
+from pheme.anonymize.field_map import FieldMap
+
+DEFAULT_COLUMNS = 'MSH-4.1,MSH-7.1,MSH-9.2,PID-3.1,PID-7.1,PID-8.1,'\
+    'PID-11.5,PV1-2.1,PV1-19.1,PV1-44.1'
+
+
+def parse_columns(value):
+    """parse comma separated field labels, i.e. 'PID-3.1,PV1-19.1'
+
+    returns list of (label, (segment, element, component)) tuples,
+    elements adjusted as for :py:class:`FieldMap`.
+
+    """
+    key_parser = FieldMap()
+    return [(label.strip(), key_parser.assert_triplekey(label.strip()))
+            for label in value.split(',') if label.strip()]
+
+
+def _text(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value) if value is not None else ''
+
+
+class ColumnarWriter(object):
+    """Writes selected fields of anonymized messages in row groups
+
+    :param path: sidecar path, Parquet if ending in '.parquet'
+    :param columns: as returned from :py:func:`parse_columns`
+    :param row_group: number of rows buffered per write
+
+    """
+    def __init__(self, path, columns, row_group=10000):
+        self.columns = columns
+        self.row_group = row_group
+        self.rows = []
+        self.count = 0
+        self.parquet = path.endswith('.parquet')
+        if self.parquet:
+            if pyarrow is None:
+                raise ValueError("writing '%s' requires pyarrow" % path)
+            self.schema = pyarrow.schema([(label, pyarrow.string())
+                                          for label, key in columns])
+            self.writer = parquet.ParquetWriter(path, self.schema)
+        else:
+            self.file = open(path, 'wb')
+            self.writer = csv.writer(self.file)
+            self.writer.writerow([label for label, key in columns])
+
+    def add(self, anon):
+        """add the row for an anonymized :py:class:`MBDS_anon`"""
+        self.rows.append([_text(anon.field_value(*key))
+                          for label, key in self.columns])
+        if len(self.rows) >= self.row_group:
+            self.flush()
+
+    def flush(self):
+        """write the buffered rows as a row group"""
+        if not self.rows:
+            return
+        if self.parquet:
+            arrays = [pyarrow.array([row[i].decode('utf-8') for row in
+                                     self.rows], pyarrow.string())
+                      for i in range(len(self.columns))]
+            self.writer.write_table(pyarrow.Table.from_arrays(
+                arrays, schema=self.schema))
+        else:
+            self.writer.writerows(self.rows)
+            self.file.flush()
+        self.count += len(self.rows)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        if self.parquet:
+            self.writer.close()
+        else:
+            self.file.close()
@@ -0,0 +1,261 @@
+"""Compact, array backed in memory term store
+
+A python dict of str keys and values costs well over a hundred bytes
+per entry once the object headers, hash table and string objects are
+accounted for.  The :py:class:`CompactStore` instead packs each key
+and (encoded) value into one large contiguous buffer, indexed by an
+open addressing hash table of buffer offsets, so caches holding tens
+of millions of terms may be kept entirely resident.
+
+"""
+from array import array
+import struct
+import sys
+
+from pheme.anonymize.codec import BinaryCodec
+
+RECORD_HEADER = struct.Struct('<II')  # key length, value length
+EMPTY, DELETED = 0, -1  # reserved index slot values
+
+
+_codec = BinaryCodec()
+encode_value, decode_value = _codec.encode, _codec.decode
+
+
+class CompactStore(object):
+    """Mapping of str keys to values, packed into contiguous buffers
+
+    Each entry is appended to a single bytearray as a record header
+    (key and value lengths) followed by the key and encoded value.
+    The index is an array of record offsets (plus one, as zero marks
+    an empty slot) probed linearly from the key's hash.
+
+    Overwritten and deleted records remain in the buffer till
+    :py:meth:`compact` is called.
+
+    :param capacity: initial number of index slots
+
+    """
+    MAX_LOAD = 0.66
+
+    def __init__(self, capacity=1024):
+        self.data = bytearray()
+        self.index = array('l', [EMPTY]) * capacity
+        self.count = 0  # live entries
+        self.used = 0  # live entries plus tombstones
+        self.garbage = 0  # bytes held by dead records
+
+    def _probe(self, key):
+        """returns (slot, offset) for key, offset None if absent
+
+        When absent, slot is the first free (empty or deleted) slot.
+
+        """
+        index, data = self.index, self.data
+        mask = len(index)
+        slot = hash(key) % mask
+        free = None
+        while True:
+            entry = index[slot]
+            if entry == EMPTY:
+                return (slot if free is None else free), None
+            if entry == DELETED:
+                if free is None:
+                    free = slot
+            else:
+                offset = entry - 1
+                klen, vlen = RECORD_HEADER.unpack_from(data, offset)
+                start = offset + RECORD_HEADER.size
+                if klen == len(key) and data[start:start + klen] == key:
+                    return slot, offset
+            slot = (slot + 1) % mask
+
+    def _value(self, offset):
+        klen, vlen = RECORD_HEADER.unpack_from(self.data, offset)
+        start = offset + RECORD_HEADER.size + klen
+        return decode_value(self.data[start:start + vlen])
+
+    def _record_size(self, offset):
+        klen, vlen = RECORD_HEADER.unpack_from(self.data, offset)
+        return RECORD_HEADER.size + klen + vlen
+
+    def _append(self, key, value):
+        """append record, returning its index entry"""
+        encoded = encode_value(value)
+        offset = len(self.data)
+        self.data.extend(RECORD_HEADER.pack(len(key), len(encoded)))
+        self.data.extend(key)
+        self.data.extend(encoded)
+        return offset + 1
+
+    def _resize(self, capacity):
+        entries = [entry for entry in self.index if entry > 0]
+        self.index = array('l', [EMPTY]) * capacity
+        self.used = 0
+        for entry in entries:
+            klen, vlen = RECORD_HEADER.unpack_from(self.data, entry - 1)
+            start = entry - 1 + RECORD_HEADER.size
+            slot, offset = self._probe(str(self.data[start:start + klen]))
+            self.index[slot] = entry
+            self.used += 1
+
+    def __contains__(self, key):
+        return self._probe(key)[1] is not None
+
+    def __getitem__(self, key):
+        offset = self._probe(key)[1]
+        if offset is None:
+            raise KeyError(key)
+        return self._value(offset)
+
+    def get(self, key, default=None):
+        offset = self._probe(key)[1]
+        if offset is None:
+            return default
+        return self._value(offset)
+
+    def __setitem__(self, key, value):
+        if not isinstance(key, str):
+            raise TypeError("keys must be str")
+        slot, offset = self._probe(key)
+        if offset is not None:
+            self.garbage += self._record_size(offset)
+        else:
+            self.count += 1
+            if self.index[slot] == EMPTY:
+                self.used += 1
+        self.index[slot] = self._append(key, value)
+        if self.used > self.MAX_LOAD * len(self.index):
+            self._resize(len(self.index) * 2)
+
+    def __delitem__(self, key):
+        slot, offset = self._probe(key)
+        if offset is None:
+            raise KeyError(key)
+        self.garbage += self._record_size(offset)
+        self.index[slot] = DELETED
+        self.count -= 1
+
+    def __len__(self):
+        return self.count
+
+    def iterkeys(self):
+        for entry in self.index:
+            if entry > 0:
+                klen, vlen = RECORD_HEADER.unpack_from(self.data, entry - 1)
+                start = entry - 1 + RECORD_HEADER.size
+                yield str(self.data[start:start + klen])
+
+    __iter__ = iterkeys
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def compact(self):
+        """rebuild the buffer and index, dropping dead records"""
+        live = [(key, self[key]) for key in self.iterkeys()]
+        capacity = len(self.index)
+        self.__init__(capacity)
+        for key, value in live:
+            self[key] = value
+
+    def nbytes(self):
+        """returns bytes held by the buffer and index"""
+        return (len(self.data) + self.index.itemsize * len(self.index) +
+                sys.getsizeof(self))
+
+    def bytes_per_entry(self):
+        """returns average bytes held per live entry"""
+        if not self.count:
+            return 0.0
+        return float(self.nbytes()) / self.count
+
+    def sync(self):
+        """no-op, the store is only held in memory"""
+
+    def close(self):
+        """no-op, the store is only held in memory"""
+
+
+class ResidentStore(object):
+    """Keeps an entire persistent store resident in a CompactStore
+
+    Every entry of the backing store is loaded on construction; reads
+    are then served entirely from memory.  Writes are applied to both.
+
+    Set-if-absent (:py:meth:`msetnx`) is resolved by the backing
+    store, where it supports it (i.e. a cache server), so processes
+    sharing the backing store never hand out different values for the
+    same new term.  Bulk lookups (:py:meth:`mget`) likewise fall back
+    to such a backing store for keys missing from memory, picking up
+    those stored by other processes since the load.
+
+    :param backing: the persistent mapping, i.e. a non writeback
+      shelf, see :py:func:`pheme.anonymize.termcache.open_store`
+
+    """
+    def __init__(self, backing):
+        self.backing = backing
+        self.memory = CompactStore()
+        for key in backing.keys():
+            self.memory[key] = backing[key]
+
+    def __contains__(self, key):
+        return key in self.memory
+
+    def __getitem__(self, key):
+        return self.memory[key]
+
+    def get(self, key, default=None):
+        return self.memory.get(key, default)
+
+    def __setitem__(self, key, value):
+        self.backing[key] = value
+        self.memory[key] = value
+
+    def __delitem__(self, key):
+        del self.backing[key]
+        del self.memory[key]
+
+    def mget(self, keys):
+        """bulk lookup, returns list of the values (None if absent)"""
+        values = [self.memory.get(key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is None]
+        if missing and hasattr(self.backing, 'mget'):
+            fetched = self.backing.mget([keys[i] for i in missing])
+            for i, value in zip(missing, fetched):
+                if value is not None:
+                    self.memory[keys[i]] = values[i] = value
+        return values
+
+    def msetnx(self, mapping):
+        """set each key absent from the backing store
+
+        returns dict of the values held for every key in mapping.
+
+        """
+        if hasattr(self.backing, 'msetnx'):
+            held = self.backing.msetnx(mapping)
+        else:
+            held = {}
+            for key, value in mapping.iteritems():
+                if key in self.backing:
+                    held[key] = self.backing[key]
+                else:
+                    self.backing[key] = held[key] = value
+            self.backing.sync()
+        for key, value in held.iteritems():
+            self.memory[key] = value
+        return held
+
+    def keys(self):
+        return self.memory.keys()
+
+    def bytes_per_entry(self):
+        return self.memory.bytes_per_entry()
+
+    def sync(self):
+        self.backing.sync()
+
+    def close(self):
+        self.backing.close()
@@ -2,11 +2,30 @@
 
 """
 import argparse
+from collections import namedtuple
+import hashlib
+import hmac
+from itertools import islice
+import mmap
+import os
+import re
+from sqlalchemy import and_, bindparam, create_engine
+from sqlalchemy.orm import class_mapper, sessionmaker
+import struct
 import sys
 import yaml
+try:
+    from yaml import CLoader as Loader, CDumper as Dumper
+except ImportError:  # libyaml unavailable, fall back to pure python
+    from yaml import Loader, Dumper
 
-from pheme.anonymize.alter import anon_term
-from pheme.anonymize.field_map import anon_map
+from pheme.anonymize.alter import anon_term, anon_terms
+from pheme.anonymize.alter import fixed_length_string
+from pheme.anonymize.fileutil import file_signature, replace_file
+from pheme.anonymize.field_map import anon_map, five_digits, short_string
+from pheme.anonymize.field_map import site_string, ten_digits_starting_w_1
+from pheme.anonymize import profiling
+from pheme.anonymize.termcache import config_value
 from pheme.longitudinal.static_data import SUPPORTED_DAOS
 from pheme.longitudinal.static_data import obj_repr, obj_loader
 import pheme.longitudinal.tables as tables
@@ -38,6 +57,7 @@ def region_anon(self):
 for type in SUPPORTED_DAOS:
     klass = getattr(tables, type)
     yaml.add_representer(klass, obj_repr)
+    yaml.add_representer(klass, obj_repr, Dumper=Dumper)
     if type == 'Facility':
         klass.anonymize = facility_anon
     elif type == 'ReportableRegion':
@@ -46,6 +66,327 @@ for type in SUPPORTED_DAOS:
         klass.anonymize = lambda(self): None
 
 
+# Columns anonymized by the direct database mode, mirroring
+# `facility_anon` and `region_anon`: each column is anonymized with
+# `func` and the result converted by `convert`.  Columns not `cached`
+# are regenerated on every run.
+AnonColumn = namedtuple('AnonColumn', 'attribute func convert cached')
+
+DB_COLUMNS = (
+    ('Facility', (
+        AnonColumn('county', short_string, None, True),
+        AnonColumn('npi', ten_digits_starting_w_1, int, True),
+        AnonColumn('zip', five_digits, str, False),
+        AnonColumn('organization_name', site_string, None, True),
+        AnonColumn('local_code', fixed_length_string(3), None, True))),
+    ('ReportableRegion', (
+        AnonColumn('region_name', fixed_length_string(4), None, True),
+        AnonColumn('dim_facility_pk', ten_digits_starting_w_1, int,
+                   True))),
+    )
+
+
+def batches(iterable, size):
+    """Generator to yield lists of up to `size` items from iterable"""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            break
+        yield batch
+
+
+def anonymize_table(session, klass, columns, batch_size=1000):
+    """Anonymize the given columns of every row of the mapped class
+
+    :param session: SQLAlchemy session, the caller is responsible
+      for committing the transaction
+    :param klass: the mapped class, i.e. `tables.Facility`
+    :param columns: sequence of :py:class:`AnonColumn` to anonymize
+    :param batch_size: number of rows read (via a server side cursor
+      where supported), anonymized and written back at a time
+
+    Terms for each batch are resolved with a single bulk cache lookup
+    per column, and written back with one executemany update.
+    Returns the number of rows anonymized.
+
+    """
+    mapper = class_mapper(klass)
+    table = mapper.local_table
+    pk_columns = mapper.primary_key
+    pk_attrs = [mapper.get_property_by_column(c).key for c in pk_columns]
+    attrs = [column.attribute for column in columns]
+
+    statement = table.update().where(and_(*[
+        c == bindparam('pk_%s' % c.key) for c in pk_columns])).values(
+        dict((mapper.get_property(attr).columns[0].key,
+              bindparam('anon_%s' % attr)) for attr in attrs))
+
+    query = session.query(*[getattr(klass, attr) for attr in
+                            pk_attrs + attrs])
+    query = query.execution_options(stream_results=True)
+    count = 0
+    for batch in batches(query.yield_per(batch_size), batch_size):
+        params = [dict(('pk_%s' % c.key, getattr(row, attr)) for c, attr
+                       in zip(pk_columns, pk_attrs)) for row in batch]
+        for column in columns:
+            values = [getattr(row, column.attribute) for row in batch]
+            if column.cached:
+                anonymized = anon_terms(values, column.func)
+                values = [anonymized.get(value, value) for value in values]
+            else:
+                values = [column.func(value) if value else value
+                          for value in values]
+            if column.convert:
+                values = [column.convert(value) if value else value
+                          for value in values]
+            for param, value in zip(params, values):
+                param['anon_%s' % column.attribute] = value
+        session.execute(statement, params)
+        count += len(batch)
+    return count
+
+
+def anonymize_database(session, batch_size=1000):
+    """Anonymize the static data tables in a single transaction
+
+    returns dict of row counts anonymized, keyed by table class name
+
+    """
+    counts = {}
+    try:
+        for name, columns in DB_COLUMNS:
+            counts[name] = anonymize_table(
+                session, getattr(tables, name), columns, batch_size)
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    return counts
+
+
+def yaml_items(fileobj):
+    """Generator to yield the text of one top level YAML item at a time
+
+    :param fileobj: open filelike obj containing either a top level
+      block sequence (as written by `yaml.dump`), or a stream of
+      '---' delimited documents.
+
+    Each yielded chunk is the complete text for a single sequence
+    item or document, so only one object need be held in memory.
+    Aliases to anchors in other items can't be loaded from the chunk
+    alone, check for them first with :py:func:`has_aliases`.
+
+    """
+    chunk = []
+    # sequence items are only split when the document content starts
+    # with a sequence; mappings may hold unindented nested sequences
+    content = None  # unknown till the first content line
+    for line in fileobj:
+        if line.startswith('---'):
+            if chunk:
+                yield ''.join(chunk)
+            chunk = [line]
+            content = 'mapping' if line[3:].strip() else None
+            continue
+        if content is None and line.strip() and line[0] not in '#%':
+            content = 'sequence' if line.startswith('-') else 'mapping'
+        if content == 'sequence' and line.startswith('-') and \
+                line[1:2] in (' ', '\n', '') and chunk:
+            yield ''.join(chunk)
+            chunk = []
+        chunk.append(line)
+    if chunk:
+        yield ''.join(chunk)
+
+
+# an alias indicator at the start of a node, i.e. '- *id001'
+ALIAS = re.compile(r'(?:^|[\s\[{,])\*[^\s\[\]{},]')
+
+
+def has_aliases(fileobj):
+    """returns True if the YAML text in fileobj may hold aliases
+
+    Errs on the side of caution: scalars with a word starting with '*'
+    also count.  Reads fileobj to the end.
+
+    """
+    return any(ALIAS.search(line) for line in fileobj)
+
+
+def chunk_objects(chunk):
+    """returns list of the objects loaded from the YAML text chunk"""
+    loaded = yaml.load(chunk, Loader=Loader)
+    if loaded is None:
+        return []
+    if not isinstance(loaded, list):
+        loaded = [loaded]
+    return loaded
+
+
+def load_objects(fileobj):
+    """Generator to yield one loaded object at a time from fileobj"""
+    for chunk in yaml_items(fileobj):
+        for obj in chunk_objects(chunk):
+            yield obj
+
+
+def anonymize_stream(fileobj, output):
+    """Anonymize and write one object at a time
+
+    Output is written as a top level sequence, one item per object,
+    equivalent to dumping the entire list at once.
+
+    """
+    for obj in load_objects(fileobj):
+        obj.anonymize()
+        output.write(yaml.dump([obj], Dumper=Dumper,
+                               default_flow_style=False))
+
+
+HASH_HEADER = struct.Struct('<8sQQ16sQ')
+HASH_RECORD = struct.Struct('<16sQQ')
+HASH_MAGIC = 'DAOHASH3'
+
+
+def read_hashes(path):
+    """returns dict of (offset, length) in the output at path, by digest
+
+    Empty if the sidecar (see :py:func:`write_hashes`) is absent, or
+    no longer matches the output.
+
+    """
+    try:
+        with open(path + '.hashes', 'rb') as sidecar:
+            header = sidecar.read(HASH_HEADER.size)
+            if len(header) < HASH_HEADER.size:
+                return {}
+            magic, size, mtime, digest, count = HASH_HEADER.unpack(header)
+            if magic != HASH_MAGIC or \
+                    (size, mtime, digest) != file_signature(path):
+                return {}
+            data = sidecar.read(HASH_RECORD.size * count)
+    except (IOError, OSError):
+        return {}
+    hashes = {}
+    for i in xrange(len(data) // HASH_RECORD.size):
+        digest, offset, length = HASH_RECORD.unpack_from(
+            data, i * HASH_RECORD.size)
+        hashes[digest] = (offset, length)
+    return hashes
+
+
+def write_hashes(path, records):
+    """write (digest, offset, length) records for the output at path
+
+    The sidecar, the output path plus '.hashes', holds a header
+    (magic, size, modification time and head and tail digest of the
+    output, record count) followed by one record per source item: the
+    HMAC-MD5 of the item's source text, and the offset and length of
+    its anonymized text in the output.
+
+    """
+    size, mtime, digest = file_signature(path)
+    with replace_file(path + '.hashes') as sidecar:
+        sidecar.write(HASH_HEADER.pack(HASH_MAGIC, size, mtime, digest,
+                                       len(records)))
+        for record in records:
+            sidecar.write(HASH_RECORD.pack(*record))
+
+
+def anonymize_incremental(fileobj, path, key=None):
+    """Anonymize only the objects changed since the previous run
+
+    :param fileobj: open filelike obj of the source YAML
+    :param path: path of the output, holding the output of the
+      previous run (if any) on entry
+    :param key: secret keying the source hashes, by default the
+      'hash_key' config value
+
+    Each top level item of the source is hashed; items whose hash
+    matches one in the previous run are copied verbatim from the
+    previous output, so even uncached values (i.e. zip) don't churn.
+    Only new or changed items are loaded and anonymized.  Output is
+    written as with :py:func:`anonymize_stream`, then renamed into
+    place, and the hash sidecar rewritten.  The source holds PHI, so
+    the hashes are keyed; plain digests of low entropy items could be
+    confirmed by brute force.
+
+    returns (item count, count reused from the previous output).
+    Raises ValueError if the source may hold aliases, as items sharing
+    anchors can't be hashed or anonymized alone.
+
+    """
+    key = key or config_value('hash_key')
+    if not key:
+        raise ValueError("incremental mode requires the 'hash_key' "
+                         "config value")
+    start = fileobj.tell()
+    if has_aliases(fileobj):
+        raise ValueError("incremental mode can't split YAML with aliases")
+    fileobj.seek(start)
+    key = str(key)
+    yaml.add_constructor(u'!DAO', obj_loader, Loader=Loader)
+    hashes = read_hashes(path)
+    previous = open(path, 'rb') if hashes else None
+    data = None
+    if previous and os.fstat(previous.fileno()).st_size:
+        data = mmap.mmap(previous.fileno(), 0, access=mmap.ACCESS_READ)
+    records, reused, position = [], 0, 0
+    tmpfile = path + '.tmp'
+    try:
+        with open(tmpfile, 'wb') as output:
+            for chunk in yaml_items(fileobj):
+                digest = hmac.new(key, chunk, hashlib.md5).digest()
+                if digest in hashes:
+                    offset, length = hashes[digest]
+                    text = data[offset:offset + length] if length else ''
+                    reused += 1
+                else:
+                    objects = chunk_objects(chunk)
+                    for obj in objects:
+                        obj.anonymize()
+                    text = ''.join(yaml.dump([obj], Dumper=Dumper,
+                                             default_flow_style=False)
+                                   for obj in objects)
+                output.write(text)
+                records.append((digest, position, len(text)))
+                position += len(text)
+    finally:
+        if data is not None:
+            data.close()
+        if previous:
+            previous.close()
+    os.rename(tmpfile, path)
+    write_hashes(path, records)
+    return len(records), reused
+
+
+def anonymize_objects(fileobj, output, stream=False):
+    """Anonymize the YAML objects read from fileobj, writing to output
+
+    :param stream: if set, one object at a time is read, anonymized
+      and written, see :py:func:`anonymize_stream`.  Otherwise, or if
+      the file may hold aliases (which can refer to other items), the
+      entire file is loaded at once.
+
+    """
+    yaml.add_constructor(u'!DAO', obj_loader, Loader=Loader)
+    if stream:
+        start = fileobj.tell()
+        stream = not has_aliases(fileobj)
+        fileobj.seek(start)
+    if stream:
+        anonymize_stream(fileobj, output)
+    else:
+        objects = yaml.load(fileobj.read(), Loader=Loader)
+        for obj in objects:
+            obj.anonymize()
+
+        output.write(yaml.dump(objects, Dumper=Dumper,
+                               default_flow_style=False))
+
+
 def anonymize_file():
     """Entry point to convert yaml db file to anon version
 
@@ -57,18 +398,54 @@ def anonymize_file():
     parser.add_argument("file", type=file, help="the file to anonymize")
     parser.add_argument("-o", "--output",
                         help="file for output, by default hits stdout")
+    parser.add_argument("-s", "--stream", action='store_true',
+                        help="read, anonymize and write one object at a "
+                        "time, keeping memory use constant")
+    parser.add_argument("-i", "--incremental", action='store_true',
+                        help="only anonymize objects changed since the "
+                        "run that wrote the output, reusing the rest")
+    profiling.add_arguments(parser)
     args = parser.parse_args()
-    if args.output:
-        output = open(args.output, 'wb')
+    if args.incremental and not args.output:
+        parser.error("incremental mode requires an output file")
+    if args.incremental and not config_value('hash_key'):
+        parser.error("incremental mode requires the 'hash_key' config "
+                     "value, keying the source hashes")
+    profiler = profiling.from_arguments(args)
+    run = profiler.run if profiler is not None else \
+        lambda func, *params: func(*params)
+    if args.incremental:
+        count, reused = run(anonymize_incremental, args.file, args.output)
+        print >> sys.stderr, "%d objects, %d unchanged" % (count, reused)
     else:
-        output = sys.stdout
+        if args.output:
+            output = open(args.output, 'wb')
+        else:
+            output = sys.stdout
 
-    yaml.add_constructor(u'!DAO', obj_loader)
-    objects = yaml.load(args.file.read())
-    for obj in objects:
-        obj.anonymize()
+        run(anonymize_objects, args.file, output, args.stream)
 
-    output.write(yaml.dump(objects, default_flow_style=False))
-    
-    if args.output:
-        output.close()
+        if args.output:
+            output.close()
+    if profiler is not None:
+        profiler.finish()
+
+
+def anonymize_db():
+    """Entry point to anonymize static data directly in the database
+
+    parameters are read from the command line.  call with '-h' for
+    options and documentation
+
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("database", help="SQLAlchemy URL of the "
+                        "database to anonymize in place")
+    parser.add_argument("-b", "--batch-size", type=int, default=1000,
+                        help="rows read and written per batch")
+    args = parser.parse_args()
+
+    session = sessionmaker(bind=create_engine(args.database))()
+    counts = anonymize_database(session, args.batch_size)
+    for name, count in sorted(counts.items()):
+        print "%s: %d rows anonymized" % (name, count)
@@ -4,6 +4,7 @@ import re
 from pheme.util.config import Config
 from pheme.anonymize.alter import fixed_length_digits, fixed_length_string
 from pheme.anonymize.alter import random_date_delta, anon_term
+from pheme.anonymize.alter import composite
 
 """Map message segments to the anonymize function needed
 
@@ -140,6 +141,8 @@ six_digits = fixed_length_digits(6)
 nine_digits = fixed_length_digits(9)
 ten_digits = fixed_length_digits(10)
 
+
+@composite
 def ten_digits_starting_w_1(initial):
     """specialized anon function for NPI like numbers
 
@@ -149,8 +152,10 @@ def ten_digits_starting_w_1(initial):
     """
     def one_and_nine(initial):
         return '1' + nine_digits(initial)
-    return anon_term(initial, one_and_nine)
+    return ((initial, one_and_nine),), lambda(values): values[0]
+
 
+@composite
 def msg_control_id(initial):
     """specialized anon function for message control id
 
@@ -166,10 +171,11 @@ def msg_control_id(initial):
     counter = initial[-4:]
     timestamp = initial[-18:-4]
     source_id = initial[:-18]
-    return anon_term(source_id, ten_digits) +\
-        anon_term(timestamp, ymdhms) + counter
+    return (((source_id, ten_digits), (timestamp, ymdhms)),
+            lambda(values): ''.join(values) + counter)
 
 
+@composite
 def facility_subcomponents(initial):
     """specialized anon function for PID-3.4 and 3.6
 
@@ -182,14 +188,43 @@ def facility_subcomponents(initial):
     we'd like to substitute in the same values.
 
     """
-    if initial is None or len(initial) == 0:
-        return initial
     parts = initial.split('&')
     if len(parts) < 3:
-        return anon_term(initial, dotted_sequence)
-    return '&'.join((anon_term(parts[0], site_string),
-                     anon_term(parts[1], dotted_sequence),
-                     parts[2]))
+        return ((initial, dotted_sequence),), lambda(values): values[0]
+    return (((parts[0], site_string), (parts[1], dotted_sequence)),
+            lambda(values): '&'.join(values + parts[2:3]))
+
+
+"""Namespaces, grouping cached terms for the retention policy
+
+Terms in the 'facility' namespace are pinned by default, others are
+expired as configured, see pheme.anonymize.retention
+"""
+site_string.namespace = 'facility'
+ten_digits_starting_w_1.namespace = 'facility'
+facility_subcomponents.namespace = 'facility'
+dotted_sequence.namespace = 'identifier'
+ymdhms.namespace = 'timestamp'
+yyyymm.namespace = 'timestamp'
+
+
+def namespaced(func, namespace):
+    """returns func, tagging its terms with namespace
+
+    For generators shared by fields of differing lifetimes, i.e. the
+    six digit patient and visit ids, so each field is tagged with its
+    own namespace rather than that of the generator.
+
+    """
+    def anonymize(initial):
+        return func(initial)
+    if hasattr(func, 'bulk'):
+        anonymize.bulk = func.bulk
+    anonymize.namespace = namespace
+    return anonymize
+
+patient_id = namespaced(six_digits, 'patient')
+visit_id = namespaced(six_digits, 'visit')
 
 
 def zipcode(initial):
@@ -205,6 +240,56 @@ def zipcode(initial):
     return five_digits(initial)
 
 
+_numeric = re.compile(r'[+-]?(?:\d+\.?\d*|\.\d+)$').match
+_has_digit = re.compile(r'\d').search
+
+
+def magnitude_shape(initial):
+    """returns (length, point) shape of a numeric string, None otherwise
+
+    point is the offset of the decimal point, None for integers.
+    Plain decimal numbers are classified with a single regular
+    expression match; only rare forms holding digits (exponents,
+    surrounding whitespace) fall back to int() and float().  Strings
+    without digits are never numeric.
+
+    """
+    if _numeric(initial):
+        point = initial.find('.')
+        return len(initial), point if point != -1 else None
+    if not _has_digit(initial):
+        return None
+    try:
+        int(initial)
+        return len(initial), None
+    except ValueError:
+        try:
+            float(initial)
+            return len(initial), initial.find('.')
+        except ValueError:
+            return None
+
+
+_magnitude_generators = {}
+
+
+def magnitude_generator(shape):
+    """returns the digits generator for the given magnitude shape
+
+    Generators are built once per shape and reused.
+
+    """
+    generator = _magnitude_generators.get(shape)
+    if generator is None:
+        length, point = shape
+        if point is None:
+            generator = fixed_length_digits(length)
+        else:
+            generator = fixed_length_digits(length, (point, point + 1))
+        _magnitude_generators[shape] = generator
+    return generator
+
+
 def type_and_magnitude(initial):
     """return string matching type and magnitude
 
@@ -215,17 +300,10 @@ def type_and_magnitude(initial):
     """
     if initial is None or len(initial) == 0:
         return initial
-    try:
-        value = int(initial)
-        return anon_term(initial, fixed_length_digits(len(initial)))
-    except ValueError:
-        try:
-            value = float(initial)
-            lenb4 = initial.find('.')
-            return anon_term(initial, fixed_length_digits(len(initial),
-                                                          (lenb4, lenb4+1)))
-        except ValueError:
-            return short_string(initial)
+    shape = magnitude_shape(initial)
+    if shape is None:
+        return short_string(initial)
+    return anon_term(initial, magnitude_generator(shape))
 
 
 anon_map = FieldMap()
@@ -267,19 +345,19 @@ anon_map['EVN-3.1'] = ymdhms
 anon_map['EVN-7.1'] = site_string
 anon_map['EVN-7.2'] = ten_digits
 
-anon_map['PID-3.1'] = six_digits
+anon_map['PID-3.1'] = patient_id
 anon_map['PID-3.4'] = facility_subcomponents
 anon_map['PID-3.6'] = facility_subcomponents
 anon_map['PID-7.1'] = yyyymm
 anon_map['PID-11.5'] = zipcode
-anon_map['PID-18.1'] = six_digits
+anon_map['PID-18.1'] = patient_id
 anon_map['PID-18.4'] = facility_subcomponents
 
-anon_map['PV1-3.2'] = six_digits
+anon_map['PV1-3.2'] = visit_id
 anon_map['PV1-3.4'] = short_string
 anon_map['PV1-3.7'] = short_string
 anon_map['PV1-3.8'] = two_digits
-anon_map['PV1-19.1'] = six_digits
+anon_map['PV1-19.1'] = visit_id
 anon_map['PV1-19.4'] = facility_subcomponents
 anon_map['PV1-19.6'] = facility_subcomponents
 anon_map['PV1-44.1'] = ymdhms
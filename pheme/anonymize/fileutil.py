@@ -0,0 +1,53 @@
+"""File helpers shared by the sidecar writers
+
+Sidecars (the split index, the incremental hash sidecar) record the
+signature of the file they describe, and are ignored once it no
+longer matches.  They're written with :py:func:`replace_file`, so
+concurrent writers never interleave, and readers never see a partial
+sidecar.
+
+"""
+from contextlib import contextmanager
+import hashlib
+import os
+import tempfile
+
+SIGNATURE_BYTES = 1 << 16  # read from both the head and tail
+
+
+def file_signature(path):
+    """returns (size, mtime in microseconds, digest) of the file at path
+
+    The digest is the MD5 of the first and last `SIGNATURE_BYTES`,
+    catching rewrites of the same size within the resolution of the
+    file system's modification times.
+
+    """
+    stat = os.stat(path)
+    digest = hashlib.md5()
+    with open(path, 'rb') as fileobj:
+        digest.update(fileobj.read(SIGNATURE_BYTES))
+        if stat.st_size > SIGNATURE_BYTES:
+            fileobj.seek(max(SIGNATURE_BYTES,
+                             stat.st_size - SIGNATURE_BYTES))
+            digest.update(fileobj.read(SIGNATURE_BYTES))
+    return stat.st_size, int(round(stat.st_mtime * 1e6)), digest.digest()
+
+
+@contextmanager
+def replace_file(path):
+    """context manager yielding a file object to replace path with
+
+    Written to a uniquely named temporary file in the same directory,
+    renamed over path on success and removed on failure.
+
+    """
+    fd, tmpfile = tempfile.mkstemp(prefix=os.path.basename(path) + '.',
+                                   dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as fileobj:
+            yield fileobj
+        os.rename(tmpfile, path)
+    except:
+        os.remove(tmpfile)
+        raise
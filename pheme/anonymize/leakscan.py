@@ -0,0 +1,279 @@
+"""Scan anonymized output for leaked original terms
+
+Every key in the term cache is an original (PHI) term, so none should
+ever appear in anonymized output.  Checking each term in turn is
+quadratic in practice; instead the selected terms are compiled into
+a single Aho-Corasick automaton, through which the output streams in
+one pass, whatever the number of terms.
+
+The `pyahocorasick` package, when installed, provides a C automaton
+handling millions of terms in modest memory.  Otherwise the pure
+python :py:class:`Automaton` is used, with identical results, if
+considerably slower.
+
+Short terms (single initials, '1', 'M') occur everywhere by chance,
+restrict the terms scanned for with a minimum length, or to the
+namespaces of interest (requires the access log kept with the
+'track_access' config value, see :py:mod:`pheme.anonymize.retention`).
+
+"""
+import argparse
+from collections import deque
+import shelve
+import sys
+
+try:
+    import ahocorasick
+except ImportError:  # pyahocorasick unavailable, fall back to pure python
+    ahocorasick = None
+
+from pheme.anonymize import termcache
+from pheme.anonymize.retention import DEFAULT_NAMESPACE, PINNED_PREFIXES
+from pheme.anonymize.termcache import open_store
+from pheme.util.config import Config
+
+CHUNK_SIZE = 1 << 20  # bytes read at a time
+SEGMENT_ENDS = '\r\n'
+DELIMITERS = '|^~\\&' + SEGMENT_ENDS
+
+
+class Automaton(object):
+    """Pure python Aho-Corasick automaton
+
+    Mirrors the subset of the `ahocorasick.Automaton` interface used
+    here: add each word, call `make_automaton`, then `iter` over any
+    text for (end index, value) of every occurrence.
+
+    """
+    def __init__(self):
+        self.goto = [{}]  # per state, transitions by character
+        self.values = [None]
+        self.fail = [0]
+        self.output = [0]  # next state along the fail chain with a value
+
+    def add_word(self, word, value):
+        state = 0
+        for char in word:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append({})
+                self.values.append(None)
+            state = next_state
+        self.values[state] = value
+
+    def __len__(self):
+        return sum(1 for value in self.values if value is not None)
+
+    def make_automaton(self):
+        """calculate fail and output links, breadth first"""
+        goto, values = self.goto, self.values
+        fail = self.fail = [0] * len(goto)
+        output = self.output = [0] * len(goto)
+        queue = deque(goto[0].itervalues())
+        while queue:
+            state = queue.popleft()
+            for char, child in goto[state].iteritems():
+                queue.append(child)
+                link = fail[state]
+                while link and char not in goto[link]:
+                    link = fail[link]
+                link = goto[link].get(char, 0)
+                fail[child] = link if link != child else 0
+                output[child] = fail[child] if values[fail[child]] is not \
+                    None else output[fail[child]]
+
+    def iter(self, text):
+        goto, fail, output, values = \
+            self.goto, self.fail, self.output, self.values
+        state = 0
+        for i, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            match = state if values[state] is not None else output[state]
+            while match:
+                yield i, values[match]
+                match = output[match]
+
+
+def new_automaton():
+    """returns an empty automaton, the C implementation if available"""
+    if ahocorasick is not None:
+        return ahocorasick.Automaton()
+    return Automaton()
+
+
+def select_terms(store, namespaces=None, min_length=1, access_log=None):
+    """Generator yielding the original terms to scan for
+
+    :param store: the cache store, see
+      :py:func:`pheme.anonymize.termcache.open_store`
+    :param namespaces: optional set of namespaces, only terms last
+      accessed in one of them are yielded
+    :param min_length: shortest term yielded
+    :param access_log: path of the access log sidecar, required to
+      filter by namespace
+
+    The 'date_delta-*' keys aren't terms, and never yielded.
+
+    """
+    log = None
+    if namespaces:
+        if not access_log:
+            raise ValueError("namespaces filter requires the access log")
+        log = shelve.open(access_log, 'r')
+    try:
+        for key in store.keys():
+            if len(key) < min_length or key.startswith(PINNED_PREFIXES):
+                continue
+            if log is not None:
+                entry = log.get(key)
+                namespace = entry and entry[1] or DEFAULT_NAMESPACE
+                if namespace not in namespaces:
+                    continue
+            yield key
+    finally:
+        if log is not None:
+            log.close()
+
+
+def build_automaton(terms):
+    """returns automaton matching every one of terms"""
+    automaton = new_automaton()
+    for term in terms:
+        automaton.add_word(term, term)
+    automaton.make_automaton()
+    return automaton
+
+
+def located_segments(fileobj, chunk_size=CHUNK_SIZE):
+    """Generator yielding (offset, segment) of each segment of fileobj
+
+    Segments end with either carriage return or newline, the
+    terminators aren't included.  offset is that of the segment's
+    first byte, from where fileobj was on entry.
+
+    """
+    remainder, offset = '', 0  # offset of the remainder
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        lines = (remainder + chunk).replace('\n', '\r').split('\r')
+        remainder = lines.pop()
+        for line in lines:
+            if line:
+                yield offset, line
+            offset += len(line) + 1
+    if remainder:
+        yield offset, remainder
+
+
+def segments(fileobj, chunk_size=CHUNK_SIZE):
+    """Generator yielding each segment of fileobj, read in chunks
+
+    see :py:func:`located_segments`
+
+    """
+    for offset, segment in located_segments(fileobj, chunk_size):
+        yield segment
+
+
+def bounded(segment, start, end):
+    """True if segment[start:end] spans entire fields or components"""
+    return (start == 0 or segment[start - 1] in DELIMITERS) and\
+        (end == len(segment) or segment[end] in DELIMITERS)
+
+
+def scan(fileobj, automaton, whole_fields=False):
+    """Generator yielding the location of every term found in fileobj
+
+    :param fileobj: the anonymized output, read in a single pass
+    :param automaton: as returned from :py:func:`build_automaton`
+    :param whole_fields: if set, only yield terms spanning entire
+      fields, components or subcomponents
+
+    yields (message, segment, segment ID, field, offset, term)
+    tuples; the message and segment numbers count from 1, the segment
+    number within its message.  offset is the term's byte offset in
+    the file.
+
+    """
+    if not len(automaton):
+        return
+    message, number = 0, 0
+    for offset, segment in located_segments(fileobj):
+        if segment.startswith(('MSH', 'BHS', 'FHS')) or not message:
+            message, number = message + 1, 0
+        number += 1
+        for end, term in automaton.iter(segment):
+            start = end + 1 - len(term)
+            if whole_fields and not bounded(segment, start, end + 1):
+                continue
+            field = segment.count('|', 0, start)
+            if segment.startswith('MSH'):
+                field += 1  # MSH-1 is the field separator itself
+            yield message, number, segment[:3], field, offset + start, term
+
+
+def scan_ep():
+    """entry point to scan anonymized output for leaked cached terms
+
+    parameters are read from the command line.  call with '-h' for
+    options and documentation.  exits with status 1 if any term was
+    found.
+
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs='+',
+                        help="the anonymized files to scan")
+    parser.add_argument("-c", "--cachefile",
+                        help="cache file, by default the configured one")
+    parser.add_argument("-n", "--namespaces",
+                        help="only scan for terms in these comma "
+                        "separated namespaces, i.e. 'visit,identifier'")
+    parser.add_argument("-m", "--min-length", type=int, default=4,
+                        help="only scan for terms at least this long")
+    parser.add_argument("-w", "--whole-fields", action='store_true',
+                        help="only report terms spanning entire fields "
+                        "or components")
+    parser.add_argument("--show-terms", action='store_true',
+                        help="include the leaked terms, which are PHI, "
+                        "in the report.  By default only their length")
+    args = parser.parse_args()
+
+    cachefile = args.cachefile or Config().get('anonymize', 'cachefile')
+    if args.cachefile:
+        store = open_store(cachefile,
+                           termcache.config_value('cacheshards', 1))
+    else:
+        # the module singleton already holds the configured cache open
+        store = termcache.tc.shelf
+    namespaces = set(namespace.strip() for namespace in
+                     args.namespaces.split(',')) if args.namespaces else None
+    try:
+        automaton = build_automaton(select_terms(
+            store, namespaces, args.min_length, cachefile + '.access'))
+    finally:
+        if args.cachefile:
+            store.close()
+    print >> sys.stderr, "Scanning for %d terms (%s)" % (
+        len(automaton), 'pyahocorasick' if ahocorasick else 'pure python')
+
+    found = 0
+    for path in args.files:
+        with open(path, 'rb') as fileobj:
+            for location in scan(fileobj, automaton, args.whole_fields):
+                found += 1
+                term = location[-1]
+                report = "%s: message %d segment %d (%s) field %d " \
+                    "offset %d: %d byte term" % (
+                        (path,) + location[:-1] + (len(term),))
+                if args.show_terms:
+                    report += " %r" % term
+                print report
+    print >> sys.stderr, "%d leaked terms found" % found
+    if found:
+        sys.exit(1)
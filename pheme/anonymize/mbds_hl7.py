@@ -6,17 +6,192 @@ HL7 2.5 message.
 
 """
 import argparse
+from collections import OrderedDict, deque
 import hl7
+from itertools import islice
+import os
+import select
 import sys
+import time
 
-from pheme.anonymize.alter import anon_term
+from pheme.anonymize.alter import anon_term, generate_many, parse_worker
+from pheme.anonymize.alter import seed_streams, streams, tag
+from pheme.anonymize.cardinality import HyperLogLog, hash64
+from pheme.anonymize.columnar import DEFAULT_COLUMNS, ColumnarWriter
+from pheme.anonymize.columnar import parse_columns
+from pheme.anonymize.termcache import lookup_terms, store_new_terms
+import pheme.anonymize.termcache as termcache
 from pheme.anonymize.field_map import anon_map
+from pheme.anonymize.pipeline import report_latency, report_utilization
+from pheme.anonymize.pipeline import ReadAhead, run_pipeline
+from pheme.anonymize import profiling
+from pheme.anonymize.rollover import RollingOutput, parse_size
+from pheme.anonymize.splitindex import chunk_range, load_index
+from pheme.anonymize.splitindex import messages_in_range, parse_range
+
+
+class LazyMessage(object):
+    """HL/7 message split only on segment boundaries
+
+    Tokenizing every segment into fields and components is wasted
+    effort for segments the anonymize map never touches (NK1, AL1,
+    IN1, Z segments, etc.).  This representation only parses those
+    segments whose ID is found in `parse_ids`, and retains the raw
+    text of all others for verbatim output.
+
+    Iteration yields the parsed segments, in the same
+    :py:class:`hl7.Segment` form `hl7.parse` would produce.
+
+    """
+    def __init__(self, msg, parse_ids):
+        # mimic hl7.parse - whitespace is stripped from the message
+        # and the separators are read from the leading header segment
+        msg = msg.strip()
+        self.field_sep, self.component_sep = msg[3:5]
+        self.segments = msg.split('\r')
+        for i, raw in enumerate(self.segments):
+            if raw[:3] in parse_ids:
+                self.segments[i] = self.parse_segment(raw)
+
+    def parse_segment(self, raw):
+        """returns hl7.Segment for the raw segment text"""
+        return hl7.Segment(
+            self.field_sep,
+            [hl7.Field(self.component_sep, field.split(self.component_sep))
+             for field in unicode(raw).split(self.field_sep)])
+
+    def __iter__(self):
+        for segment in self.segments:
+            if isinstance(segment, hl7.Segment):
+                yield segment
+
+    def find(self, segment_id):
+        """returns the first segment with the given ID, None if absent
+
+        Segments not already parsed are parsed on demand, although
+        retained in raw form.
+
+        """
+        for segment in self.segments:
+            if isinstance(segment, hl7.Segment):
+                if str(segment[0][0]) == segment_id:
+                    return segment
+            elif segment[:3] == segment_id:
+                return self.parse_segment(segment)
+        return None
+
+    def __str__(self):
+        return '\r'.join(str(unicode(segment))
+                          if isinstance(segment, hl7.Segment) else segment
+                          for segment in self.segments)
+
+
+class MappedField(object):
+    """Location of a single component within a parsed segment"""
+    __slots__ = ('segment', 'element', 'component')
+
+    def __init__(self, segment, element, component):
+        self.segment = segment
+        self.element = element
+        self.component = component
+
+    def label(self):
+        """returns the HL/7 label for the field, i.e. 'PID-3.4'"""
+        segment = str(self.segment[0][0])
+        element = self.element
+        if segment in ('MSH', 'FHS', 'BHS'):
+            element += 1  # undo the field separator adjustment
+        return '%s-%d.%d' % (segment, element, self.component)
+
+
+# cache operations made anonymizing composite fields (see
+# pheme.anonymize.alter.composite), by field label: [calls, operations]
+composite_operations = OrderedDict()
+
+
+def anon_field(field, term, anon_method):
+    """anon_term, counting the cache operations of composite fields"""
+    if not hasattr(anon_method, 'parts'):
+        return anon_term(term=term, func=anon_method)
+    operations = termcache.tc.operations
+    before = sum(operations.values())
+    value = anon_term(term=term, func=anon_method)
+    stats = composite_operations.setdefault(field.label(), [0, 0])
+    stats[0] += 1
+    stats[1] += sum(operations.values()) - before
+    return value
+
+
+def report_cache_operations(stream=sys.stderr):
+    """write term cache operation counts to stream
+
+    Totals by operation type are followed by the operations made per
+    composite field.
+
+    """
+    operations = termcache.tc.operations
+    stream.write("cache operations: %s\n" % ', '.join(
+        '%s %d' % (op, operations[op]) for op in sorted(operations)))
+    for label, (calls, count) in composite_operations.iteritems():
+        stream.write("%-10s %8d calls  %8d operations  %5.2f per call\n" % (
+            label, calls, count, float(count) / calls))
+
+
+def prefetch_terms(msg):
+    """returns the terms anonymizing msg will look up
+
+    Includes the parts of composite fields, see
+    :py:func:`pheme.anonymize.alter.composite`.
+
+    """
+    terms = []
+    for field, anon_method in MBDS_anon(msg.replace('\n', '\r')).\
+            mapped_fields():
+        term = field.segment[field.element][field.component - 1]
+        if not term:
+            continue
+        terms.append(term)
+        if hasattr(anon_method, 'parts'):
+            parts, combine = anon_method.parts(term)
+            terms.extend(initial for initial, func in parts if initial)
+    return terms
+
+
+def prefetch_messages(messages, depth):
+    """returns :py:class:`ReadAhead` of messages, prefetching their terms
+
+    :param messages: iterable of HL/7 message strings
+    :param depth: number of messages read ahead
+
+    """
+    return ReadAhead(messages, lambda(msg): termcache.tc.prefetch(
+        prefetch_terms(msg)), depth)
+
+
+def report_prefetch(read_ahead, stream=sys.stderr):
+    """write read ahead and term cache stall metrics to stream"""
+    tc = termcache.tc
+    stream.write("prefetch: %d keys read ahead, %d lookups prefetched, "
+                 "%d stalls %.3fs, waited on read ahead %.3fs\n" % (
+                     tc.prefetch_reads, tc.prefetch_hits, tc.stalls,
+                     tc.stall_time, read_ahead.waiting))
 
 
 class MBDS_anon(object):
 
-    def __init__(self, msg):
-        self.msg = hl7.parse(msg)
+    def __init__(self, msg, lazy=True):
+        """prepare message for anonymization
+
+        :param msg: the HL/7 message text
+        :param lazy: if set, only segments referenced in the anon_map
+          are parsed, all others are passed through untouched.  Clear
+          to have `hl7.parse` tokenize the entire message.
+
+        """
+        if lazy:
+            self.msg = LazyMessage(msg, frozenset(anon_map.keys()))
+        else:
+            self.msg = hl7.parse(msg)
 
     def anonymize(self):
         """apply the anonymize map to the instance message
@@ -26,9 +201,25 @@ class MBDS_anon(object):
         """
         # preserve idempotence
         if hasattr(self, '_anonymized'):
-            return str(unicode(self.msg))
+            return self.serialize()
 
         # apply all anon methods applicable to this message
+        for field, anon_method in self.mapped_fields():
+            # adjust hl7 one versus zero index
+            cur_val = field.segment[field.element][field.component - 1]
+            field.segment[field.element][field.component - 1] =\
+                anon_field(field, cur_val, anon_method)
+        self._anonymized = True
+        return self.serialize()
+
+    def mapped_fields(self):
+        """Generator yielding each component the anon_map applies to
+
+        Yields (:py:class:`MappedField`, anon_method) tuples, in
+        message order, for every component of the message with an
+        anon_method defined.
+
+        """
         for hl7segment in self.msg:
             segment = str(hl7segment[0][0])  # MSH, PID, OBX, etc.
             if segment in anon_map:
@@ -37,40 +228,346 @@ class MBDS_anon(object):
                         anon_method = anon_map[segment][element][component]
                         # adjust hl7 one versus zero index
                         try:
-                            cur_val = hl7segment[element][component - 1]
+                            hl7segment[element][component - 1]
                         except IndexError:
                             # said component not in the hl7segment
                             # safe to ignore and continue
                             continue
-                        hl7segment[element][component - 1] =\
-                            anon_term(term=cur_val, func=anon_method)
-        self._anonymized = True
+                        yield (MappedField(hl7segment, element, component),
+                               anon_method)
+
+    def field_value(self, segment_id, element, component):
+        """returns the value of a component, '' if absent
+
+        :param segment_id: i.e. 'PID', the first segment with the ID
+          is used
+        :param element: element index, as adjusted for MSH, FHS and
+          BHS by :py:meth:`FieldMap.assert_triplekey`
+        :param component: component number, from 1
+
+        """
+        if isinstance(self.msg, LazyMessage):
+            segment = self.msg.find(segment_id)
+        else:
+            segment = next((segment for segment in self.msg
+                            if str(segment[0][0]) == segment_id), None)
+        try:
+            return segment[element][component - 1]
+        except (IndexError, TypeError):
+            return ''
+
+    def serialize(self):
+        """returns the (possibly anonymized) message as a string"""
+        if isinstance(self.msg, LazyMessage):
+            return str(self.msg)
         return str(unicode(self.msg))
 
 
-def message_at_a_time(fileobj):
+def anonymize_window(messages, lazy=True, columnar=None):
+    """Anonymize a window of messages with bulk cache resolution
+
+    :param messages: sequence of HL/7 message strings
+    :param lazy: see :py:class:`MBDS_anon`
+    :param columnar: optional
+      :py:class:`pheme.anonymize.columnar.ColumnarWriter`, given a
+      row for each anonymized message
+
+    Rather than a cache round trip per component, every term from the
+    entire window is collected and deduplicated, then resolved with
+    a single bulk lookup.  The misses are generated with each anon
+    method's bulk API (see :py:func:`generate_many`) and stored in a
+    single bulk store before the values are written back.
+
+    As with anon_term, the anon_method of a term's first occurrence
+    is used to generate its value.  Composite anon methods, which
+    commit their own terms along with their parts, are called after
+    the bulk store, so they see the values generated for the rest
+    of the window.
+
+    returns list of the anonymized messages, in order.
+
+    """
+    anons = [MBDS_anon(msg, lazy=lazy) for msg in messages]
+    slots = []  # (field, term) to write back
+    methods = OrderedDict()  # each unique term -> (anon_method, field)
+    for anon in anons:
+        for field, anon_method in anon.mapped_fields():
+            term = field.segment[field.element][field.component - 1]
+            if not term:
+                continue
+            slots.append((field, term))
+            if term not in methods:
+                methods[term] = (anon_method, field)
+
+    values = lookup_terms(methods.keys())
+    misses = OrderedDict()  # anon_method -> terms, in message order
+    terms_by_method = {}
+    for term, (anon_method, field) in methods.iteritems():
+        terms_by_method.setdefault(anon_method, []).append(term)
+        if term not in values:
+            misses.setdefault(anon_method, []).append(term)
+    for anon_method, terms in terms_by_method.iteritems():
+        tag(anon_method, terms)
+
+    generated = {}
+    composites = []
+    for anon_method, terms in misses.iteritems():
+        if hasattr(anon_method, 'bulk'):
+            generated.update(zip(terms, generate_many(anon_method, terms)))
+        else:
+            composites.append((anon_method, terms))
+    values.update(store_new_terms(generated))
+    for anon_method, terms in composites:
+        for term in terms:
+            values[term] = anon_field(methods[term][1], term, anon_method)
+
+    for field, term in slots:
+        field.segment[field.element][field.component - 1] = values[term]
+    results = []
+    for anon in anons:
+        anon._anonymized = True
+        results.append(anon.serialize())
+        if columnar is not None:
+            columnar.add(anon)
+    return results
+
+
+class FeedAnalysis(object):
+    """Profile of the terms a feed would add to the term cache
+
+    Streams messages, extracting every component the anon_map applies
+    to, and estimates (with memory bounded HyperLogLog sketches) the
+    number of distinct terms per field, and how many of those aren't
+    yet cached.  Nothing is written to the cache.
+
+    NB - composite anon methods (i.e. facility_subcomponents) also
+    cache their sub-components, which aren't included in the counts.
+
+    :param precision: HyperLogLog precision, see
+      :py:class:`pheme.anonymize.cardinality.HyperLogLog`
+    :param recent: number of recently checked terms to remember, to
+      spare repeated cache lookups of frequent terms
+
+    """
+    def __init__(self, precision=12, recent=100000):
+        self.precision = precision
+        self.recent = recent
+        self.messages = 0
+        self.fields = OrderedDict()  # label -> [occurrences, all, new]
+        self.new_terms = HyperLogLog(precision)
+        self.term_bytes = 0
+        self.terms_seen = 0
+        self._checked = {}
+
+    def _is_new(self, term):
+        if term not in self._checked:
+            if len(self._checked) >= self.recent:
+                self._checked.clear()
+            self._checked[term] = term not in termcache.tc
+        return self._checked[term]
+
+    def add(self, msg):
+        """add all mapped terms from the message to the profile"""
+        self.messages += 1
+        for field, anon_method in MBDS_anon(msg).mapped_fields():
+            term = field.segment[field.element][field.component - 1]
+            if not term:
+                continue
+            label = field.label()
+            if label not in self.fields:
+                self.fields[label] = [0, HyperLogLog(self.precision),
+                                      HyperLogLog(self.precision)]
+            stats = self.fields[label]
+            stats[0] += 1
+            hashed = hash64(term)
+            stats[1].add_hash(hashed)
+            self.term_bytes += len(term)
+            self.terms_seen += 1
+            if self._is_new(term):
+                stats[2].add_hash(hashed)
+                self.new_terms.add_hash(hashed)
+
+    def report(self, stream=sys.stdout):
+        """write the profile summary to stream"""
+        stream.write("%-10s %12s %12s %12s\n" % (
+            'field', 'occurrences', 'distinct', 'new'))
+        for label, (occurrences, distinct, new) in self.fields.iteritems():
+            stream.write("%-10s %12d %12d %12d\n" % (
+                label, occurrences, distinct.count(), new.count()))
+        new = self.new_terms.count()
+        average = float(self.term_bytes) / max(self.terms_seen, 1)
+        stream.write("%d messages\n" % self.messages)
+        stream.write("projected new cache entries: %d (about %d bytes of "
+                     "terms, averaging %.1f bytes)\n" % (
+                         new, new * average, average))
+
+
+def message_at_a_time(fileobj, chunk_size=1 << 16):
     """Generator to yield a complete HL/7 message at a time till exhausted
 
     :param fileobj: open filelike obj ready to read and yield a line at a time
+    :param chunk_size: bytes read at a time.  The file is read
+      incrementally, so the first messages are yielded (and may be
+      anonymized) while the rest of the file is still being read.
 
     """
     field_sep = '|^~\&|'
     segment_id_len = len('MSH')  # or 'FHS', 'BHS'...
-    input = fileobj.read()
+    buffered = ''
     msg_start = 0
+    search = len(field_sep) + segment_id_len
     # The field_sep is just beyond the message break.  Find and roll back
-    while msg_start < len(input):
-        start_search = msg_start + len(field_sep) + segment_id_len
-        next_sep = input.find(field_sep, start_search)
+    while True:
+        next_sep = buffered.find(field_sep, search)
         if next_sep != -1:
-            msg = input[msg_start:next_sep-segment_id_len]
+            yield buffered[msg_start:next_sep-segment_id_len]
             msg_start = next_sep-segment_id_len
-            yield msg
-        else:
-            # Fell off end looking for next sep, return what's left
-            yield input[msg_start:]
+            search = msg_start + len(field_sep) + segment_id_len
+            continue
+        data = fileobj.read(chunk_size)
+        if not data:
             break
-    raise StopIteration
+        # drop the messages already yielded, resuming the search
+        # where a separator spanning the chunks could begin
+        buffered = buffered[msg_start:]
+        search = max(search - msg_start, len(buffered) - len(field_sep) + 1)
+        msg_start = 0
+        buffered += data
+    if msg_start < len(buffered):
+        # Fell off end looking for next sep, return what's left
+        yield buffered[msg_start:]
+
+
+MLLP_START, MLLP_END = '\x0b', '\x1c\r'  # minimal lower layer protocol
+
+
+MESSAGE_HEADERS = ('MSH', 'BHS', 'FHS')
+
+
+class _ArrivalBuffer(object):
+    """Input buffered till complete, remembering when each read arrived"""
+    def __init__(self):
+        self.data = ''
+        self.reads = []  # (end offset in data, time) of each read held
+
+    def append(self, data):
+        self.data += data
+        self.reads.append((len(self.data), time.time()))
+
+    def take(self, end):
+        """remove data up to end
+
+        returns (the data, time the read holding its last byte arrived)
+
+        """
+        arrived = next(when for offset, when in self.reads if offset >= end)
+        taken, self.data = self.data[:end], self.data[end:]
+        self.reads = [(offset - end, when) for offset, when in self.reads
+                      if offset > end]
+        return taken, arrived
+
+
+def stream_messages(fileobj, mllp=False, idle=None, arrivals=False):
+    """Generator yielding each message from fileobj once complete
+
+    :param fileobj: open file, pipe or socket file to read from.
+      Reads return whatever data is available, rather than blocking
+      till a buffer fills or EOF (as :py:func:`message_at_a_time`).
+    :param mllp: if set, messages are MLLP framed, i.e. between
+      '\x0b' and '\x1c\r'.  Otherwise a message ends when the next
+      begins (with a MSH, BHS or FHS segment) or at EOF.
+    :param idle: unframed input only, off by default; when no more
+      data arrives for 'idle' seconds, and the data so far ends with
+      a segment terminator, the message is taken to be complete.  A
+      writer pausing mid message splits it, so unframed data not
+      starting with a MSH, BHS or FHS segment is never yielded; such
+      fragments are reported to stderr and discarded.
+    :param arrivals: if set, (message, time) tuples are yielded, the
+      time being that the message's last byte was read.
+
+    """
+    field_sep = '|^~\&|'
+    segment_id_len = len('MSH')
+    fd = fileobj.fileno()
+    buffered = _ArrivalBuffer()
+
+    def complete(end):
+        message, arrived = buffered.take(end)
+        if not mllp and not message.lstrip('\r\n').startswith(
+                MESSAGE_HEADERS):
+            # never echo the content, it's yet to be anonymized
+            sys.stderr.write("discarding %d bytes not starting a "
+                             "message\n" % len(message))
+            return None
+        return (message, arrived) if arrivals else message
+
+    while True:
+        if buffered.data and not mllp and idle is not None and \
+                not select.select([fd], [], [], idle)[0]:
+            if buffered.data[-1] in '\r\n':
+                message = complete(len(buffered.data))
+                if message is not None:
+                    yield message
+            continue
+        data = os.read(fd, 65536)
+        if not data:
+            break
+        buffered.append(data)
+        if mllp:
+            while MLLP_END in buffered.data:
+                end = buffered.data.index(MLLP_END)
+                frame, arrived = buffered.take(end + len(MLLP_END))
+                message = frame[frame.find(MLLP_START) + 1:end]
+                yield (message, arrived) if arrivals else message
+        else:
+            while True:
+                next_sep = buffered.data.find(
+                    field_sep, len(field_sep) + segment_id_len)
+                if next_sep == -1:
+                    break
+                message = complete(next_sep - segment_id_len)
+                if message is not None:
+                    yield message
+    if buffered.data.strip():
+        if mllp:
+            raise IOError("input ended within a MLLP frame")
+        message = complete(len(buffered.data))
+        if message is not None:
+            yield message
+
+
+def anonymize_filter(input, output, mllp=False, idle=None, recent=100000,
+                     columnar=None):
+    """Anonymize messages from input as they arrive, for use in a pipe
+
+    :param input: file to read messages from, see
+      :py:func:`stream_messages` for `mllp` and `idle`
+    :param output: file to write anonymized messages to.  Each is
+      flushed as soon as it's written, MLLP framed if `mllp` is set.
+    :param recent: number of the most recent latencies retained
+    :param columnar: optional
+      :py:class:`pheme.anonymize.columnar.ColumnarWriter`, given a
+      row for each anonymized message
+
+    returns the latencies (in seconds) from the arrival of the last
+    byte of each message till its anonymized version was flushed, for
+    the most recent messages.  Time spent waiting for the next message
+    or `idle` to complete one is included.
+
+    """
+    latencies = deque(maxlen=recent)
+    for msg, arrived in stream_messages(input, mllp, idle, arrivals=True):
+        anon = MBDS_anon(msg.replace('\n', '\r'))
+        anonymized = anon.anonymize()
+        if columnar is not None:
+            columnar.add(anon)
+        if mllp:
+            output.write(MLLP_START + anonymized + MLLP_END)
+        else:
+            output.write(anonymized + '\r')
+        output.flush()
+        latencies.append(time.time() - arrived)
+    return latencies
 
 
 def anonymize_file():
@@ -81,18 +578,212 @@ def anonymize_file():
 
     """
     parser = argparse.ArgumentParser()
-    parser.add_argument("file", type=file, help="the file to anonymize")
+    parser.add_argument("file", type=file, nargs='?',
+                        help="the file to anonymize, in filter mode "
+                        "by default stdin")
     parser.add_argument("-o", "--output",
                         help="file for output, by default hits stdout")
+    parser.add_argument("-p", "--pipeline", action='store_true',
+                        help="overlap reading, anonymizing and writing "
+                        "in separate threads")
+    parser.add_argument("-q", "--queue-size", type=int, default=64,
+                        help="max messages queued between pipeline stages")
+    parser.add_argument("--stats", action='store_true',
+                        help="report per stage utilization and cache "
+                        "operations to stderr")
+    parser.add_argument("-w", "--window", type=int, default=1,
+                        help="anonymize windows of 'window' messages, "
+                        "resolving all their terms in bulk")
+    parser.add_argument("--analyze", action='store_true',
+                        help="dry run, report the distinct terms per "
+                        "field and projected new cache entries")
+    slicing = parser.add_mutually_exclusive_group()
+    slicing.add_argument("--range",
+                         help="only anonymize messages 'start:end' (zero "
+                         "based, end exclusive), read directly using the "
+                         "split index")
+    slicing.add_argument("--chunk",
+                         help="only anonymize chunk 'i/N' (i from 1 to N) "
+                         "of the file's messages, read directly using "
+                         "the split index")
+    parser.add_argument("-f", "--filter", action='store_true',
+                        help="read incrementally, writing and flushing "
+                        "each message as soon as it's anonymized")
+    parser.add_argument("--mllp", action='store_true',
+                        help="filter mode, messages are MLLP framed on "
+                        "input and output")
+    parser.add_argument("--idle", type=float,
+                        help="filter mode, seconds without input after "
+                        "which an unframed message ending in a segment "
+                        "terminator is complete.  Off by default, "
+                        "writers pausing mid message split it")
+    parser.add_argument("--max-messages", type=int,
+                        help="roll output over to a new shard file after "
+                        "this many messages, see --output")
+    parser.add_argument("--max-bytes", type=parse_size,
+                        help="roll output over to a new shard file before "
+                        "exceeding this size, i.e. '512M'")
+    parser.add_argument("--batch-boundaries", action='store_true',
+                        help="only roll output over at batch (BHS) "
+                        "boundaries")
+    parser.add_argument("--columnar",
+                        help="also write the --columns of each message to "
+                        "this columnar sidecar, CSV or (with pyarrow) "
+                        "'.parquet'")
+    parser.add_argument("--columns", default=DEFAULT_COLUMNS,
+                        help="comma separated fields for the columnar "
+                        "sidecar, default '%(default)s'")
+    parser.add_argument("--row-group", type=int, default=10000,
+                        help="rows buffered per columnar row group")
+    parser.add_argument("--prefetch", type=int, default=0, metavar='DEPTH',
+                        help="read the cached terms of the next DEPTH "
+                        "messages ahead, on a background thread")
+    parser.add_argument("--seed",
+                        help="seed the value generators, reproducing the "
+                        "new values of an earlier run.  Never reuse a "
+                        "seed for other input, and keep it secret")
+    parser.add_argument("--worker",
+                        help="this is worker 'i/N' (i from 1 to N); new "
+                        "values never collide with those of other workers")
+    profiling.add_arguments(parser, 'messages (or windows)')
     args = parser.parse_args()
-    if args.output:
-        output = open(args.output, 'wb')
+
+    def reject_with(mode, *flags):
+        """error out if any of the (option, value) flags are set"""
+        given = [option for option, value in flags if value]
+        if given:
+            parser.error("%s can't be combined with %s" %
+                         (mode, ', '.join(given)))
+
+    if args.analyze:
+        reject_with('--analyze', ('--filter', args.filter),
+                    ('--window', args.window > 1),
+                    ('--pipeline', args.pipeline),
+                    ('--columnar', args.columnar),
+                    ('--prefetch', args.prefetch),
+                    ('--max-messages', args.max_messages),
+                    ('--max-bytes', args.max_bytes),
+                    ('--batch-boundaries', args.batch_boundaries),
+                    ('--profile', args.profile), ('--stats', args.stats))
+    if args.filter:
+        reject_with('--filter', ('--window', args.window > 1),
+                    ('--pipeline', args.pipeline),
+                    ('--range', args.range), ('--chunk', args.chunk),
+                    ('--prefetch', args.prefetch))
+    elif args.mllp or args.idle is not None:
+        parser.error("--mllp and --idle require --filter")
+    if args.seed is not None or args.worker:
+        worker, workers = parse_worker(args.worker) if args.worker else \
+            (streams.worker, streams.workers)  # as configured
+        seed_streams(args.seed, worker, workers)
+    rolling = args.max_messages or args.max_bytes
+    if rolling and not args.output:
+        parser.error("output is required to roll over into shards")
+
+    def open_output():
+        if rolling:
+            return RollingOutput(args.output, args.max_messages,
+                                 args.max_bytes, args.batch_boundaries)
+        return open(args.output, 'wb') if args.output else sys.stdout
+
+    columnar = None
+    if args.columnar:
+        columnar = ColumnarWriter(args.columnar, parse_columns(args.columns),
+                                  args.row_group)
+    profiler = profiling.from_arguments(args)
+
+    if args.filter:
+        output = open_output()
+        filter_args = (args.file or sys.stdin, output, args.mllp, args.idle)
+        if profiler is not None:
+            # the entire run, time spent waiting on input included
+            latencies = profiler.run(anonymize_filter, *filter_args,
+                                     columnar=columnar)
+            profiler.finish()
+        else:
+            latencies = anonymize_filter(*filter_args, columnar=columnar)
+        if args.output:
+            output.close()
+        if columnar is not None:
+            columnar.close()
+        if args.stats:
+            report_latency(latencies)
+            report_cache_operations()
+        return
+    if args.file is None:
+        parser.error("file is required, unless in filter mode")
+    if args.range or args.chunk:
+        offsets = load_index(args.file.name)
+        if args.range:
+            start, end = parse_range(args.range)
+        else:
+            start, end = chunk_range(args.chunk, len(offsets))
+        messages = messages_in_range(args.file.name, start, end, offsets)
+    else:
+        messages = message_at_a_time(args.file)
+    read_ahead = None
+    if args.prefetch:
+        read_ahead = prefetch_messages(messages, args.prefetch)
+        messages = iter(read_ahead)
+
+    if args.analyze:
+        analysis = FeedAnalysis()
+        for msg in messages:
+            analysis.add(msg.replace('\n', '\r'))
+        if args.output:
+            with open(args.output, 'w') as output:
+                analysis.report(output)
+        else:
+            analysis.report(sys.stdout)
+        return
+    output = open_output()
+
+    if args.window > 1:
+        def windows():
+            while True:
+                window = list(islice(messages, args.window))
+                if not window:
+                    break
+                yield window
+        source = windows()
+
+        def anonymize(window):
+            return [msg + '\r' for msg in anonymize_window(
+                [msg.replace('\n', '\r') for msg in window],
+                columnar=columnar)]
+
+        def write(anonymized):
+            # a message at a time, so rollover limits hold mid window
+            for msg in anonymized:
+                output.write(msg)
+    else:
+        source = messages
+        write = output.write
+
+        def anonymize(msg):
+            anon = MBDS_anon(msg.replace('\n', '\r'))
+            anonymized = anon.anonymize() + '\r'
+            if columnar is not None:
+                columnar.add(anon)
+            return anonymized
+    if profiler is not None:
+        anonymize = profiler.wrap(anonymize, args.profile_every)
+
+    if args.pipeline:
+        stages = run_pipeline(source, anonymize, write, args.queue_size)
+        if args.stats:
+            report_utilization(stages)
     else:
-        output = sys.stdout
-    for nextline in message_at_a_time(args.file):
-        parser = MBDS_anon(nextline.replace('\n', '\r'))
-        output.write(parser.anonymize())
-        output.write('\r')
+        for item in source:
+            write(anonymize(item))
+    if args.stats:
+        report_cache_operations()
+        if read_ahead is not None:
+            report_prefetch(read_ahead)
+    if profiler is not None:
+        profiler.finish()
 
     if args.output:
         output.close()
+    if columnar is not None:
+        columnar.close()
@@ -0,0 +1,233 @@
+"""Staged, threaded processing pipeline
+
+Stages run in their own threads, connected by bounded queues so
+memory use stays capped regardless of input size.  With a single
+thread per stage, output order matches input order.
+
+Errors raised in any stage stop the entire pipeline and are re-raised
+(with the original traceback) in the calling thread.
+
+"""
+from Queue import Queue, Empty, Full
+import sys
+import threading
+import time
+
+
+_END = object()  # sentinel marking the end of the stream
+
+
+class Aborted(Exception):
+    """Raised within a stage when another stage has failed"""
+
+
+class Stage(threading.Thread):
+    """A single pipeline stage, run in its own thread
+
+    :param name: label used in utilization reports
+    :param work: callable for the stage.  The first stage's work is
+      called without arguments and returns the next item, raising
+      StopIteration when exhausted.  Later stages are called with
+      each item; if an outbox is defined the result is passed on.
+    :param inbox: queue to read items from, None for the first stage
+    :param outbox: queue to pass results on to, None for the last stage
+    :param abort: shared threading.Event, set when any stage fails
+
+    Time spent in `work` is tracked as busy time, time blocked on the
+    queues as waiting time.
+
+    """
+    def __init__(self, name, work, inbox, outbox, abort):
+        super(Stage, self).__init__(name=name)
+        self.daemon = True
+        self.work = work
+        self.inbox = inbox
+        self.outbox = outbox
+        self.abort = abort
+        self.items = 0
+        self.busy = 0.0
+        self.waiting = 0.0
+        self.elapsed = 0.0
+        self.exc_info = None
+
+    def _get(self):
+        start = time.time()
+        try:
+            while True:
+                try:
+                    return self.inbox.get(timeout=0.1)
+                except Empty:
+                    if self.abort.is_set():
+                        raise Aborted()
+        finally:
+            self.waiting += time.time() - start
+
+    def _put(self, item):
+        start = time.time()
+        try:
+            while True:
+                try:
+                    return self.outbox.put(item, timeout=0.1)
+                except Full:
+                    if self.abort.is_set():
+                        raise Aborted()
+        finally:
+            self.waiting += time.time() - start
+
+    def _next(self):
+        """returns next item for this stage to pass on, or _END"""
+        start = time.time()
+        try:
+            if self.inbox is None:
+                try:
+                    return self.work()
+                except StopIteration:
+                    return _END
+            item = self._get()
+            if item is _END:
+                return _END
+            start = time.time()
+            return self.work(item)
+        finally:
+            self.busy += time.time() - start
+
+    def run(self):
+        start = time.time()
+        try:
+            while True:
+                result = self._next()
+                if result is _END:
+                    break
+                self.items += 1
+                if self.outbox is not None:
+                    self._put(result)
+            if self.outbox is not None:
+                self._put(_END)
+        except Aborted:
+            pass
+        except:
+            self.exc_info = sys.exc_info()
+            self.abort.set()
+        finally:
+            self.elapsed = time.time() - start
+
+    @property
+    def utilization(self):
+        """fraction of the stage's run time spent busy"""
+        if not self.elapsed:
+            return 0.0
+        return self.busy / self.elapsed
+
+
+def run_pipeline(source, transform, sink, queue_size=64):
+    """Run reader, transform and writer stages concurrently
+
+    :param source: iterable producing the items to process
+    :param transform: callable applied to each item
+    :param sink: callable consuming each transformed item
+    :param queue_size: bound on the number of items queued between
+      any two stages
+
+    Blocks until all items have been processed, returning the list
+    of stages for reporting.  Re-raises the first error from any stage.
+
+    """
+    abort = threading.Event()
+    iterator = iter(source)
+    inbox, outbox = Queue(queue_size), Queue(queue_size)
+    stages = [Stage('read', iterator.next, None, inbox, abort),
+              Stage('anonymize', transform, inbox, outbox, abort),
+              Stage('write', sink, outbox, None, abort)]
+    for stage in stages:
+        stage.start()
+    for stage in stages:
+        while stage.is_alive():
+            stage.join(0.1)
+    for stage in stages:
+        if stage.exc_info:
+            exc_type, exc_value, exc_tb = stage.exc_info
+            raise exc_type, exc_value, exc_tb
+    return stages
+
+
+class ReadAhead(object):
+    """Iterable applying work to the items of source ahead of use
+
+    A background stage reads items from source and calls `work` with
+    each (i.e. to prefetch what the item will need), queuing up to
+    `depth` items ahead of the consumer.  Iterate to consume the
+    items, in order.  Errors raised reading source or in `work` are
+    re-raised in the consuming thread.
+
+    `waiting` is the time the consumer spent blocked on the stage,
+    the stage's own busy and waiting times are available from
+    `stage`.
+
+    """
+    def __init__(self, source, work, depth=8):
+        self.source = source
+        self.work = work
+        self.depth = depth
+        self.waiting = 0.0
+        self.stage = None
+
+    def __iter__(self):
+        abort = threading.Event()
+        iterator = iter(self.source)
+        queue = Queue(self.depth)
+
+        def next_item():
+            item = iterator.next()
+            self.work(item)
+            return item
+
+        self.stage = stage = Stage('read ahead', next_item, None, queue,
+                                   abort)
+        stage.start()
+        try:
+            while True:
+                start = time.time()
+                try:
+                    item = queue.get(timeout=0.1)
+                except Empty:
+                    if stage.exc_info or not stage.is_alive():
+                        break
+                    continue
+                finally:
+                    self.waiting += time.time() - start
+                if item is _END:
+                    break
+                yield item
+        finally:
+            abort.set()  # release the stage if the consumer quits early
+            stage.join()
+        if stage.exc_info:
+            exc_type, exc_value, exc_tb = stage.exc_info
+            raise exc_type, exc_value, exc_tb
+
+
+def report_utilization(stages, stream=sys.stderr):
+    """write per stage utilization summary to stream"""
+    for stage in stages:
+        stream.write("%-10s %8d items  busy %8.3fs  waiting %8.3fs  "
+                     "utilization %5.1f%%\n" % (
+                         stage.name, stage.items, stage.busy,
+                         stage.waiting, 100 * stage.utilization))
+
+
+def percentile(values, pct):
+    """returns the pct percentile from the list of values"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered))))
+    return ordered[index]
+
+
+def report_latency(latencies, stream=sys.stderr):
+    """write summary of per item latencies (in seconds) to stream"""
+    latencies = list(latencies)
+    stream.write("%d items  p50 %.3fms  p99 %.3fms  max %.3fms\n" % (
+        len(latencies), 1000 * percentile(latencies, 50),
+        1000 * percentile(latencies, 99),
+        1000 * max(latencies or [0])))
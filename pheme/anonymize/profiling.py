@@ -0,0 +1,276 @@
+"""Built in profiling of anonymize runs
+
+Diagnosing a slow production run shouldn't require wrapping the
+console scripts in external profilers.  Both `anonymize_file` entry
+points accept `--profile PREFIX`, writing:
+
+  PREFIX.pstats     for `python -m pstats`, snakeviz and the like
+  PREFIX.collapsed  collapsed stacks, one 'frame;frame;... count'
+                    line per stack, for flamegraph.pl or speedscope
+
+and a summary of the hot frames in the `field_map` anon functions
+and the :py:class:`TermCache` methods to stderr.
+
+Two modes are available.  'sampling' (the default) has a background
+thread record the stack of the profiled thread every `interval`
+seconds, costing little enough to leave on in production; the pstats
+file is then built from the samples, with times estimated from the
+sample counts.  'deterministic' runs cProfile, for exact call counts
+and times, at several times the run time.  Collapsed stacks always
+come from sampling.
+
+"""
+import argparse
+from collections import Counter
+import cProfile
+import marshal
+import os
+import pstats
+import sys
+import thread
+import threading
+
+MODES = ('sampling', 'deterministic')
+
+
+def frame_key(code):
+    """returns the pstats (filename, line, function) key of code"""
+    return code.co_filename, code.co_firstlineno, code.co_name
+
+
+def frame_label(key):
+    """returns 'module:function' label of a pstats key"""
+    filename, line, name = key
+    return '%s:%s' % (os.path.splitext(os.path.basename(filename))[0], name)
+
+
+class StackSampler(threading.Thread):
+    """Samples the stacks of the target threads every interval seconds
+
+    `samples` counts each distinct stack, a tuple of pstats keys from
+    the outermost frame in.
+
+    """
+    def __init__(self, interval=0.005):
+        super(StackSampler, self).__init__(name='profile sampler')
+        self.daemon = True
+        self.interval = interval
+        self.targets = set()  # idents of the threads to sample
+        self.samples = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+            for ident in list(self.targets):
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    stack.append(frame_key(frame.f_code))
+                    frame = frame.f_back
+                if stack:
+                    self.samples[tuple(reversed(stack))] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def stats(self):
+        """returns a pstats compatible dict, estimated from the samples
+
+        Call counts are sample counts; times are the sample counts
+        multiplied by the interval.
+
+        """
+        stats = {}
+        for stack, count in self.samples.iteritems():
+            elapsed = count * self.interval
+            seen = set()
+            for depth, key in enumerate(stack):
+                entry = stats.setdefault(key, [0, 0, 0.0, 0.0, {}])
+                innermost = depth == len(stack) - 1
+                if key not in seen:  # count recursion once
+                    seen.add(key)
+                    entry[0] += count
+                    entry[1] += count
+                    entry[3] += elapsed
+                if innermost:
+                    entry[2] += elapsed
+                if depth:
+                    caller = entry[4].setdefault(stack[depth - 1],
+                                                 [0, 0, 0.0, 0.0])
+                    caller[0] += count
+                    caller[1] += count
+                    caller[3] += elapsed
+                    if innermost:
+                        caller[2] += elapsed
+        return dict((key, (cc, nc, tt, ct, dict(
+            (caller, tuple(values))
+            for caller, values in callers.iteritems())))
+            for key, (cc, nc, tt, ct, callers) in stats.iteritems())
+
+    def collapsed(self):
+        """returns the samples as collapsed stack lines"""
+        return ['%s %d' % (';'.join(frame_label(key) for key in stack), count)
+                for stack, count in sorted(self.samples.iteritems())]
+
+
+class Profiler(object):
+    """Profiles sections of a run, see the module documentation
+
+    :param prefix: path prefix of the files written by :py:meth:`finish`
+    :param mode: 'sampling' or 'deterministic'
+    :param interval: seconds between stack samples
+
+    Sections may run in any one thread, but not concurrently.
+
+    """
+    def __init__(self, prefix, mode='sampling', interval=0.005):
+        if mode not in MODES:
+            raise ValueError("profile mode must be one of %s, not '%s'" %
+                             (', '.join(MODES), mode))
+        self.prefix = prefix
+        self.profile = cProfile.Profile() if mode == 'deterministic' \
+            else None
+        self.sampler = StackSampler(interval)
+        self.sampler.start()
+        self.sections = 0
+
+    def enable(self):
+        """start profiling the calling thread"""
+        self.sections += 1
+        self.sampler.targets.add(thread.get_ident())
+        if self.profile is not None:
+            self.profile.enable()
+
+    def disable(self):
+        if self.profile is not None:
+            self.profile.disable()
+        self.sampler.targets.discard(thread.get_ident())
+
+    def run(self, func, *args, **kwargs):
+        """returns func(*args, **kwargs), profiling the call"""
+        self.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.disable()
+
+    def wrap(self, func, every=1):
+        """returns func wrapped to profile one call in `every`"""
+        if every < 1:
+            raise ValueError("every must be at least 1, not %d" % every)
+        calls = [0]
+
+        def profiled(*args, **kwargs):
+            calls[0] += 1
+            if (calls[0] - 1) % every:
+                return func(*args, **kwargs)
+            return self.run(func, *args, **kwargs)
+        return profiled
+
+    def finish(self, stream=sys.stderr):
+        """write the pstats and collapsed stack files, report hot frames
+
+        returns the pstats.Stats of the run, None if the run was too
+        short to take a single sample.
+
+        """
+        self.sampler.stop()
+        pstats_path = self.prefix + '.pstats'
+        if self.profile is not None:
+            self.profile.dump_stats(pstats_path)
+        else:
+            with open(pstats_path, 'wb') as output:
+                marshal.dump(self.sampler.stats(), output)
+        with open(self.prefix + '.collapsed', 'w') as output:
+            for line in self.sampler.collapsed():
+                output.write(line + '\n')
+        stats = None
+        if self.profile is not None or self.sampler.samples:
+            stats = pstats.Stats(pstats_path)
+            report_hot_frames(stats, stream)
+        stream.write("profiled %d sections, %d samples, wrote %s and %s\n" % (
+            self.sections, sum(self.sampler.samples.itervalues()),
+            pstats_path, self.prefix + '.collapsed'))
+        return stats
+
+
+def hot_frames(stats, limit=10):
+    """returns the hottest anon functions and TermCache methods
+
+    :param stats: pstats.Stats of the run
+
+    returns list of (group, label, calls, self seconds, cumulative
+    seconds) tuples: the `limit` functions defined in field_map with
+    the most cumulative time, followed by those of the TermCache
+    methods.
+
+    """
+    from pheme.anonymize.termcache import TermCache
+    # pstats keys don't name the class, tell methods apart by line
+    methods = set((value.func_code.co_firstlineno, value.func_code.co_name)
+                  for value in vars(TermCache).itervalues()
+                  if hasattr(value, 'func_code'))
+    groups = (('field_map', lambda(key): os.path.splitext(
+        os.path.basename(key[0]))[0] == 'field_map'),
+        ('TermCache', lambda(key): os.path.splitext(
+            os.path.basename(key[0]))[0] == 'termcache' and
+            key[1:] in methods))
+    result = []
+    for group, member in groups:
+        entries = sorted(((key, entry) for key, entry in
+                          stats.stats.iteritems() if member(key)),
+                         key=lambda(item): item[1][3], reverse=True)
+        for key, (cc, nc, tt, ct, callers) in entries[:limit]:
+            result.append((group, frame_label(key), nc, tt, ct))
+    return result
+
+
+def report_hot_frames(stats, stream=sys.stderr, limit=10):
+    """write the hot frames of the run to stream"""
+    stream.write("%-10s %-40s %10s %10s %10s\n" % (
+        'group', 'function', 'calls', 'self s', 'total s'))
+    for group, label, calls, own, total in hot_frames(stats, limit):
+        stream.write("%-10s %-40s %10d %10.3f %10.3f\n" % (
+            group, label, calls, own, total))
+
+
+def positive_int(value):
+    """argparse type for counts of at least one"""
+    try:
+        count = int(value)
+    except ValueError:
+        count = 0
+    if count < 1:
+        raise argparse.ArgumentTypeError("must be a whole number of at "
+                                         "least 1, not '%s'" % value)
+    return count
+
+
+def add_arguments(parser, sections=None):
+    """add the profiling options to an argparse parser
+
+    :param sections: description of the profiled sections, if one in
+      N may be profiled, i.e. 'messages'
+
+    """
+    parser.add_argument("--profile", metavar='PREFIX',
+                        help="profile the run, writing PREFIX.pstats and "
+                        "PREFIX.collapsed")
+    parser.add_argument("--profile-mode", choices=MODES, default='sampling',
+                        help="low overhead 'sampling' (the default) or "
+                        "'deterministic' (cProfile)")
+    parser.add_argument("--profile-interval", type=float, default=0.005,
+                        help="seconds between stack samples")
+    if sections:
+        parser.add_argument("--profile-every", type=positive_int, default=1,
+                            metavar='N', help="only profile one in N %s" %
+                            sections)
+
+
+def from_arguments(args):
+    """returns Profiler for the parsed arguments, None if not profiling"""
+    if not args.profile:
+        return None
+    return Profiler(args.profile, args.profile_mode, args.profile_interval)
@@ -0,0 +1,226 @@
+"""Retention policy for cached terms
+
+Left alone, the term cache grows forever, although most visit ids and
+timestamps are never seen again a few weeks after they first appear.
+With the 'track_access' value set in the 'anonymize' config section,
+a :py:class:`TermCache` records the day each term was last accessed,
+along with the namespace of the term (see the `namespace` attributes
+in :py:mod:`pheme.anonymize.field_map`), in an access log sidecar
+written on close.  Lookups only touch an in memory dict.
+
+The offline sweep (`sweep_term_cache`) expires terms not accessed
+within the number of days configured for their namespace, i.e.::
+
+  [anonymize]
+  track_access = 1
+  retention = visit:30, timestamp:30, default:365
+
+Namespaces missing from the policy are never expired, nor are terms
+in pinned namespaces (by default 'facility' and 'date_delta', see the
+'pinned_namespaces' config value), terms pinned individually, or the
+'date_delta-*' keys on which all date shifting depends.
+
+"""
+import argparse
+from collections import Counter
+from contextlib import contextmanager
+import datetime
+import shelve
+import sys
+
+from pheme.anonymize import termcache
+from pheme.anonymize.termcache import _FileLock, config_value, open_store
+from pheme.anonymize.termcache import prune_hot_keys
+from pheme.util.config import Config
+
+DEFAULT_NAMESPACE = 'default'
+PINNED = 'pinned'  # namespace of individually pinned terms
+PINNED_PREFIXES = ('date_delta-',)
+
+
+def today():
+    """returns the day number access is recorded with"""
+    return datetime.date.today().toordinal()
+
+
+def parse_policy(policy):
+    """parse a policy string, i.e. 'visit:30, default:365'
+
+    returns dict mapping each namespace to the max days since last
+    access before its terms expire.
+
+    """
+    result = {}
+    for entry in (policy or '').split(','):
+        if not entry.strip():
+            continue
+        try:
+            namespace, days = entry.split(':')
+            result[namespace.strip()] = int(days)
+        except ValueError:
+            raise ValueError("retention policy entries must match "
+                             "'namespace:days', not '%s'" % entry)
+    return result
+
+
+def pinned_namespaces():
+    """returns the set of namespaces never expired"""
+    configured = config_value('pinned_namespaces', 'facility, date_delta')
+    return set([namespace.strip() for namespace in configured.split(',')
+                if namespace.strip()] + [PINNED])
+
+
+class AccessLog(object):
+    """Last access day and namespace of each cached term
+
+    Persisted as a shelf sidecar to the cache, mapping each term to
+    a (day, namespace) tuple.  Updates hold an exclusive lock, so any
+    number of processes sharing the cache may record their accesses.
+
+    :param path: path of the sidecar, typically cachefile + '.access'
+
+    """
+    def __init__(self, path):
+        self.path = path
+
+    @contextmanager
+    def _locked(self):
+        with open(self.path + '.lock', 'a') as lockfile:
+            with _FileLock(lockfile):
+                yield
+
+    def record(self, touched, day=None):
+        """record access to the terms in touched
+
+        :param touched: dict mapping each term accessed to its
+          namespace, or None if unknown, in which case any namespace
+          previously recorded is retained
+        :param day: day of access, by default today
+
+        """
+        day = day or today()
+        with self._locked():
+            log = shelve.open(self.path, 'c')
+            try:
+                for key, namespace in touched.iteritems():
+                    previous = log.get(key)
+                    if previous is not None:
+                        if namespace is None or previous[1] == PINNED:
+                            namespace = previous[1]
+                        if previous == (day, namespace):
+                            continue
+                    log[key] = (day, namespace)
+            finally:
+                log.close()
+
+    def pin(self, keys):
+        """pin keys, so they are never expired"""
+        self.record(dict((key, PINNED) for key in keys))
+
+    def sweep(self, store, policy, pinned, day=None, dry_run=False,
+              hotfile=None):
+        """expire terms from store as the policy dictates
+
+        :param store: the cache store, see
+          :py:func:`pheme.anonymize.termcache.open_store`
+        :param policy: dict of max days since last access, by
+          namespace, see :py:func:`parse_policy`
+        :param pinned: set of namespaces never expired
+        :param day: the current day, by default today
+        :param dry_run: if set, nothing is deleted or recorded
+        :param hotfile: optional path of the cache's hot key sidecar,
+          expired terms are pruned from it so they're never prewarmed
+
+        Terms in the store yet missing from the log (cached before
+        access was tracked) are recorded as accessed today, starting
+        their clock.  Returns a Counter of the terms expired, and one
+        of the terms kept, by namespace.
+
+        """
+        day = day or today()
+        expired, kept = Counter(), Counter()
+        expired_keys = []
+        keys = store.keys()
+        with self._locked():
+            log = shelve.open(self.path, 'c')
+            try:
+                if not dry_run:
+                    # drop entries for terms no longer cached
+                    for key in set(log.keys()).difference(keys):
+                        del log[key]
+                for key in keys:
+                    entry = log.get(key)
+                    if entry is None:
+                        if not dry_run:
+                            log[key] = (day, None)
+                        kept['untracked'] += 1
+                        continue
+                    accessed, namespace = entry
+                    namespace = namespace or DEFAULT_NAMESPACE
+                    max_age = policy.get(namespace)
+                    if namespace in pinned or max_age is None or \
+                            key.startswith(PINNED_PREFIXES) or \
+                            day - accessed <= max_age:
+                        kept[namespace] += 1
+                        continue
+                    expired[namespace] += 1
+                    if not dry_run:
+                        del store[key]
+                        del log[key]
+                        expired_keys.append(key)
+            finally:
+                log.close()
+        if not dry_run:
+            store.sync()
+            if hotfile and expired_keys:
+                prune_hot_keys(hotfile, expired_keys)
+        return expired, kept
+
+
+def sweep_ep():
+    """entry point to expire terms from the cache
+
+    parameters are read from the command line.  call with '-h' for
+    options and documentation
+
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--cachefile",
+                        help="cache file, by default the configured one")
+    parser.add_argument("-r", "--retention",
+                        help="policy, i.e. 'visit:30, default:365', by "
+                        "default the configured 'retention'")
+    parser.add_argument("-n", "--dry-run", action='store_true',
+                        help="report what would expire, deleting nothing")
+    parser.add_argument("--pin", nargs='+', metavar='TERM',
+                        help="pin the given terms, so they never expire, "
+                        "rather than sweeping")
+    args = parser.parse_args()
+
+    cachefile = args.cachefile or Config().get('anonymize', 'cachefile')
+    log = AccessLog(cachefile + '.access')
+    if args.pin:
+        log.pin(args.pin)
+        print "Pinned %d terms" % len(args.pin)
+        return
+
+    policy = parse_policy(args.retention or config_value('retention'))
+    if not policy:
+        raise ValueError("no retention policy given or configured")
+    if args.cachefile:
+        store = open_store(cachefile, config_value('cacheshards', 1))
+    else:
+        # the module singleton already holds the configured cache open
+        store = termcache.tc.shelf
+    try:
+        expired, kept = log.sweep(store, policy, pinned_namespaces(),
+                                  dry_run=args.dry_run,
+                                  hotfile=cachefile + '.hot')
+    finally:
+        if args.cachefile:
+            store.close()
+    for namespace in sorted(set(expired) | set(kept)):
+        print "%-12s %10d expired %10d kept" % (
+            namespace, expired[namespace], kept[namespace])
+    if args.dry_run:
+        print >> sys.stderr, "Dry run, nothing expired"
@@ -0,0 +1,119 @@
+"""Roll anonymized output over to a series of shard files
+
+Downstream loaders parallelize across files.  A
+:py:class:`RollingOutput` takes the place of the single output file,
+starting a new shard once the current one holds the configured number
+of messages or bytes.  Shards only ever roll over between writes, and
+each write is one or more complete messages, so messages are never
+split.  Optionally shards only roll over at batch boundaries (before
+a BHS or FHS segment).
+
+Given the output path 'anon.hl7', shards are named 'anon-00001.hl7',
+'anon-00002.hl7' and so on.  Each is written with a '.part' suffix,
+renamed once complete, and then listed in the manifest 'anon.hl7.manifest'
+with its message count, size and MD5 checksum, so loaders may start on
+the first shards while later ones are still being written.  The
+manifest ends with a '# complete' line once all shards are written.
+
+"""
+import hashlib
+import os
+
+FRAME_START = '\x0b'  # MLLP framing, see mbds_hl7.MLLP_START
+BATCH_HEADERS = ('BHS', 'FHS')
+SIZE_UNITS = {'k': 1 << 10, 'm': 1 << 20, 'g': 1 << 30}
+
+
+def parse_size(value):
+    """parse byte size, with optional k, M or G suffix, i.e. '512M'"""
+    try:
+        multiplier = SIZE_UNITS.get(value[-1:].lower(), 1)
+        return int(value[:-1] if multiplier > 1 else value) * multiplier
+    except ValueError:
+        raise ValueError("size must be a number of bytes, optionally "
+                         "suffixed k, M or G, not '%s'" % value)
+
+
+def count_messages(data):
+    """returns the number of messages (MSH segments) starting in data"""
+    return data.count('\rMSH|') + data.lstrip(FRAME_START).startswith('MSH|')
+
+
+class RollingOutput(object):
+    """File like object writing to a series of shard files
+
+    :param path: output path the shard names are derived from
+    :param max_messages: roll over once a shard holds this many
+      messages
+    :param max_bytes: roll over before a write would take a shard
+      beyond this many bytes
+    :param batch_boundaries: if set, only roll over before a write
+      starting a new batch (BHS or FHS), once either limit is reached
+
+    """
+    def __init__(self, path, max_messages=None, max_bytes=None,
+                 batch_boundaries=False):
+        if not (max_messages or max_bytes):
+            raise ValueError("either max_messages or max_bytes required")
+        self.root, self.extension = os.path.splitext(path)
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.batch_boundaries = batch_boundaries
+        self.manifest = open(path + '.manifest', 'w')
+        self.shards = []  # (name, messages, bytes, md5) of each completed
+        self.current = None
+        self.previous = ''  # the most recent write
+
+    def shard_name(self, number):
+        """returns the file name of shard `number`, counting from 1"""
+        return '%s-%05d%s' % (self.root, number, self.extension)
+
+    def _due(self, data):
+        """True if the current shard should end before data"""
+        if self.batch_boundaries:
+            if not data.lstrip(FRAME_START).startswith(BATCH_HEADERS) or \
+                    self.previous.lstrip(FRAME_START).startswith('FHS'):
+                return False  # keep each batch whole, behind its FHS
+            return (self.max_messages and
+                    self.messages >= self.max_messages) or \
+                (self.max_bytes and self.bytes >= self.max_bytes)
+        return (self.max_messages and self.messages >= self.max_messages) or \
+            (self.max_bytes and self.bytes + len(data) > self.max_bytes)
+
+    def _open_shard(self):
+        self.name = self.shard_name(len(self.shards) + 1)
+        self.current = open(self.name + '.part', 'wb')
+        self.messages, self.bytes = 0, 0
+        self.checksum = hashlib.md5()
+
+    def _close_shard(self):
+        self.current.close()
+        os.rename(self.name + '.part', self.name)
+        entry = (os.path.basename(self.name), self.messages, self.bytes,
+                 self.checksum.hexdigest())
+        self.shards.append(entry)
+        self.manifest.write('%s\t%d\t%d\t%s\n' % entry)
+        self.manifest.flush()
+        self.current = None
+
+    def write(self, data):
+        if self.current is not None and self.bytes and self._due(data):
+            self._close_shard()
+        if self.current is None:
+            self._open_shard()
+        self.current.write(data)
+        self.checksum.update(data)
+        self.messages += count_messages(data)
+        self.bytes += len(data)
+        self.previous = data
+
+    def flush(self):
+        if self.current is not None:
+            self.current.flush()
+
+    def close(self):
+        """complete the final shard and the manifest"""
+        if self.current is not None:
+            self._close_shard()
+        self.manifest.write('# complete\n')
+        self.manifest.close()
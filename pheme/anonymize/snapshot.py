@@ -0,0 +1,246 @@
+"""Frozen, memory mapped term cache snapshots
+
+Read only consumers (term lookups, re-identification jobs, test runs)
+needn't open the live cache, contending with production writers.  A
+snapshot freezes the cache into an immutable file of records sorted
+by key, which is memory mapped and binary searched in place; readers
+start instantly, and all processes share the same pages.
+
+Configure the 'snapshot' value in the 'anonymize' config section (or
+pass `snapshot` to :py:class:`TermCache`) to open a snapshot as a
+read only base layer, with a small in memory overlay taking any
+writes, see :py:class:`OverlayStore`.
+
+Layout::
+
+  header   magic, record count, offset of the record index
+  records  key length, value length, key, tagged value; sorted by key
+  index    offset of each record, in key order
+
+All ints are little endian.  Values are encoded with the
+:py:class:`pheme.anonymize.codec.BinaryCodec`, so str values (nearly
+all anonymized terms) are stored as is, and returned without
+deserialization.  Snapshots frozen by earlier releases, tagging
+values 's' (str) or 'p' (pickle), remain readable.
+
+"""
+import argparse
+from array import array
+import cPickle as pickle
+import mmap
+import os
+import struct
+
+from pheme.anonymize.codec import BinaryCodec
+from pheme.anonymize.compact import CompactStore
+from pheme.anonymize import termcache
+from pheme.util.config import Config
+
+HEADER = struct.Struct('<8sQQ')  # magic, count, index offset
+RECORD_HEADER = struct.Struct('<II')  # key length, value length
+OFFSET = struct.Struct('<Q')
+MAGIC = 'TCSNAP02'
+LEGACY_MAGIC = 'TCSNAP01'
+STR, PICKLED = 's', 'p'  # value type tags of legacy snapshots
+
+_codec = BinaryCodec()
+encode_value, decode_value = _codec.encode, _codec.decode
+
+
+def decode_legacy_value(data):
+    if data[0] == STR:
+        return data[1:]
+    return pickle.loads(data[1:])
+
+
+def freeze(store, path):
+    """write every term in store to a snapshot file at path
+
+    :param store: the term mapping to freeze, i.e. the `shelf` of a
+      :py:class:`TermCache`
+
+    The snapshot is written to a temporary file, and renamed into
+    place once complete, so readers never see a partial snapshot.
+    returns the number of terms written.
+
+    """
+    keys = sorted(store.keys())
+    offsets = array('L')
+    tmpfile = path + '.tmp'
+    with open(tmpfile, 'wb') as snapshot:
+        snapshot.write(HEADER.pack(MAGIC, 0, 0))
+        position = HEADER.size
+        for key in keys:
+            encoded = encode_value(store[key])
+            offsets.append(position)
+            snapshot.write(RECORD_HEADER.pack(len(key), len(encoded)))
+            snapshot.write(key)
+            snapshot.write(encoded)
+            position += RECORD_HEADER.size + len(key) + len(encoded)
+        for offset in offsets:
+            snapshot.write(OFFSET.pack(offset))
+        snapshot.seek(0)
+        snapshot.write(HEADER.pack(MAGIC, len(keys), position))
+    os.rename(tmpfile, path)
+    return len(keys)
+
+
+class Snapshot(object):
+    """Read only mapping over a memory mapped snapshot file
+
+    :param path: path to a snapshot written by :py:func:`freeze`
+
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as snapshot:
+            self.data = mmap.mmap(snapshot.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        magic, self.count, self.index = HEADER.unpack_from(self.data)
+        if magic not in (MAGIC, LEGACY_MAGIC):
+            self.data.close()
+            raise ValueError("'%s' isn't a term cache snapshot" % path)
+        self.decode = decode_value if magic == MAGIC else \
+            decode_legacy_value
+
+    def _record(self, i):
+        """returns (key, value offset, value length) of record i"""
+        offset, = OFFSET.unpack_from(self.data,
+                                     self.index + OFFSET.size * i)
+        klen, vlen = RECORD_HEADER.unpack_from(self.data, offset)
+        start = offset + RECORD_HEADER.size
+        return self.data[start:start + klen], start + klen, vlen
+
+    def _find(self, key):
+        """returns (value offset, value length) for key, None if absent"""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            found, start, vlen = self._record(middle)
+            if found < key:
+                low = middle + 1
+            elif found > key:
+                high = middle
+            else:
+                return start, vlen
+        return None
+
+    def __contains__(self, key):
+        return self._find(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        found = self._find(key)
+        if found is None:
+            return default
+        start, vlen = found
+        return self.decode(self.data[start:start + vlen])
+
+    def __len__(self):
+        return self.count
+
+    def iterkeys(self):
+        for i in xrange(self.count):
+            yield self._record(i)[0]
+
+    __iter__ = iterkeys
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def sync(self):
+        """no-op, snapshots are immutable"""
+
+    def close(self):
+        self.data.close()
+
+
+class OverlayStore(object):
+    """A writable overlay on a read only base store
+
+    Reads check the overlay, then the base.  Writes and deletes only
+    ever touch the overlay, so the base (i.e. a :py:class:`Snapshot`)
+    is never altered.
+
+    :param base: the read only mapping
+    :param overlay: mapping taking all writes, by default held in
+      memory and discarded on close
+
+    """
+    def __init__(self, base, overlay=None):
+        self.base = base
+        self.overlay = CompactStore() if overlay is None else overlay
+        self.deleted = set()
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self.overlay.get(key)
+        if value is not None:
+            return value
+        if key in self.deleted:
+            return default
+        return self.base.get(key, default)
+
+    def __setitem__(self, key, value):
+        self.deleted.discard(key)
+        self.overlay[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self.overlay:
+            del self.overlay[key]
+        self.deleted.add(key)
+
+    def keys(self):
+        keys = set(self.overlay.keys())
+        keys.update(key for key in self.base.iterkeys()
+                    if key not in self.deleted)
+        return list(keys)
+
+    def sync(self):
+        self.overlay.sync()
+
+    def close(self):
+        self.overlay.close()
+        self.base.close()
+
+
+def freeze_ep():
+    """entry point to freeze the term cache into a snapshot
+
+    parameters are read from the command line.  call with '-h' for
+    options and documentation
+
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output",
+                        help="snapshot file, by default the configured "
+                        "'snapshot', or the cachefile + '.snapshot'")
+    args = parser.parse_args()
+
+    output = args.output or termcache.config_value('snapshot') or \
+        Config().get('anonymize', 'cachefile') + '.snapshot'
+    if isinstance(termcache.tc.shelf, OverlayStore):
+        # the singleton reads a snapshot, freeze the live cache
+        store = termcache.open_store(
+            Config().get('anonymize', 'cachefile'),
+            termcache.config_value('cacheshards', 1),
+            server=termcache.config_value('cacheserver'))
+        count = freeze(store, output)
+        store.close()
+    else:
+        count = freeze(termcache.tc.shelf, output)
+    print "Froze %d terms into %s" % (count, output)
@@ -0,0 +1,186 @@
+"""Split point index of HL/7 batch files
+
+A single huge batch file can only be divided among workers at message
+boundaries, which :py:func:`pheme.anonymize.mbds_hl7.message_at_a_time`
+finds by scanning (and holding) the entire file.  The split index
+records the byte offset of every message start (any MSH, BHS or FHS
+segment) in a sidecar, found with a single pass over a memory mapped
+view of the file.  Any slice of the messages may then be read
+directly, say by workers each given one chunk of the file.
+
+The sidecar, the batch file name plus '.idx', holds a header (magic,
+size, modification time and head and tail digest of the indexed
+file, message count) followed by the offsets as little endian 64 bit
+ints.  A sidecar no longer matching its file is rebuilt when next
+loaded; the digest catches rewrites of the same size within the
+resolution of the file system's modification times.
+
+"""
+import argparse
+from array import array
+import mmap
+import os
+import struct
+
+from pheme.anonymize.fileutil import file_signature, replace_file
+
+FIELD_SEP = '|^~\&|'
+SEGMENT_ID_LEN = len('MSH')  # or 'FHS', 'BHS'...
+HEADER = struct.Struct('<8sQQ16sQ')  # magic, size, mtime, digest, count
+MAGIC = 'HL7SPLT2'
+PACK_COUNT = 65536  # offsets packed per write
+
+
+def scan_offsets(data):
+    """returns array of each message start offset in data
+
+    :param data: str or mmap of the batch file contents
+
+    Message boundaries match those of `message_at_a_time`; the
+    first message starts at offset zero, whatever the segment.
+
+    """
+    offsets = array('L')
+    start, size = 0, len(data)
+    while start < size:
+        offsets.append(start)
+        next_sep = data.find(FIELD_SEP,
+                             start + len(FIELD_SEP) + SEGMENT_ID_LEN)
+        if next_sep == -1:
+            break
+        start = next_sep - SEGMENT_ID_LEN
+    return offsets
+
+
+def _mapped(fileobj):
+    """returns read only mmap of fileobj, None if empty"""
+    if os.fstat(fileobj.fileno()).st_size == 0:
+        return None
+    return mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def build_index(path):
+    """scan the batch file at path, returning its message offsets"""
+    with open(path, 'rb') as fileobj:
+        data = _mapped(fileobj)
+        if data is None:
+            return array('L')
+        try:
+            return scan_offsets(data)
+        finally:
+            data.close()
+
+
+def write_index(path, offsets):
+    """write the offsets of the batch file at path to its sidecar"""
+    size, mtime, digest = file_signature(path)
+    with replace_file(path + '.idx') as sidecar:
+        sidecar.write(HEADER.pack(MAGIC, size, mtime, digest, len(offsets)))
+        for start in xrange(0, len(offsets), PACK_COUNT):
+            chunk = offsets[start:start + PACK_COUNT]
+            sidecar.write(struct.pack('<%dQ' % len(chunk), *chunk))
+
+
+def read_index(path):
+    """returns offsets from the sidecar of path, None if stale or absent"""
+    try:
+        with open(path + '.idx', 'rb') as sidecar:
+            header = sidecar.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return None
+            magic, size, mtime, digest, count = HEADER.unpack(header)
+            if magic != MAGIC or (size, mtime, digest) != file_signature(path):
+                return None
+            data = sidecar.read(8 * count)
+    except (IOError, OSError):
+        return None
+    if len(data) < 8 * count:
+        return None
+    return array('L', struct.unpack('<%dQ' % count, data))
+
+
+def load_index(path):
+    """returns message offsets of the batch file at path
+
+    The sidecar index is used if current, otherwise the file is
+    scanned and the sidecar (re)written, where permitted.
+
+    """
+    offsets = read_index(path)
+    if offsets is None:
+        offsets = build_index(path)
+        try:
+            write_index(path, offsets)
+        except (IOError, OSError):
+            pass  # i.e. read only directory, just use the scan
+    return offsets
+
+
+def parse_range(value):
+    """parse 'start:end' message range, either may be omitted
+
+    returns (start, end) tuple, end None if open ended.
+
+    """
+    try:
+        start, end = value.split(':')
+        return (int(start) if start else 0, int(end) if end else None)
+    except ValueError:
+        raise ValueError("range must match 'start:end', not '%s'" % value)
+
+
+def chunk_range(chunk, count):
+    """returns (start, end) message range of chunk 'i/N' of count
+
+    Chunks are numbered from 1 to N, and differ in size by at most
+    one message.
+
+    """
+    try:
+        i, n = [int(part) for part in chunk.split('/')]
+    except ValueError:
+        raise ValueError("chunk must match 'i/N', not '%s'" % chunk)
+    if not 1 <= i <= n:
+        raise ValueError("chunk %d not in 1 through %d" % (i, n))
+    return (i - 1) * count // n, i * count // n
+
+
+def messages_in_range(path, start=0, end=None, offsets=None):
+    """Generator yielding the messages of path from start to end
+
+    :param path: path to the batch file
+    :param start: index of the first message to yield
+    :param end: index beyond the last message to yield, None for all
+    :param offsets: the file's message offsets, by default those from
+      :py:func:`load_index`
+
+    Messages are read directly from a memory mapped view of the file,
+    and match those `message_at_a_time` would yield.
+
+    """
+    if offsets is None:
+        offsets = load_index(path)
+    count = len(offsets)
+    end = count if end is None else min(end, count)
+    with open(path, 'rb') as fileobj:
+        data = _mapped(fileobj)
+        if data is None:
+            return
+        try:
+            for i in xrange(start, end):
+                stop = offsets[i + 1] if i + 1 < count else len(data)
+                yield data[offsets[i]:stop]
+        finally:
+            data.close()
+
+
+def index_ep():
+    """entry point to build the split index sidecar of batch files"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs='+', help="the batch files to index")
+    args = parser.parse_args()
+
+    for path in args.files:
+        offsets = build_index(path)
+        write_index(path, offsets)
+        print "%s: %d messages" % (path, len(offsets))
@@ -1,11 +1,295 @@
 import argparse
+import atexit
+from collections import Counter, deque
+from ConfigParser import NoOptionError, NoSectionError
+import cPickle as pickle
 import datetime
-import shelve
+import fcntl
+import os
 import sys
+import threading
+import time
+import zlib
 
+from pheme.anonymize.codec import CodecShelf, get_codec
 from pheme.util.config import Config
 
 
+def config_value(option, default=None):
+    """returns 'anonymize' config section value for option
+
+    :param option: name of the option in the 'anonymize' section
+    :param default: returned when the option isn't set.  if the
+      default is an int, the configured value is converted to match.
+
+    """
+    try:
+        value = Config().get('anonymize', option)
+    except (NoOptionError, NoSectionError):
+        return default
+    if value is None:
+        return default
+    if isinstance(default, int) and not isinstance(value, int):
+        value = int(value)
+    return value
+
+
+def shard_path(cachefile, index, shards):
+    """returns the filename for shard `index` of `shards`"""
+    return "%s-%d-of-%d" % (cachefile, index, shards)
+
+
+class Shard(object):
+    """A single shelve file of a :py:class:`ShardedShelf`
+
+    Writes are batched in memory, and flushed to disk once
+    `batch_size` are pending, or on sync.  Reads use a read only
+    handle.  Flushes hold an exclusive lock on the shard's lock file
+    and write through a fresh handle opened within the lock, so
+    writes of other processes to other keys are never lost.  As with
+    a plain shelf, a set overwrites any value already stored.
+
+    Set-if-absent (:py:meth:`msetnx`) isn't batched: it's resolved
+    against the file within the lock, so the first value stored for
+    a key wins, and the value returned is that every process sharing
+    the shard sees.
+
+    Every flush reopens the dbm file for writing while other
+    processes may hold it open for reading.  The dumbdbm and dbhash
+    backends allow this; gdbm does not (its writers require exclusive
+    access), so shards shared between processes mustn't use gdbm.
+
+    """
+    def __init__(self, path, batch_size, codec=None):
+        self.path = path
+        self.batch_size = batch_size
+        self.codec = codec
+        self.pending = {}
+        self.lockfile = open(path + '.lock', 'a')
+        with self.locked():
+            CodecShelf(path, 'c', codec=codec).close()
+            self.shelf = CodecShelf(path, 'r', codec=codec)
+
+    def locked(self):
+        """context manager holding the shard's exclusive lock"""
+        return _FileLock(self.lockfile)
+
+    def _write(self, func):
+        """call func with a writable shelf, within the lock"""
+        with self.locked():
+            self.shelf.close()
+            writer = CodecShelf(self.path, 'c', codec=self.codec)
+            try:
+                return func(writer)
+            finally:
+                writer.close()
+                self.shelf = CodecShelf(self.path, 'r', codec=self.codec)
+
+    def __contains__(self, key):
+        return key in self.pending or key in self.shelf
+
+    def __getitem__(self, key):
+        if key in self.pending:
+            return self.pending[key]
+        return self.shelf[key]
+
+    def __setitem__(self, key, value):
+        self.pending[key] = value
+        if len(self.pending) >= self.batch_size:
+            self.sync()
+
+    def __delitem__(self, key):
+        self.sync()
+
+        def delete(writer):
+            del writer[key]
+        self._write(delete)
+
+    def keys(self):
+        return list(set(self.shelf.keys()).union(self.pending))
+
+    def _flush(self, writer):
+        for key, value in self.pending.iteritems():
+            writer[key] = value
+        self.pending = {}
+
+    def sync(self):
+        """flush pending writes to disk"""
+        if self.pending:
+            self._write(self._flush)
+
+    def msetnx(self, mapping):
+        """set each key of mapping not already on disk, within the lock
+
+        Pending writes are flushed along the way.  Returns a dict of
+        the value now on disk for every key in mapping.
+
+        """
+        held = {}
+
+        def store(writer):
+            self._flush(writer)
+            for key, value in mapping.iteritems():
+                if key in writer:
+                    held[key] = writer[key]
+                else:
+                    writer[key] = held[key] = value
+        self._write(store)
+        return held
+
+    def migrate(self):
+        """re-encode legacy values, see :py:mod:`pheme.anonymize.codec`"""
+        self.sync()
+        return self._write(lambda(writer): writer.migrate())
+
+    def close(self):
+        self.sync()
+        self.shelf.close()
+        self.lockfile.close()
+
+
+class _FileLock(object):
+    """context manager for an exclusive flock on an open file"""
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def __enter__(self):
+        fcntl.flock(self.fileobj, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self.fileobj, fcntl.LOCK_UN)
+
+
+class ShardedShelf(object):
+    """Mapping spread across a number of shelve files
+
+    A stable hash of the key selects which of the `shards` backing
+    files holds any given key, so lookups only touch one (smaller)
+    file, and writers touching different keys rarely contend.  See
+    :py:class:`Shard` for the write batching and locking details.
+
+    """
+    def __init__(self, cachefile, shards, batch_size=100, codec=None):
+        self.shards = [Shard(shard_path(cachefile, i, shards), batch_size,
+                             codec) for i in range(shards)]
+
+    def _shard(self, key):
+        return self.shards[(zlib.crc32(key) & 0xffffffff) %
+                           len(self.shards)]
+
+    def __contains__(self, key):
+        return key in self._shard(key)
+
+    def __getitem__(self, key):
+        return self._shard(key)[key]
+
+    def get(self, key, default=None):
+        shard = self._shard(key)
+        if key in shard:
+            return shard[key]
+        return default
+
+    def __setitem__(self, key, value):
+        self._shard(key)[key] = value
+
+    def __delitem__(self, key):
+        del self._shard(key)[key]
+
+    def msetnx(self, mapping):
+        """set-if-absent, see :py:meth:`Shard.msetnx`"""
+        by_shard = {}
+        for key, value in mapping.iteritems():
+            by_shard.setdefault(self._shard(key), {})[key] = value
+        held = {}
+        for shard, values in by_shard.iteritems():
+            held.update(shard.msetnx(values))
+        return held
+
+    def keys(self):
+        return [key for shard in self.shards for key in shard.keys()]
+
+    def migrate(self):
+        return sum(shard.migrate() for shard in self.shards)
+
+    def sync(self):
+        for shard in self.shards:
+            shard.sync()
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+
+def open_store(cachefile, shards=1, batch_size=100, server=None,
+               resident=False, snapshot=None, codec=None):
+    """open the persistent mapping backing a term cache
+
+    :param cachefile: path to the cache file
+    :param shards: number of shards to spread the keys across.  A
+      single shard uses `cachefile` itself.
+    :param batch_size: for sharded stores, number of writes batched
+      per shard before flushing
+    :param server: optional socket path of a running cache server,
+      see :py:mod:`pheme.anonymize.cacheserver`.  If given, the
+      server is used in place of any local files.
+    :param resident: if set, the entire store is loaded into a
+      compact in memory representation and all reads served from it,
+      see :py:class:`pheme.anonymize.compact.ResidentStore`
+    :param snapshot: optional path of a frozen snapshot.  If given,
+      the snapshot is opened read only, beneath an in memory overlay
+      taking all writes, in place of the cache itself.  See
+      :py:mod:`pheme.anonymize.snapshot`
+    :param codec: name of the value codec for local files, by default
+      the 'codec' config value, see :py:mod:`pheme.anonymize.codec`
+
+    """
+    codec = get_codec(codec or config_value('codec', 'binary'))
+    if snapshot:
+        from pheme.anonymize.snapshot import OverlayStore, Snapshot
+        return OverlayStore(Snapshot(snapshot))
+    if server:
+        from pheme.anonymize.cacheserver import RemoteStore
+        store = RemoteStore(server)
+    elif shards > 1:
+        store = ShardedShelf(cachefile, shards, batch_size, codec)
+    else:
+        # the writeback cache is redundant when resident
+        store = CodecShelf(cachefile, writeback=not resident, codec=codec)
+    if resident:
+        from pheme.anonymize.compact import ResidentStore
+        store = ResidentStore(store)
+    return store
+
+
+def read_hot_keys(hotfile):
+    """returns the (key, count, value) entries of a hot key sidecar"""
+    try:
+        with open(hotfile, 'rb') as sidecar:
+            return pickle.loads(sidecar.read())
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return []
+
+
+def write_hot_keys(hotfile, entries):
+    """replace the hot key sidecar with entries"""
+    tmpfile = hotfile + '.tmp'
+    with open(tmpfile, 'wb') as sidecar:
+        sidecar.write(pickle.dumps(entries, pickle.HIGHEST_PROTOCOL))
+    os.rename(tmpfile, hotfile)
+
+
+def prune_hot_keys(hotfile, keys):
+    """drop keys, i.e. those just expired, from the hot key sidecar"""
+    keys = set(keys)
+    entries = read_hot_keys(hotfile)
+    kept = [entry for entry in entries if entry[0] not in keys]
+    if len(kept) < len(entries):
+        write_hot_keys(hotfile, kept)
+
+
+_NOT_PREFETCHED = object()  # sentinel, distinct from a prefetched None
+
+
 class TermCache(object):
     """Persistent cache of terms and their anonymized values
 
@@ -13,33 +297,408 @@ class TermCache(object):
     any existing term, so set a term's anonymized value, and persist
     the entire store to the filesystem.
 
+    Access frequencies are tracked, and the most frequently accessed
+    terms (facilities, applications, OIDs and the like) are persisted
+    to a 'hot' sidecar file on close.  The next open bulk loads the
+    sidecar in a single sequential read, sparing a cold start the
+    disk lookups for the same small set of terms in every message.
+
+    Large caches may be spread across a number of shard files, see
+    :py:class:`ShardedShelf`, or held by a cache server shared by any
+    number of processes, see :py:mod:`pheme.anonymize.cacheserver`.
+
+    If access tracking is enabled, the keys accessed are recorded in
+    the access log sidecar for the retention policy, see
+    :py:mod:`pheme.anonymize.retention`.
+
+    Keys about to be looked up may be read ahead of time, say from a
+    background thread, with :py:meth:`prefetch`.  All store access
+    then holds `lock`, and lookups missing the in memory layers (the
+    hot and prefetched keys) count as stalls.
+
     """
-    def __init__(self):
-        cachefile = Config().get('anonymize', 'cachefile')
-        self.shelf = shelve.open(cachefile, writeback=True)
+    ACCESS_BATCH = 100000  # max keys held before recording access
+    PREFETCH_LIMIT = 100000  # max prefetched keys held
+
+    def __init__(self, cachefile=None, prewarm_keys=None,
+                 prewarm_bytes=None, shards=None, server=None,
+                 resident=None, track_access=None, snapshot=None):
+        """open the persistent cache
+
+        :param cachefile: path to the cache file, by default the
+          'cachefile' from the 'anonymize' config section
+        :param prewarm_keys: max number of hot keys to prewarm and
+          persist, by default the 'prewarm_keys' config value.  0
+          disables prewarming.
+        :param prewarm_bytes: optional limit on the size of the hot
+          key sidecar, by default the 'prewarm_bytes' config value.
+        :param shards: number of files the cache is sharded across,
+          by default the 'cacheshards' config value, or 1 if unset.
+          Writes to sharded caches are batched per shard, see the
+          'shard_batch' config value.
+        :param server: socket path of the cache server to use in
+          place of local files, by default the 'cacheserver' config
+          value.  Pass '' to force use of local files.
+        :param resident: if set, the entire cache is held in memory in
+          a compact form, by default the 'resident_cache' config value
+        :param track_access: if set, the day each key is accessed is
+          recorded, by default the 'track_access' config value
+        :param snapshot: path of a frozen snapshot to read from, with
+          writes held in memory, rather than the cache itself.  By
+          default the 'snapshot' config value.  Pass '' to force use
+          of the cache.
+
+        """
+        if cachefile is None:
+            cachefile = Config().get('anonymize', 'cachefile')
+        if prewarm_keys is None:
+            prewarm_keys = config_value('prewarm_keys', 1000)
+        if prewarm_bytes is None:
+            prewarm_bytes = config_value('prewarm_bytes', 0)
+        self.prewarm_keys = prewarm_keys
+        self.prewarm_bytes = prewarm_bytes
+        if shards is None:
+            shards = config_value('cacheshards', 1)
+        if server is None:
+            server = config_value('cacheserver')
+        if resident is None:
+            resident = config_value('resident_cache', 0)
+        if track_access is None:
+            track_access = config_value('track_access', 0)
+        if snapshot is None:
+            snapshot = config_value('snapshot')
+        if snapshot:
+            # readers leave the hot keys and access log be
+            self.prewarm_keys = 0
+            track_access = 0
+        self.hotfile = cachefile + '.hot'
+        self.accessfile = cachefile + '.access'
+        # keys accessed since last recorded, and their namespace
+        self.touched = {} if track_access else None
+        self.shelf = open_store(cachefile, shards,
+                                config_value('shard_batch', 100), server,
+                                resident, snapshot)
+        # sharded stores batch their own writes, servers persist all
+        self.sync_writes = shards <= 1 and not server and not snapshot
+        self.operations = Counter()  # cache round trips, by type
+        self.lock = threading.RLock()  # held for all store access
+        self.prefetched = None  # key -> value (None if absent), read ahead
+        self.prefetch_order = deque()
+        self.prefetch_reads = 0
+        self.prefetch_hits = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+        self.hits = {}
+        self.hot = {}
+        self.hot_counts = {}
+        if self.prewarm_keys:
+            self.prewarm()
 
     def _convert_key(self, key):
         if isinstance(key, str):
             return key
         return str(key)
 
+    def prewarm(self):
+        """bulk load the hot key sidecar persisted by a previous close"""
+        for key, count, value in read_hot_keys(self.hotfile):
+            self.hot[key] = value
+            self.hot_counts[key] = count
+
+    def _record_hit(self, key):
+        hits = self.hits
+        hits[key] = hits.get(key, 0) + 1
+        # bound the memory used to track frequencies, retaining
+        # the most popular entries
+        if len(hits) > 100 * max(self.prewarm_keys, 100):
+            self.hits = dict(Counter(hits).most_common(
+                10 * max(self.prewarm_keys, 100)))
+
+    def persist_hot_keys(self):
+        """write the most frequently accessed keys to the sidecar
+
+        Counts from previous runs are halved before merging with
+        those from this run, so the hot set follows the feed over
+        time.  The sidecar is limited to `prewarm_keys` entries
+        and if set, `prewarm_bytes` in size.
+
+        """
+        counts = Counter(dict((k, v // 2) for k, v in
+                              self.hot_counts.iteritems() if v > 1))
+        counts.update(self.hits)
+        entries = []
+        size = 0
+        for key, count in counts.most_common(self.prewarm_keys):
+            value = self.hot[key] if key in self.hot else \
+                self.shelf.get(key)
+            if value is None:
+                continue
+            size += len(key) + len(str(value))
+            if self.prewarm_bytes and size > self.prewarm_bytes:
+                break
+            entries.append((key, count, value))
+        write_hot_keys(self.hotfile, entries)
+
+    def __contains__(self, key):
+        key = self._convert_key(key)
+        if key in self.hot:
+            return True
+        with self.lock:
+            return self.shelf.__contains__(key)
+
+    def _touch(self, key):
+        if key not in self.touched:
+            self.touched[key] = None
+            if len(self.touched) >= self.ACCESS_BATCH:
+                self.persist_access()
+
+    def persist_access(self):
+        """record the keys accessed in the access log sidecar"""
+        from pheme.anonymize.retention import AccessLog
+        AccessLog(self.accessfile).record(self.touched)
+        self.touched.clear()
+
+    def tag(self, keys, namespace):
+        """set the namespace of keys, for the retention policy"""
+        if self.touched is None:
+            return
+        for key in keys:
+            self.touched[self._convert_key(key)] = namespace
+        if len(self.touched) >= self.ACCESS_BATCH:
+            self.persist_access()
+
+    def prefetch(self, keys):
+        """read keys not yet held in memory ahead of their lookup
+
+        Safe to call from a background thread.  Keys found absent are
+        remembered too, till stored.
+
+        """
+        if self.prefetched is None:
+            self.prefetched = {}
+        prefetched, order = self.prefetched, self.prefetch_order
+        for key in keys:
+            key = self._convert_key(key)
+            if key in self.hot or key in prefetched:
+                continue
+            with self.lock:
+                if key in prefetched:
+                    continue
+                prefetched[key] = self.shelf.get(key)
+                order.append(key)
+                self.prefetch_reads += 1
+                while len(order) > self.PREFETCH_LIMIT:
+                    prefetched.pop(order.popleft(), None)
+
+    def _forget(self, key):
+        """drop any prefetched value of key, now stored or deleted"""
+        if self.prefetched is not None:
+            self.prefetched.pop(key, None)
+
+    def _get(self, key):
+        if self.prewarm_keys:
+            self._record_hit(key)
+        if key in self.hot:
+            value = self.hot[key]
+        elif self.prefetched is None:
+            value = self.shelf.get(key)
+        else:
+            value = self.prefetched.get(key, _NOT_PREFETCHED)
+            if value is _NOT_PREFETCHED:
+                start = time.time()
+                with self.lock:
+                    value = self.shelf.get(key)
+                self.stalls += 1
+                self.stall_time += time.time() - start
+            else:
+                self.prefetch_hits += 1
+        if self.touched is not None and value is not None:
+            self._touch(key)
+        return value
+
+    def _sync(self):
+        if self.sync_writes:
+            self.operations['sync'] += 1
+            self.shelf.sync()
+
+    def __getitem__(self, key):
+        self.operations['lookup'] += 1
+        return self._get(self._convert_key(key))
+
+    def __setitem__(self, key, value):
+        self.operations['store'] += 1
+        key = self._convert_key(key)
+        if key in self.hot:
+            self.hot[key] = value
+        with self.lock:
+            self.shelf[key] = value
+            self._forget(key)
+            self._sync()
+        if self.touched is not None:
+            self._touch(key)
+
+    def __delitem__(self, key):
+        self.operations['delete'] += 1
+        key = self._convert_key(key)
+        self.hot.pop(key, None)
+        if self.touched is not None:
+            self.touched.pop(key, None)
+        with self.lock:
+            del self.shelf[key]
+            self._forget(key)
+
+    def get_many(self, keys):
+        """bulk lookup - returns dict of the found keys and values"""
+        self.operations['bulk_lookup'] += 1
+        found = {}
+        if not hasattr(self.shelf, 'mget'):
+            for key in keys:
+                value = self._get(self._convert_key(key))
+                if value is not None:
+                    found[key] = value
+            return found
+
+        # fetch all not held in memory with a single request
+        remote = []
+        for key in keys:
+            converted = self._convert_key(key)
+            if self.prewarm_keys:
+                self._record_hit(converted)
+            if converted in self.hot:
+                found[key] = self.hot[converted]
+            else:
+                remote.append((key, converted))
+        with self.lock:
+            values = self.shelf.mget([converted for key, converted in
+                                      remote])
+        for (key, converted), value in zip(remote, values):
+            if value is not None:
+                found[key] = value
+        if self.touched is not None:
+            for key in found:
+                self._touch(self._convert_key(key))
+        return found
+
+    def set_many(self, mapping):
+        """bulk store of all key, value pairs in mapping
+
+        The shelf is synchronized once, after all are set, rather than
+        once per key.
+
+        """
+        self.operations['bulk_store'] += 1
+        with self.lock:
+            for key, value in mapping.iteritems():
+                key = self._convert_key(key)
+                if key in self.hot:
+                    self.hot[key] = value
+                self.shelf[key] = value
+                self._forget(key)
+                if self.touched is not None:
+                    self._touch(key)
+            self._sync()
+
+    def _setdefault_many(self, mapping):
+        with self.lock:
+            return self._locked_setdefault_many(mapping)
+
+    def _locked_setdefault_many(self, mapping):
+        converted = dict((self._convert_key(key), key) for key in mapping)
+        for ckey in converted:
+            self._forget(ckey)
+        if hasattr(self.shelf, 'msetnx'):
+            held = self.shelf.msetnx(dict(
+                (ckey, mapping[key]) for ckey, key in converted.iteritems()))
+        else:
+            held = {}
+            for ckey, key in converted.iteritems():
+                if ckey in self.shelf:
+                    held[ckey] = self.shelf[ckey]
+                else:
+                    held[ckey] = self.shelf[ckey] = mapping[key]
+            if mapping:
+                self._sync()
+        for ckey in held:
+            if ckey in self.hot:
+                self.hot[ckey] = held[ckey]
+            if self.touched is not None:
+                self._touch(ckey)
+        return dict((key, held[ckey]) for ckey, key in converted.iteritems())
+
+    def setdefault_many(self, mapping):
+        """bulk set-if-absent
+
+        Each key in mapping not already cached is set to its value.
+        Returns a dict of the values now held for every key in
+        mapping; where a key was already cached (perhaps just now by
+        another process sharing a cache server) the existing value is
+        returned rather than that provided.
+
+        """
+        self.operations['bulk_store'] += 1
+        return self._setdefault_many(mapping)
+
+    def setdefault(self, key, value):
+        """set-if-absent, returns the value now held for key"""
+        self.operations['store'] += 1
+        return self._setdefault_many({key: value})[key]
+
+    def keys(self):
+        """returns list of all keys in the cache"""
+        return self.shelf.keys()
+
+    def close(self):
+        """persist and close the underlying store"""
+        if self.shelf is None:
+            return
+        if self.prewarm_keys and self.hits:
+            self.persist_hot_keys()
+        if self.touched:
+            self.persist_access()
+        self.shelf.close()
+        self.shelf = None
+
+
+class _LazyTermCache(object):
+    """The module level :py:class:`TermCache`, opened on first use
+
+    Merely importing this module (say, to read a snapshot) then never
+    opens, nor locks, the configured cache.
+
+    """
+    def __init__(self):
+        self._cache = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        if self._cache is None:
+            with self._lock:
+                if self._cache is None:
+                    self._cache = TermCache()
+        return self._cache
+
+    def __getattr__(self, name):
+        return getattr(self._open(), name)
+
     def __contains__(self, key):
-        return self.shelf.__contains__(self._convert_key(key))
+        return key in self._open()
 
     def __getitem__(self, key):
-        if self._convert_key(key) in self.shelf:
-            return self.shelf[self._convert_key(key)]
-        return None
+        return self._open()[key]
 
     def __setitem__(self, key, value):
-        self.shelf[self._convert_key(key)] = value
-        self.shelf.sync()
+        self._open()[key] = value
 
     def __delitem__(self, key):
-        del self.shelf[self._convert_key(key)]
+        del self._open()[key]
 
+    def close(self):
+        if self._cache is not None:
+            self._cache.close()
 
-tc = TermCache()  # module level singleton
+
+tc = _LazyTermCache()  # module level singleton
+atexit.register(lambda: tc.close())
 
 
 def lookup_term(term):
@@ -52,6 +711,36 @@ def store_term(term, value):
     tc[term] = value
 
 
+def lookup_terms(terms):
+    """bulk lookup - returns dict of the found terms and values"""
+    return tc.get_many(terms)
+
+
+def store_terms(mapping):
+    """set each term in mapping to its value in cache"""
+    tc.set_many(mapping)
+
+
+def store_new_term(term, value):
+    """set term to value unless already cached
+
+    returns the value cached for term, which differs from that given
+    when another has already stored a value for term.
+
+    """
+    return tc.setdefault(term, value)
+
+
+def store_new_terms(mapping):
+    """bulk store_new_term - returns dict of values cached for each"""
+    return tc.setdefault_many(mapping)
+
+
+def tag_terms(terms, namespace):
+    """set the namespace of terms, see :py:mod:`retention`"""
+    tc.tag(terms, namespace)
+
+
 def delete_term(term):
     """delete term from cache"""
     del tc[term]
@@ -61,7 +750,14 @@ def lookup_term_ep():
     """entry point to lookup arbitrary term from persistent cache"""
     parser = argparse.ArgumentParser()
     parser.add_argument("term", help="lookup 'term' in termcache")
+    parser.add_argument("-s", "--snapshot",
+                        help="lookup in the given frozen snapshot, rather "
+                        "than the cache")
     args = parser.parse_args()
+    if args.snapshot:
+        # the singleton is yet to open, so the cache is never touched
+        global tc
+        tc = TermCache(snapshot=args.snapshot)
 
     if args.term.count(',') == 4:
         # make it easy to convert datetime references
@@ -85,6 +781,39 @@ def lookup_term_ep():
         sys.exit(1)
 
 
+def reshard_ep():
+    """entry point to copy the term cache into a new shard layout
+
+    The configured cache (or that named on the command line) is
+    read, in its current layout, and every term copied into the new
+    layout.  Update the 'cacheshards' config value once complete.
+
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("shards", type=int,
+                        help="number of shards for the new layout")
+    parser.add_argument("-c", "--cachefile",
+                        help="cache file, by default the configured one")
+    parser.add_argument("-f", "--from-shards", type=int,
+                        help="number of shards in the current layout, by "
+                        "default the configured 'cacheshards'")
+    args = parser.parse_args()
+
+    cachefile = args.cachefile or Config().get('anonymize', 'cachefile')
+    from_shards = args.from_shards or config_value('cacheshards', 1)
+    if from_shards == args.shards:
+        raise ValueError("cache already has %d shards" % args.shards)
+    source = open_store(cachefile, from_shards)
+    target = open_store(cachefile, args.shards, batch_size=10000)
+    count = 0
+    for key in source.keys():
+        target[key] = source[key]
+        count += 1
+    target.close()
+    source.close()
+    print "Copied %d terms into %d shards" % (count, args.shards)
+
+
 def store_term_ep():
     """entry point to store arbitrary term from persistent cache"""
     parser = argparse.ArgumentParser()
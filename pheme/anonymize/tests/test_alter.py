@@ -4,6 +4,7 @@ from nose.tools import raises
 
 from pheme.anonymize.alter import fixed_length_string, fixed_length_digits
 from pheme.anonymize.alter import random_date_delta, anon_term
+from pheme.anonymize.alter import RandomStreams, parse_worker, seed_streams
 from pheme.anonymize.termcache import delete_term
 
 
@@ -126,3 +127,65 @@ def test_datetime_format():
     result = formated_date_anon(input)
     assert(len(result) == 6)
     assert(int(result) > 197707 and int(result) < 198009)
+
+
+def test_seeded_streams():
+    "same seed and worker, same values"
+    try:
+        seed_streams('run 1')
+        func = fixed_length_digits(10)
+        first = [func('x') for i in range(5)]
+        seed_streams('run 1')
+        assert(first == [func('x') for i in range(5)])
+        seed_streams('run 1', worker=1, workers=2)
+        assert(first != [func('x') for i in range(5)])
+    finally:
+        seed_streams()
+
+
+def test_partitioned_workers():
+    "workers never generate the same value"
+    alphabet = string.digits
+    generated = []
+    for worker in range(3):
+        streams = RandomStreams('run', worker, 3)
+        rand = streams.stream('digits')
+        values = set()
+        for i in range(200):
+            chars = [rand.choice(alphabet) for j in range(4)]
+            values.add(''.join(streams.partition(rand, chars, alphabet)))
+        assert(all(int(value[-1]) % 3 == worker for value in values))
+        generated.append(values)
+    assert(not generated[0] & generated[1])
+    assert(not generated[1] & generated[2])
+
+
+def test_partitioned_generator():
+    try:
+        seed_streams(None, 1, 2)
+        func = fixed_length_digits(7, (2, 4))
+        for i in range(20):
+            value = func('x')
+            assert(int(value.replace('.', '')[-1]) % 2 == 1)
+    finally:
+        seed_streams()
+
+
+def test_short_values_unpartitioned():
+    "values too short to partition are generated as for a single worker"
+    try:
+        for workers in (1, 10, 200):
+            seed_streams(None, workers - 1, workers)
+            for length in (1, 2):
+                func = fixed_length_digits(length)
+                values = set(func('x') for i in range(200))
+                assert(all(len(value) == length for value in values))
+                assert(len(values) > 5)
+                assert(len(fixed_length_string(length)('x')) == length)
+    finally:
+        seed_streams()
+
+
+@raises(ValueError)
+def test_invalid_worker():
+    parse_worker('3/2')
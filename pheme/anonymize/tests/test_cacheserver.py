@@ -0,0 +1,116 @@
+from contextlib import contextmanager
+import os
+import threading
+
+from pheme.anonymize.benchmark import scratch_directory
+from pheme.anonymize.cacheserver import RemoteStore, TermCacheServer
+from pheme.anonymize.cacheserver import TermStore
+from pheme.anonymize.termcache import TermCache
+
+
+class ServerFixture(object):
+    "run a cache server in a background thread"
+    def __init__(self, directory):
+        self.directory = directory
+        self.socket_path = os.path.join(directory, 'socket')
+        self.store = TermStore(os.path.join(directory, 'log'))
+        self.server = TermCacheServer(self.socket_path, self.store)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.store.close()
+
+
+@contextmanager
+def cache_server():
+    "context manager running a cache server in a scratch directory"
+    with scratch_directory() as directory:
+        fixture = ServerFixture(directory)
+        try:
+            yield fixture
+        finally:
+            fixture.stop()
+
+
+def test_set_if_absent():
+    "two clients missing on the same term receive the same value"
+    with cache_server() as fixture:
+        first = RemoteStore(fixture.socket_path)
+        second = RemoteStore(fixture.socket_path)
+        assert(first.get('term') is None)
+        assert(second.get('term') is None)
+        assert(first.setnx('term', 'first') == 'first')
+        assert(second.setnx('term', 'second') == 'first')
+        assert(second.msetnx({'term': 'x', 'other': 'y'}) ==
+               {'term': 'first', 'other': 'y'})
+        first.close()
+        second.close()
+
+
+def test_pipeline():
+    with cache_server() as fixture:
+        client = RemoteStore(fixture.socket_path)
+        requests = [('set', 'key %d' % i, i) for i in range(1000)]
+        requests.append(('mget', ['key 0', 'key 999', 'missing']))
+        results = client.pipeline(requests)
+        assert(results[-1] == [0, 999, None])
+        client.close()
+
+
+def test_pipeline_failure():
+    "a request failing mid window doesn't leave responses unread"
+    with cache_server() as fixture:
+        client = RemoteStore(fixture.socket_path)
+        client['key'] = 'value'
+        try:
+            client.pipeline([('get', 'key'), ('set', 'bad', lambda: None)])
+        except Exception:
+            pass
+        else:
+            assert False, "unpicklable request sent"
+        assert(client.sock is None)
+        assert(client.mget(['key', 'missing']) == ['value', None])
+        client.close()
+
+
+def test_termcache_client():
+    "TermCache uses the server transparently, log persists changes"
+    with scratch_directory() as directory:
+        fixture = ServerFixture(directory)
+        try:
+            tc = TermCache(os.path.join(directory, 'cache'), prewarm_keys=0,
+                           server=fixture.socket_path)
+            tc['term'] = 'value'
+            tc['gone'] = 'soon'
+            del tc['gone']
+            assert(tc['term'] == 'value')
+            assert(tc.setdefault('term', 'other') == 'value')
+            assert(tc.get_many(['term', 'gone']) == {'term': 'value'})
+            tc.close()
+        finally:
+            fixture.stop()
+
+        store = TermStore(os.path.join(directory, 'log'))
+        assert(store.terms == {'term': 'value'})
+        store.close()
+
+
+def test_resident_client():
+    "resident caches over a server resolve new terms on the server"
+    with cache_server() as fixture:
+        cachefile = os.path.join(fixture.directory, 'cache')
+        first = TermCache(cachefile, prewarm_keys=0, resident=1,
+                          server=fixture.socket_path)
+        second = TermCache(cachefile, prewarm_keys=0, resident=1,
+                           server=fixture.socket_path)
+        assert(first.setdefault('term', 'first') == 'first')
+        assert(second.setdefault('term', 'second') == 'first')
+        assert(second['term'] == 'first')
+        first['other'] = 'value'
+        assert(second.get_many(['other', 'missing']) == {'other': 'value'})
+        first.close()
+        second.close()
@@ -0,0 +1,31 @@
+from nose.tools import raises
+
+from pheme.anonymize.cardinality import HyperLogLog
+
+
+def test_small_counts():
+    hll = HyperLogLog()
+    for i in range(100):
+        hll.add('term %d' % (i % 10))
+    assert(hll.count() == 10)
+
+
+def test_estimate():
+    hll = HyperLogLog(precision=12)
+    for i in range(50000):
+        hll.add('term %d' % i)
+    assert(abs(hll.count() - 50000) < 50000 * 0.05)
+
+
+def test_union():
+    first, second = HyperLogLog(), HyperLogLog()
+    for i in range(1000):
+        first.add(str(i))
+        second.add(str(i + 500))
+    first.update(second)
+    assert(abs(first.count() - 1500) < 1500 * 0.05)
+
+
+@raises(ValueError)
+def test_precision():
+    HyperLogLog(precision=2)
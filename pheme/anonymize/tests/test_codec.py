@@ -0,0 +1,75 @@
+import cPickle as pickle
+import datetime
+import os
+import shelve
+
+from nose.tools import raises
+
+from pheme.anonymize.benchmark import scratch_directory
+from pheme.anonymize.codec import BinaryCodec, CodecShelf, get_codec
+
+VALUES = ('Anonymized', '', u'caf\xe9', 42, -2 ** 40, 2 ** 70, 3.14159,
+          datetime.datetime(1969, 7, 20, 20, 17, 40, 123),
+          datetime.date(2013, 12, 1), None, ('tuple', 1))
+
+
+def test_round_trip():
+    codec = BinaryCodec()
+    for value in VALUES:
+        decoded = codec.decode(codec.encode(value))
+        assert(decoded == value)
+        assert(type(decoded) == type(value))
+    assert(codec.decode(bytearray(codec.encode('term'))) == 'term')
+
+
+def test_compact_encoding():
+    codec = BinaryCodec()
+    assert(len(codec.encode('Anonymized')) == len('Anonymized') + 1)
+    delta = 157766400.53710938  # a typical date_delta
+    assert(len(codec.encode(delta)) == 9)
+    assert(len(codec.encode(delta)) < len(pickle.dumps(delta)))
+
+
+def test_legacy_pickles():
+    codec = BinaryCodec()
+    for value in VALUES:
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            data = pickle.dumps(value, protocol)
+            assert(codec.is_legacy(data))
+            assert(codec.decode(data) == value)
+
+
+def test_switch_back_to_pickle():
+    "the pickle codec decodes binary encoded values"
+    binary, pickled = get_codec('binary'), get_codec('pickle')
+    for value in VALUES:
+        assert(pickled.decode(binary.encode(value)) == value)
+        assert(pickled.decode(pickled.encode(value)) == value)
+
+
+@raises(ValueError)
+def test_unknown_codec():
+    get_codec('json')
+
+
+def test_migrate_shelf():
+    "shelve written values are read, and migrated in place"
+    with scratch_directory() as directory:
+        path = os.path.join(directory, 'cache')
+        legacy = shelve.open(path)
+        legacy['term'] = 'Anonymized'
+        legacy['date_delta-1'] = 12345.5
+        legacy.close()
+
+        shelf = CodecShelf(path)
+        assert(shelf['term'] == 'Anonymized')
+        shelf['new'] = 'Value'
+        assert(shelf.dict['new'] == '\x01Value')
+        assert(shelf.migrate() == 2)
+        assert(shelf.migrate() == 0)
+        shelf.close()
+
+        shelf = CodecShelf(path, 'r')
+        assert(dict(shelf) == {'term': 'Anonymized', 'new': 'Value',
+                               'date_delta-1': 12345.5})
+        shelf.close()
@@ -0,0 +1,44 @@
+import csv
+import os
+
+from pheme.anonymize.benchmark import scratch_directory
+from pheme.anonymize.columnar import ColumnarWriter, parse_columns
+from pheme.anonymize.mbds_hl7 import MBDS_anon
+
+MESSAGE = "MSH|^~\&|app|facility|||20130102030405||ADT^A08|%d|P|2.5\r"\
+    "PID|1||patient%d||||197001|F\r"\
+    "ZXX|1|local^extension"
+
+
+def test_parse_columns():
+    assert(parse_columns('PID-3.1, MSH-9.2') ==
+           [('PID-3.1', ('PID', 3, 1)), ('MSH-9.2', ('MSH', 8, 2))])
+
+
+def test_field_value():
+    anon = MBDS_anon(MESSAGE % (1, 1))
+    anonymized = anon.anonymize().split('\r')
+    assert(anon.field_value('PID', 3, 1) == anonymized[1].split('|')[3])
+    assert(anon.field_value('MSH', 8, 2) == 'A08')
+    # segments the anon_map doesn't touch are parsed on demand
+    assert(anon.field_value('ZXX', 2, 2) == 'extension')
+    assert(anon.field_value('ZXX', 9, 1) == '')
+    assert(anon.field_value('OBX', 5, 1) == '')
+
+
+def test_row_groups():
+    with scratch_directory() as directory:
+        path = os.path.join(directory, 'fields.csv')
+        writer = ColumnarWriter(path, parse_columns('MSH-10.1,PID-8.1'),
+                                row_group=2)
+        for i in range(5):
+            anon = MBDS_anon(MESSAGE % (i, i))
+            anon.anonymize()
+            writer.add(anon)
+            assert(len(writer.rows) < 2)
+        writer.close()
+        assert(writer.count == 5)
+        rows = list(csv.reader(open(path)))
+        assert(rows[0] == ['MSH-10.1', 'PID-8.1'])
+        assert(len(rows) == 6)
+        assert(all(row[1] == 'F' for row in rows[1:]))
@@ -0,0 +1,60 @@
+import datetime
+import os
+
+from pheme.anonymize.benchmark import scratch_directory
+from pheme.anonymize.compact import CompactStore
+from pheme.anonymize.termcache import TermCache
+
+
+def test_mapping():
+    store = CompactStore(capacity=8)
+    now = datetime.datetime.now()
+    for i in range(1000):
+        store['key %d' % i] = 'value %d' % i
+    store['date'] = now
+    store['delta'] = 123.5
+    assert(len(store) == 1002)
+    assert(store['key 999'] == 'value 999')
+    assert(store['date'] == now)
+    assert(store.get('missing') is None)
+    assert('key 0' in store and 'missing' not in store)
+
+
+def test_overwrite_and_delete():
+    store = CompactStore()
+    store['key'] = 'one'
+    store['key'] = 'two'
+    assert(store['key'] == 'two' and len(store) == 1)
+    del store['key']
+    assert('key' not in store and len(store) == 0)
+    store['key'] = 'three'
+    store['other'] = 'four'
+    store.compact()
+    assert(store.garbage == 0)
+    assert(sorted(store.keys()) == ['key', 'other'])
+    assert(store['key'] == 'three')
+
+
+def test_bytes_per_entry():
+    "compact store should beat a dict of str by a healthy margin"
+    store = CompactStore()
+    for i in range(10000):
+        store['%016d' % i] = 'anonymized%06d' % i
+    assert(store.bytes_per_entry() < 100)
+
+
+def test_resident_termcache():
+    with scratch_directory() as directory:
+        cachefile = os.path.join(directory, 'cache')
+        tc = TermCache(cachefile, prewarm_keys=0, resident=False)
+        tc['term'] = 'value'
+        tc.close()
+
+        tc = TermCache(cachefile, prewarm_keys=0, resident=True)
+        assert(tc['term'] == 'value')
+        tc['new'] = 'entry'
+        tc.close()
+
+        tc = TermCache(cachefile, prewarm_keys=0, resident=False)
+        assert(tc['new'] == 'entry')
+        tc.close()
@@ -0,0 +1,174 @@
+import hashlib
+import os
+from StringIO import StringIO
+import tempfile
+
+from nose.tools import raises
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+import yaml
+
+from pheme.anonymize.benchmark import scratch_directory
+from pheme.anonymize.db_static_data import DB_COLUMNS, anonymize_table
+from pheme.anonymize.db_static_data import yaml_items, load_objects
+from pheme.anonymize.db_static_data import Dumper, Loader
+from pheme.anonymize.db_static_data import anonymize_incremental
+from pheme.anonymize.db_static_data import anonymize_objects, has_aliases
+from pheme.anonymize.termcache import lookup_term
+
+
+def test_sequence_items():
+    "each top level sequence item yields independently"
+    data = [{'name': 'one', 'values': [1, 2]},
+            {'name': 'two', 'nested': {'values': ['a', 'b']}},
+            'three']
+    text = yaml.dump(data, default_flow_style=False)
+    items = list(yaml_items(StringIO(text)))
+    assert(len(items) == 3)
+    assert(''.join(items) == text)
+    assert(list(load_objects(StringIO(text))) == data)
+
+
+def test_documents():
+    "mapping documents with unindented sequences aren't split"
+    text = "--- \nname: one\nvalues:\n- 1\n- 2\n---\nname: two\n"
+    items = list(yaml_items(StringIO(text)))
+    assert(len(items) == 2)
+    assert(list(load_objects(StringIO(text))) ==
+           [{'name': 'one', 'values': [1, 2]}, {'name': 'two'}])
+
+
+def test_anonymize_table():
+    "anonymize rows in place, consistent with the term cache"
+    Base = declarative_base()
+
+    class Facility(Base):
+        __tablename__ = 'facility'
+        pk = Column(Integer, primary_key=True)
+        county = Column(String)
+        npi = Column(Integer)
+        zip = Column(String)
+        organization_name = Column(String)
+        local_code = Column(String)
+
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    originals = [Facility(pk=i, county='county %d' % (i % 3), npi=1000 + i,
+                          zip='98101', organization_name='General %d' % i,
+                          local_code='L%d' % i) for i in range(25)]
+    session.add_all(originals)
+    session.commit()
+
+    columns = dict(DB_COLUMNS)['Facility']
+    count = anonymize_table(session, Facility, columns, batch_size=10)
+    session.commit()
+    assert(count == 25)
+
+    for i, row in enumerate(session.query(Facility).order_by(Facility.pk)):
+        assert(row.county == lookup_term('county %d' % (i % 3)))
+        assert(row.npi == int(lookup_term(1000 + i)))
+        assert(row.organization_name == lookup_term('General %d' % i))
+        assert(row.local_code == lookup_term('L%d' % i))
+        assert(len(row.zip) == 5)
+
+
+class Region(yaml.YAMLObject):
+    "minimal DAO stand in, counting anonymize calls"
+    yaml_tag = u'!Region'
+    yaml_loader, yaml_dumper = Loader, Dumper
+    anonymized = 0
+
+    def __init__(self, name):
+        self.name = name
+
+    def anonymize(self):
+        Region.anonymized += 1
+        self.name = self.name.upper()
+
+
+def anonymized(objects, stream):
+    "returns the anonymized dump of objects, streamed or loaded at once"
+    output = StringIO()
+    anonymize_objects(StringIO(yaml.dump(objects, Dumper=Dumper,
+                                         default_flow_style=False)),
+                      output, stream=stream)
+    return output.getvalue()
+
+
+def test_streamed_equivalence():
+    "streaming writes the same output as loading the entire file"
+    objects = [Region('region %d' % i) for i in range(3)]
+    assert(anonymized(objects, True) == anonymized(objects, False))
+
+
+def test_streamed_aliases():
+    "items sharing anchors are anonymized as when loading the file"
+    shared = {'county': 'King'}
+    objects = [Region('one'), Region('two')]
+    for obj in objects:
+        obj.shared = shared
+    text = yaml.dump(objects, Dumper=Dumper, default_flow_style=False)
+    assert(has_aliases(StringIO(text)))
+    assert(not has_aliases(StringIO(yaml.dump(
+        [Region('one')], Dumper=Dumper, default_flow_style=False))))
+    streamed = anonymized(objects, True)
+    assert(streamed == anonymized(objects, False))
+    loaded = yaml.load(streamed, Loader=Loader)
+    assert(loaded[0].shared is loaded[1].shared)
+
+
+@raises(ValueError)
+def test_incremental_aliases():
+    shared = {'county': 'King'}
+    objects = [Region('one'), Region('two')]
+    for obj in objects:
+        obj.shared = shared
+    anonymize_incremental(StringIO(yaml.dump(
+        objects, Dumper=Dumper, default_flow_style=False)),
+        os.path.join(tempfile.gettempdir(), 'unused.yaml'), 'secret')
+
+
+def test_incremental():
+    "only changed objects are anonymized, the rest reused verbatim"
+    with scratch_directory() as directory:
+        path = os.path.join(directory, 'anon.yaml')
+        source = [Region('region %d' % i) for i in range(5)]
+
+        def run():
+            text = yaml.dump(source, Dumper=Dumper, default_flow_style=False)
+            Region.anonymized = 0
+            return anonymize_incremental(StringIO(text), path, 'secret')
+
+        assert(run() == (5, 0))
+        assert(Region.anonymized == 5)
+        first = open(path).read()
+        assert([obj.name for obj in yaml.load(first, Loader=Loader)] ==
+               ['REGION %d' % i for i in range(5)])
+
+        assert(run() == (5, 5))
+        assert(Region.anonymized == 0)
+        assert(open(path).read() == first)
+
+        source[2].name = 'changed'
+        source.append(Region('added'))
+        assert(run() == (6, 4))
+        assert(Region.anonymized == 2)
+        assert([obj.name for obj in yaml.load(open(path).read(),
+                                              Loader=Loader)] ==
+               ['REGION 0', 'REGION 1', 'CHANGED', 'REGION 3', 'REGION 4',
+                'ADDED'])
+
+
+def test_incremental_keyed():
+    "source hashes are keyed, reuse requires the same key"
+    with scratch_directory() as directory:
+        path = os.path.join(directory, 'anon.yaml')
+        text = yaml.dump([Region('keyed')], Dumper=Dumper,
+                         default_flow_style=False)
+        assert(anonymize_incremental(StringIO(text), path, 'one') == (1, 0))
+        assert(hashlib.md5(text).digest() not in
+               open(path + '.hashes', 'rb').read())
+        assert(anonymize_incremental(StringIO(text), path, 'one') == (1, 1))
+        assert(anonymize_incremental(StringIO(text), path, 'two') == (1, 0))
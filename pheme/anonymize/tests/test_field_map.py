@@ -1,11 +1,19 @@
 from nose.tools import raises
 
+from pheme.anonymize.alter import anon_term, anon_terms
+from pheme.anonymize.benchmark import scratch_cache
 from pheme.anonymize.field_map import (
     FieldMap,
+    anon_map,
+    facility_subcomponents,
+    magnitude_generator,
+    magnitude_shape,
     msg_control_id,
+    site_string,
     type_and_magnitude,
     ten_digits_starting_w_1
     )
+from pheme.anonymize.termcache import lookup_term
 
 
 def test_valid_set():
@@ -28,6 +36,20 @@ def test_type_and_magnitude_float():
     assert(result > 9 and result < 100)
     assert(type_and_magnitude(a_float).count('.') == 1)
 
+def test_magnitude_shape():
+    assert(magnitude_shape('80') == (2, None))
+    assert(magnitude_shape('-80') == (3, None))
+    assert(magnitude_shape('98.6') == (4, 2))
+    assert(magnitude_shape('.5') == (2, 0))
+    assert(magnitude_shape(' 80') == (3, None))
+    assert(magnitude_shape('1e5') == (3, -1))
+    assert(magnitude_shape('80 mg') is None)
+    assert(magnitude_shape('FEVER') is None)
+
+def test_magnitude_generator_reused():
+    assert(magnitude_generator((4, 2)) is magnitude_generator((4, 2)))
+    assert(magnitude_generator((4, 2)) is not magnitude_generator((4, 1)))
+
 @raises(ValueError)
 def test_invalid_key():
     fm = FieldMap()
@@ -61,3 +83,55 @@ def test_npi():
     result = ten_digits_starting_w_1(input)
     assert(len(input) == len(result))
     assert(input.startswith('1'))
+
+
+def test_msgcontrolid_parts_cached():
+    source_id, timestamp = "5550001234", "30301211090814"
+    fixed = msg_control_id(source_id + timestamp + "0001")
+    assert(lookup_term(source_id) == fixed[:10])
+    assert(lookup_term(timestamp) == fixed[10:24])
+
+
+def test_composite_round_trips():
+    "composite and its parts resolved in one lookup and one store"
+    with scratch_cache(prewarm_keys=0) as tc:
+        initial = "5550004321" + "30301212090814" + "0002"
+        fixed = anon_term(initial, msg_control_id)
+        assert(tc.operations['bulk_lookup'] == 1)
+        assert(tc.operations['bulk_store'] == 1)
+        assert(tc.operations['lookup'] == 0)
+        assert(lookup_term(initial) == fixed)
+        assert(lookup_term("5550004321") == fixed[:10])
+        assert(anon_term(initial, msg_control_id) == fixed)
+        assert(tc.operations['bulk_store'] == 1)
+
+
+def test_facility_subcomponents():
+    site = anon_term('Composite Facility', site_string)
+    fixed = facility_subcomponents('Composite Facility&1.2.3.4&ISO')
+    name, oid, kind = fixed.split('&')
+    assert(name == site)
+    assert(lookup_term('1.2.3.4') == oid)
+    assert(kind == 'ISO')
+
+
+def test_bulk_composites():
+    "composites and all their parts resolved in one lookup and one store"
+    with scratch_cache(prewarm_keys=0) as tc:
+        npis = ['1234567890', '1234567891', '1234567892']
+        fixed = anon_terms(npis + npis[:1], ten_digits_starting_w_1)
+        assert(sorted(fixed) == npis)
+        assert(tc.operations['bulk_lookup'] == 1)
+        assert(tc.operations['bulk_store'] == 1)
+        for npi in npis:
+            assert(fixed[npi][0] == '1' and len(fixed[npi]) == 10)
+            assert(anon_term(npi, ten_digits_starting_w_1) == fixed[npi])
+        assert(anon_terms(npis, ten_digits_starting_w_1) == fixed)
+
+
+def test_id_namespaces():
+    "patient and visit ids share a generator, not a namespace"
+    assert(anon_map['PID-3.1'].namespace == 'patient')
+    assert(anon_map['PID-18.1'].namespace == 'patient')
+    assert(anon_map['PV1-19.1'].namespace == 'visit')
+    assert(len(anon_map['PV1-19.1']('12345')) == 6)
@@ -0,0 +1,70 @@
+import os
+from StringIO import StringIO
+
+from pheme.anonymize.benchmark import scratch_directory
+from pheme.anonymize.leakscan import Automaton, build_automaton, scan
+from pheme.anonymize.leakscan import located_segments, segments
+from pheme.anonymize.leakscan import select_terms
+from pheme.anonymize.retention import AccessLog
+from pheme.anonymize.termcache import TermCache
+
+OUTPUT = ("MSH|^~\&|app|Cmtpzwq|||2013||ADT^A08|1|P|2.5\r"
+          "PID|1||12345678^^^&Cmtpzwq||\"\"\r"
+          "MSH|^~\&|app|Cmtpzwq|||2013||ADT^A08|2|P|2.5\r"
+          "EVN|A08|2013\r"
+          "PV1|1|E|^^^General Hospital^^^main^2|visit123\r")
+
+
+def test_pure_python_automaton():
+    automaton = Automaton()
+    for word in ('he', 'she', 'his', 'hers'):
+        automaton.add_word(word, word)
+    automaton.make_automaton()
+    assert(len(automaton) == 4)
+    assert(sorted(automaton.iter('ushers')) ==
+           [(3, 'he'), (3, 'she'), (5, 'hers')])
+    assert(list(automaton.iter('nothing')) == [])
+
+
+def test_segments():
+    assert(list(segments(StringIO(OUTPUT), chunk_size=7)) ==
+           OUTPUT.rstrip('\r').split('\r'))
+
+
+def test_located_segments():
+    for offset, segment in located_segments(StringIO(OUTPUT), chunk_size=7):
+        assert(OUTPUT[offset:offset + len(segment)] == segment)
+
+
+def test_scan_locations():
+    automaton = build_automaton(['General Hospital', 'visit123', 'eral'])
+    found = list(scan(StringIO(OUTPUT), automaton))
+    assert((2, 3, 'PV1', 3, 145, 'General Hospital') in found)
+    assert((2, 3, 'PV1', 4, 171, 'visit123') in found)
+    assert((2, 3, 'PV1', 3, 148, 'eral') in found)
+    assert(len(found) == 3)
+
+    bounded = list(scan(StringIO(OUTPUT), automaton, whole_fields=True))
+    assert(len(bounded) == 2)
+
+
+def test_msh_field_numbers():
+    found = list(scan(StringIO(OUTPUT), build_automaton(['Cmtpzwq'])))
+    assert((1, 1, 'MSH', 4, 13, 'Cmtpzwq') in found)
+    assert((1, 2, 'PID', 3, 64, 'Cmtpzwq') in found)
+
+
+def test_select_terms():
+    with scratch_directory() as directory:
+        cachefile = os.path.join(directory, 'cache')
+        tc = TermCache(cachefile, prewarm_keys=0, track_access=0)
+        for key in ('visit123', 'General Hospital', 'M', 'date_delta-1'):
+            tc[key] = 'anon'
+        AccessLog(cachefile + '.access').record(
+            {'visit123': 'visit', 'General Hospital': 'facility'})
+        assert(sorted(select_terms(tc.shelf, min_length=2)) ==
+               ['General Hospital', 'visit123'])
+        assert(list(select_terms(tc.shelf, set(['visit']),
+                                 access_log=cachefile + '.access')) ==
+               ['visit123'])
+        tc.close()
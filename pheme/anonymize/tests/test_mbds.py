@@ -1,7 +1,13 @@
+from StringIO import StringIO
 from tempfile import NamedTemporaryFile
 import os
+import time
 
-from pheme.anonymize.mbds_hl7 import MBDS_anon, message_at_a_time
+from pheme.anonymize.mbds_hl7 import MBDS_anon, anonymize_window
+from pheme.anonymize.mbds_hl7 import FeedAnalysis, message_at_a_time
+from pheme.anonymize.mbds_hl7 import composite_operations, prefetch_terms
+from pheme.anonymize.mbds_hl7 import anonymize_filter, stream_messages
+from pheme.anonymize.termcache import lookup_term
 
 
 # NB - the hl7 library requires batch encoding characters at[3:5] -
@@ -330,3 +336,162 @@ def test_filemessage_generator():
         assert(input[-1:] == output[-1:])
     finally:
         os.remove(testcontents.name)
+
+
+def test_chunked_message_generator():
+    "messages are the same whatever the read size, and read incrementally"
+    input = '\r'.join(['FHS|^~\&|fhs|components',
+                       'MSH|^~\&|msh|components', 'PID|four|five|six',
+                       'MSH|^~\&|seven|eight'])
+    expected = list(message_at_a_time(StringIO(input), len(input)))
+    assert(len(expected) == 3)
+    for chunk_size in (1, 2, 5, 7, 11, 64):
+        assert(list(message_at_a_time(StringIO(input), chunk_size)) ==
+               expected)
+    source = StringIO(input)
+    messages = message_at_a_time(source, 8)
+    assert(next(messages) == expected[0])
+    assert(source.tell() < len(input))
+
+
+def test_lazy_passthrough():
+    "segments absent from the anon_map are copied verbatim"
+    msg = "MSH|^~\&|sendingapp^SAID|sendingfacility^SFID^NPI|"\
+        "receivingapp^RAID^ISO|receivingfacility^RFID^ISO|"\
+        "30301210090814||ADT^A08^ADT_A01|"\
+        "1234567890303012100908143982|P|2.5|||||||||Biosurveillance-1.0"\
+        "\rNK1|1|DOE^JANE^^^^^L|MTH^Mother^HL70063^^^L|"\
+        "\rZXX|1|odd~repeat^&sub||"
+    result = MBDS_anon(msg).anonymize()
+    segments = result.split('\r')
+    assert(segments[0].find("sendingapp") == -1)
+    assert(segments[1:] == msg.split('\r')[1:])
+
+
+def test_lazy_matches_eager():
+    "lazy parsing yields identical output to a full parse"
+    msg = "MSH|^~\&|sendingapp^SAID|sendingfacility^SFID^NPI|"\
+        "receivingapp^RAID^ISO|receivingfacility^RFID^ISO|"\
+        "30301210090814||ADT^A08^ADT_A01|"\
+        "1234567890303012100908143982|P|2.5|||||||||Biosurveillance-1.0"\
+        "\rAL1|1|DA^Drug allergy^HL70127|70618^Penicillin^RXNORM"\
+        "\rOBX|1|NM|8310-5^Body temperature^LN||38.2|Cel||||||F"\
+        "|||30301210090814\r"
+    eager = MBDS_anon(msg, lazy=False).anonymize()
+    lazy = MBDS_anon(msg, lazy=True).anonymize()
+    assert(eager == lazy)
+
+
+def test_anonymize_window():
+    "batched window matches message at a time anonymization"
+    msgs = ["MSH|^~\&|windowapp^WAID|windowfacility^WFID^NPI|"
+            "receivingapp^RAID^ISO|receivingfacility^RFID^ISO|"
+            "3030121009081%d||ADT^A08^ADT_A01|"
+            "12345678903030121009081%d3982|P|2.5" % (i, i) +
+            "\rPID|1||windowpatient%d^^^&windowassigning&ISO" % i +
+            "\rOBX|1|NM|8310-5^Body temperature^LN||3%d.2|Cel" % i
+            for i in range(5)]
+    batched = anonymize_window(msgs)
+    assert(len(batched) == 5)
+    assert(batched == [MBDS_anon(msg).anonymize() for msg in msgs])
+    for msg in batched:
+        for term in ('windowapp', 'windowfacility', 'windowpatient',
+                     'windowassigning'):
+            assert(msg.find(term) == -1)
+
+
+def test_analyze():
+    "analysis counts distinct terms without caching any"
+    msgs = ["MSH|^~\&|analyzeapp^AAID|analyzefacility^AFID^NPI|"
+            "receivingapp^RAID^ISO|receivingfacility^RFID^ISO|"
+            "30301210090814||ADT^A08^ADT_A01|"
+            "1234567890303012100908143982|P|2.5" +
+            "\rPID|1||analyzepatient%d^^^&analyzeassigning&ISO" % (i % 4)
+            for i in range(20)]
+    analysis = FeedAnalysis()
+    for msg in msgs:
+        analysis.add(msg)
+    assert(analysis.fields['PID-3.1'][0] == 20)
+    assert(analysis.fields['PID-3.1'][1].count() == 4)
+    assert(analysis.fields['PID-3.1'][2].count() == 4)
+    assert(analysis.fields['MSH-3.1'][1].count() == 1)
+    assert(lookup_term('analyzepatient0') is None)
+
+
+def test_composite_operations():
+    msg = "MSH|^~\&||Composite Site^9876543210^NPI||||||||" \
+        "compositecontrolid|P|2.5.1\r" \
+        "PID|1||4321^^^Composite Site&9.8.7.6&ISO"
+    before = dict((label, list(stats)) for label, stats in
+                  composite_operations.iteritems())
+    MBDS_anon(msg).anonymize()
+    for label in ('MSH-4.2', 'PID-3.4'):
+        calls, count = composite_operations[label]
+        previous = before.get(label, [0, 0])
+        assert(calls == previous[0] + 1)
+        assert(count > previous[1])
+
+
+def test_prefetch_terms():
+    "mapped terms, and the parts of composite fields"
+    msg = "MSH|^~\&||Prefetch Site^1234567890^NPI||||||||" \
+        "prefetchcontrolid|P|2.5.1\n" \
+        "PID|1||4321^^^Prefetch Site&9.8.7.6&ISO"
+    terms = prefetch_terms(msg)
+    for term in ('Prefetch Site', '1234567890', '4321',
+                 'Prefetch Site&9.8.7.6&ISO', '9.8.7.6'):
+        assert(term in terms)
+
+
+def test_stream_messages():
+    "messages yield as soon as complete, without waiting for EOF"
+    read, write = os.pipe()
+    try:
+        reader = os.fdopen(read, 'rb')
+        msg = "MSH|^~\&|streamapp|streamfacility\rPID|1||streampatient\r"
+        os.write(write, '\x0b' + msg + '\x1c\r' + '\x0b' + msg[:10])
+        messages = stream_messages(reader, mllp=True)
+        assert(messages.next() == msg)
+        os.write(write, msg[10:] + '\x1c\r')
+        assert(messages.next() == msg)
+
+        # unframed, complete once idle
+        messages = stream_messages(reader, idle=0.01)
+        os.write(write, msg)
+        assert(messages.next() == msg)
+    finally:
+        os.close(write)
+
+
+def test_idle_fragments_discarded():
+    "the tail of a message split by an idle writer is never yielded"
+    read, write = os.pipe()
+    try:
+        reader = os.fdopen(read, 'rb')
+        msg = "MSH|^~\&|streamapp|streamfacility\rPID|1||streampatient\r"
+        messages = stream_messages(reader, idle=0.01, arrivals=True)
+        os.write(write, msg)
+        message, arrived = messages.next()
+        assert(message == msg and arrived <= time.time())
+        os.write(write, "OBX|1|ST|streampatient^^^^\r")
+        time.sleep(0.05)
+        os.write(write, msg)
+        assert(messages.next()[0] == msg)
+    finally:
+        os.close(write)
+
+
+def test_anonymize_filter():
+    "filter output matches that of message at a time"
+    msgs = "MSH|^~\&|filterapp|filterfacility\nPID|1||filterpatient1\n"\
+        "MSH|^~\&|filterapp|filterfacility\nPID|1||filterpatient2\n"
+    read, write = os.pipe()
+    os.write(write, msgs)
+    os.close(write)
+    output = NamedTemporaryFile()
+    latencies = anonymize_filter(os.fdopen(read, 'rb'), output)
+    assert(len(latencies) == 2)
+    output.seek(0)
+    expected = ''.join(MBDS_anon(msg.replace('\n', '\r')).anonymize() + '\r'
+                       for msg in message_at_a_time(StringIO(msgs)))
+    assert(output.read() == expected)
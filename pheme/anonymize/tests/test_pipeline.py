@@ -0,0 +1,47 @@
+from nose.tools import raises
+
+from pheme.anonymize.pipeline import ReadAhead, run_pipeline
+
+
+def test_order_preserved():
+    output = []
+    stages = run_pipeline(range(1000), lambda(x): x * 2, output.append,
+                          queue_size=4)
+    assert(output == [x * 2 for x in range(1000)])
+    assert([stage.items for stage in stages] == [1000, 1000, 1000])
+
+
+def test_utilization():
+    stages = run_pipeline(range(10), lambda(x): x, lambda(x): None)
+    for stage in stages:
+        assert(0 <= stage.utilization <= 1)
+
+
+@raises(ZeroDivisionError)
+def test_transform_error():
+    "errors in a stage are raised in the caller"
+    run_pipeline(range(1000), lambda(x): 1 / (x - 500), lambda(x): None,
+                 queue_size=2)
+
+
+@raises(IOError)
+def test_source_error():
+    def source():
+        yield 1
+        raise IOError("read failed")
+    run_pipeline(source(), lambda(x): x, lambda(x): None)
+
+
+def test_read_ahead():
+    "work is applied ahead of consumption, order is preserved"
+    seen = []
+    consumed = []
+    for item in ReadAhead(range(100), seen.append, depth=4):
+        consumed.append(item)
+        assert(len(seen) >= len(consumed))
+    assert(consumed == range(100) and seen == range(100))
+
+
+@raises(ZeroDivisionError)
+def test_read_ahead_error():
+    list(ReadAhead(range(10), lambda(x): 1 / (x - 5), depth=2))
@@ -0,0 +1,73 @@
+import argparse
+import os
+from StringIO import StringIO
+
+from nose.tools import raises
+
+from pheme.anonymize.alter import anon_term
+from pheme.anonymize.benchmark import scratch_cache, scratch_directory
+from pheme.anonymize.field_map import ten_digits_starting_w_1
+from pheme.anonymize.profiling import Profiler, StackSampler, hot_frames
+from pheme.anonymize.profiling import positive_int
+
+OUTER = ('main.py', 1, 'main')
+INNER = ('field_map.py', 10, 'zipcode')
+
+
+def test_sampled_stats():
+    sampler = StackSampler(interval=0.01)
+    sampler.samples[(OUTER,)] = 1
+    sampler.samples[(OUTER, INNER)] = 3
+    stats = sampler.stats()
+    cc, nc, tt, ct, callers = stats[OUTER]
+    assert(nc == 4)
+    assert(abs(tt - 0.01) < 1e-9)
+    assert(abs(ct - 0.04) < 1e-9)
+    assert(callers == {})
+    cc, nc, tt, ct, callers = stats[INNER]
+    assert(abs(tt - 0.03) < 1e-9 and abs(ct - 0.03) < 1e-9)
+    assert(callers[OUTER][0] == 3)
+
+
+def test_collapsed():
+    sampler = StackSampler()
+    sampler.samples[(OUTER, INNER)] = 3
+    assert(sampler.collapsed() == ['main:main;field_map:zipcode 3'])
+
+
+@raises(ValueError)
+def test_invalid_mode():
+    Profiler('profile', mode='statistical')
+
+
+@raises(argparse.ArgumentTypeError)
+def test_profile_every_zero():
+    assert(positive_int('3') == 3)
+    positive_int('0')
+
+
+def run_profiled(mode, every):
+    "anonymize terms under the profiler, returns (profiler, stats)"
+    with scratch_directory() as directory, scratch_cache(prewarm_keys=0):
+        profiler = Profiler(os.path.join(directory, 'run'), mode, 0.001)
+        anonymize = profiler.wrap(lambda(term): anon_term(
+            term, ten_digits_starting_w_1), every)
+        for i in range(200):
+            anonymize(str(5550000000 + i))
+        stats = profiler.finish(StringIO())
+        assert(os.path.exists(os.path.join(directory, 'run.collapsed')))
+        return profiler, stats
+
+
+def test_deterministic():
+    profiler, stats = run_profiled('deterministic', 1)
+    assert(profiler.sections == 200)
+    hot = dict(((group, label), calls) for group, label, calls, own, total
+               in hot_frames(stats))
+    assert(hot[('field_map', 'field_map:one_and_nine')] == 200)
+    assert(hot[('TermCache', 'termcache:_get')] >= 200)
+
+
+def test_sampled_subset():
+    profiler, stats = run_profiled('sampling', 10)
+    assert(profiler.sections == 20)
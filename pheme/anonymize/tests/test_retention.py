@@ -0,0 +1,100 @@
+import os
+import shelve
+
+from nose.tools import raises
+
+from pheme.anonymize.benchmark import scratch_directory
+from pheme.anonymize.retention import AccessLog, parse_policy, today
+from pheme.anonymize.termcache import TermCache
+
+
+def test_parse_policy():
+    assert(parse_policy('visit:30, default: 365') ==
+           {'visit': 30, 'default': 365})
+    assert(parse_policy('') == {})
+
+
+@raises(ValueError)
+def test_invalid_policy():
+    parse_policy('visit=30')
+
+
+def test_track_access():
+    "accessed keys and their namespaces are logged on close"
+    with scratch_directory() as directory:
+        cachefile = os.path.join(directory, 'cache')
+        tc = TermCache(cachefile, prewarm_keys=0, track_access=1)
+        tc['visit'] = 'anon visit'
+        tc['site'] = 'anon site'
+        tc.tag(['site'], 'facility')
+        tc.close()
+        log = shelve.open(cachefile + '.access', 'r')
+        assert(log['visit'] == (today(), None))
+        assert(log['site'] == (today(), 'facility'))
+        log.close()
+
+        # namespaces survive later untagged access
+        tc = TermCache(cachefile, prewarm_keys=0, track_access=1)
+        assert(tc['site'] == 'anon site')
+        tc.close()
+        log = shelve.open(cachefile + '.access', 'r')
+        assert(log['site'] == (today(), 'facility'))
+        log.close()
+
+
+def test_sweep():
+    "only stale, unpinned terms are expired"
+    with scratch_directory() as directory:
+        cachefile = os.path.join(directory, 'cache')
+        tc = TermCache(cachefile, prewarm_keys=0, track_access=0)
+        for key in ('old visit', 'new visit', 'old site', 'date_delta-1',
+                    'untracked', 'pinned visit'):
+            tc[key] = key.upper()
+        log = AccessLog(cachefile + '.access')
+        day = today()
+        log.record({'old visit': 'visit', 'old site': 'facility',
+                    'date_delta-1': None, 'pinned visit': 'visit'},
+                   day=day - 90)
+        log.record({'new visit': 'visit'}, day=day - 10)
+        log.pin(['pinned visit'])
+
+        policy = {'visit': 30, 'default': 30}
+        expired, kept = log.sweep(tc.shelf, policy, set(['facility',
+                                                         'pinned']),
+                                  dry_run=True)
+        assert(expired == {'visit': 1})
+        assert('old visit' in tc)
+
+        expired, kept = log.sweep(tc.shelf, policy, set(['facility',
+                                                         'pinned']))
+        assert(expired == {'visit': 1})
+        assert(kept['untracked'] == 1)
+        assert('old visit' not in tc)
+        for key in ('new visit', 'old site', 'date_delta-1', 'untracked',
+                    'pinned visit'):
+            assert(key in tc)
+        tc.close()
+
+
+def test_sweep_prunes_hot_keys():
+    "expired terms are dropped from the hot key sidecar"
+    with scratch_directory() as directory:
+        cachefile = os.path.join(directory, 'cache')
+        tc = TermCache(cachefile, prewarm_keys=2, track_access=0)
+        tc['old visit'], tc['site'] = 'OLD VISIT', 'SITE'
+        tc['old visit'], tc['site']
+        tc.close()
+        log = AccessLog(cachefile + '.access')
+        log.record({'old visit': 'visit', 'site': 'facility'},
+                   day=today() - 90)
+
+        tc = TermCache(cachefile, prewarm_keys=0)
+        expired, kept = log.sweep(tc.shelf, {'visit': 30},
+                                  set(['facility']),
+                                  hotfile=cachefile + '.hot')
+        tc.close()
+        assert(expired == {'visit': 1})
+        tc = TermCache(cachefile, prewarm_keys=2)
+        assert(tc.hot == {'site': 'SITE'})
+        assert(tc['old visit'] is None)
+        tc.close()
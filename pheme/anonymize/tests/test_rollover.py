@@ -0,0 +1,88 @@
+import hashlib
+import os
+
+from nose.tools import raises
+
+from pheme.anonymize.benchmark import scratch_directory
+from pheme.anonymize.rollover import RollingOutput, count_messages
+from pheme.anonymize.rollover import parse_size
+
+
+def message(i):
+    return "MSH|^~\&|app|facility|||2013||ADT^A08|%d|P|2.5\rPID|1\r" % i
+
+
+def read_manifest(path):
+    lines = open(path + '.manifest').read().splitlines()
+    assert(lines[-1] == '# complete')
+    return [line.split('\t') for line in lines[:-1]]
+
+
+def test_parse_size():
+    assert(parse_size('1000') == 1000)
+    assert(parse_size('2k') == 2048)
+    assert(parse_size('512M') == 512 << 20)
+
+
+@raises(ValueError)
+def test_invalid_size():
+    parse_size('big')
+
+
+def test_count_messages():
+    assert(count_messages(message(1)) == 1)
+    assert(count_messages(message(1) + message(2)) == 2)
+    assert(count_messages('BHS|^~\&|app\r') == 0)
+    assert(count_messages('\x0b' + message(1) + '\x1c\r') == 1)
+
+
+def test_roll_by_messages():
+    with scratch_directory() as directory:
+        path = os.path.join(directory, 'anon.hl7')
+        output = RollingOutput(path, max_messages=4)
+        for i in range(10):
+            output.write(message(i))
+        output.close()
+        manifest = read_manifest(path)
+        assert([entry[0] for entry in manifest] ==
+               ['anon-00001.hl7', 'anon-00002.hl7', 'anon-00003.hl7'])
+        assert([int(entry[1]) for entry in manifest] == [4, 4, 2])
+        contents = ''
+        for name, messages, size, checksum in manifest:
+            data = open(os.path.join(directory, name)).read()
+            assert(len(data) == int(size))
+            assert(hashlib.md5(data).hexdigest() == checksum)
+            contents += data
+        assert(contents == ''.join(message(i) for i in range(10)))
+        assert(not [name for name in os.listdir(directory)
+                    if name.endswith('.part')])
+
+
+def test_roll_by_bytes():
+    with scratch_directory() as directory:
+        path = os.path.join(directory, 'anon.hl7')
+        output = RollingOutput(path, max_bytes=len(message(1)) * 3 + 1)
+        for i in range(1, 8):
+            output.write(message(i))
+        output.close()
+        assert([int(entry[1]) for entry in read_manifest(path)] ==
+               [3, 3, 1])
+
+
+def test_batch_boundaries():
+    "shards only roll over before a batch header"
+    with scratch_directory() as directory:
+        path = os.path.join(directory, 'anon.hl7')
+        output = RollingOutput(path, max_messages=2, batch_boundaries=True)
+        output.write('FHS|^~\&|app\r')
+        for batch in range(3):
+            output.write('BHS|^~\&|app\r')
+            for i in range(3):
+                output.write(message(i))
+        output.close()
+        manifest = read_manifest(path)
+        assert([int(entry[1]) for entry in manifest] == [3, 3, 3])
+        first = open(os.path.join(directory, manifest[0][0])).read()
+        assert(first.startswith('FHS|^~\&|app\rBHS'))
+        second = open(os.path.join(directory, manifest[1][0])).read()
+        assert(second.startswith('BHS'))
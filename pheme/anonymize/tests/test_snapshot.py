@@ -0,0 +1,74 @@
+import datetime
+import os
+
+from pheme.anonymize.benchmark import scratch_directory
+from pheme.anonymize.snapshot import OverlayStore, Snapshot, freeze
+from pheme.anonymize.termcache import TermCache
+
+
+def test_freeze():
+    with scratch_directory() as directory:
+        now = datetime.datetime.now()
+        terms = dict(('term %d' % i, 'value %d' % i) for i in range(500))
+        terms['date_delta-3650 days, 0:00:00'] = 315360000.5
+        terms['when'] = now
+        path = os.path.join(directory, 'snapshot')
+        assert(freeze(terms, path) == 502)
+
+        snapshot = Snapshot(path)
+        assert(len(snapshot) == 502)
+        for key, value in terms.items():
+            assert(snapshot[key] == value)
+        assert(snapshot.get('missing') is None)
+        assert('term 0' in snapshot and 'term' not in snapshot)
+        assert(snapshot.keys() == sorted(terms))
+        snapshot.close()
+
+
+def test_empty_snapshot():
+    with scratch_directory() as directory:
+        path = os.path.join(directory, 'snapshot')
+        freeze({}, path)
+        snapshot = Snapshot(path)
+        assert(snapshot.get('missing') is None and snapshot.keys() == [])
+        snapshot.close()
+
+
+def test_overlay():
+    with scratch_directory() as directory:
+        path = os.path.join(directory, 'snapshot')
+        freeze({'frozen': 'FROZEN', 'gone': 'GONE'}, path)
+        store = OverlayStore(Snapshot(path))
+        store['new'] = 'NEW'
+        store['frozen'] = 'THAWED'
+        del store['gone']
+        assert(store['new'] == 'NEW' and store['frozen'] == 'THAWED')
+        assert('gone' not in store)
+        assert(sorted(store.keys()) == ['frozen', 'new'])
+        store.close()
+
+        # the snapshot itself is never altered
+        snapshot = Snapshot(path)
+        assert(snapshot['frozen'] == 'FROZEN' and 'gone' in snapshot)
+        snapshot.close()
+
+
+def test_termcache_snapshot():
+    "term cache reads the snapshot, leaving the live cache untouched"
+    with scratch_directory() as directory:
+        cachefile = os.path.join(directory, 'cache')
+        tc = TermCache(cachefile, prewarm_keys=0, snapshot='')
+        tc['live'] = 'LIVE'
+        path = cachefile + '.snapshot'
+        freeze(tc.shelf, path)
+        tc.close()
+
+        reader = TermCache(cachefile, snapshot=path)
+        assert(reader['live'] == 'LIVE')
+        reader['scratch'] = 'SCRATCH'
+        assert(reader['scratch'] == 'SCRATCH')
+        reader.close()
+
+        tc = TermCache(cachefile, prewarm_keys=0, snapshot='')
+        assert(tc['scratch'] is None)
+        tc.close()
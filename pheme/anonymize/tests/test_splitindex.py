@@ -0,0 +1,82 @@
+import os
+
+from nose.tools import raises
+
+from pheme.anonymize.benchmark import scratch_directory
+from pheme.anonymize.mbds_hl7 import message_at_a_time
+from pheme.anonymize.splitindex import chunk_range, load_index
+from pheme.anonymize.splitindex import messages_in_range, parse_range
+from pheme.anonymize.splitindex import read_index, scan_offsets
+
+BATCH = ("FHS|^~\&|app|facility\n"
+         "BHS|^~\&|app|facility\n" +
+         "".join("MSH|^~\&|app|facility|||2013||ADT^A08|%d|P|2.5\n"
+                 "PID|1||patient%d\n" % (i, i) for i in range(10)) +
+         "BTS|10\nFTS|1\n")
+
+
+def write_batch(directory, contents=BATCH):
+    path = os.path.join(directory, 'batch.hl7')
+    with open(path, 'wb') as batch:
+        batch.write(contents)
+    return path
+
+
+def test_matches_message_at_a_time():
+    with scratch_directory() as directory:
+        path = write_batch(directory)
+        expected = list(message_at_a_time(open(path)))
+        assert(len(expected) == 12)
+        assert(list(messages_in_range(path)) == expected)
+        assert(sorted(os.listdir(directory)) ==
+               ['batch.hl7', 'batch.hl7.idx'])
+        assert(list(read_index(path)) == list(scan_offsets(BATCH)))
+        assert(list(messages_in_range(path, 3, 5)) == expected[3:5])
+
+
+def test_chunks_cover_file():
+    with scratch_directory() as directory:
+        path = write_batch(directory)
+        count = len(load_index(path))
+        chunks = []
+        for i in range(1, 6):
+            start, end = chunk_range('%d/5' % i, count)
+            chunks.extend(messages_in_range(path, start, end))
+        assert(''.join(chunks) == BATCH)
+
+
+def test_stale_index_rebuilt():
+    with scratch_directory() as directory:
+        path = write_batch(directory)
+        load_index(path)
+        write_batch(directory, BATCH + BATCH)
+        assert(read_index(path) is None)
+        assert(len(load_index(path)) == 24)
+
+
+def test_same_size_rewrite_rebuilt():
+    "rewrites keeping the size and (whole second) mtime are caught"
+    with scratch_directory() as directory:
+        path = write_batch(directory)
+        load_index(path)
+        stat = os.stat(path)
+        write_batch(directory, BATCH.replace('patient', 'PATIENT'))
+        os.utime(path, (stat.st_atime, stat.st_mtime))
+        assert(read_index(path) is None)
+
+
+def test_empty_file():
+    with scratch_directory() as directory:
+        path = write_batch(directory, '')
+        assert(list(messages_in_range(path)) == [])
+
+
+def test_parse_range():
+    assert(parse_range('10:20') == (10, 20))
+    assert(parse_range(':20') == (0, 20))
+    assert(parse_range('10:') == (10, None))
+
+
+@raises(ValueError)
+def test_invalid_chunk():
+    chunk_range('0/4', 100)
@@ -1,6 +1,9 @@
 import datetime
+import os
 import pickle
-from pheme.anonymize.termcache import TermCache
+from pheme.anonymize import termcache
+from pheme.anonymize.benchmark import scratch_cache, scratch_directory
+from pheme.anonymize.termcache import Shard, TermCache, shard_path
 
 def test_termcache():
     tc = TermCache()
@@ -12,3 +15,119 @@ def test_datetime():
     now = datetime.datetime.now()
     tc[now] = now + datetime.timedelta(seconds=10)
     assert(now in tc)
+
+
+def test_prewarm():
+    "frequently accessed terms are reloaded from the hot sidecar"
+    with scratch_directory() as directory:
+        cachefile = os.path.join(directory, 'cache')
+        tc = TermCache(cachefile, prewarm_keys=2)
+        for key in ('hot', 'warm', 'cold'):
+            tc[key] = key.upper()
+        for i in range(3):
+            tc['hot'], tc['warm']
+        tc['cold']
+        tc.close()
+
+        tc = TermCache(cachefile, prewarm_keys=2)
+        assert(tc.hot == {'hot': 'HOT', 'warm': 'WARM'})
+        assert(tc['cold'] == 'COLD')
+        tc.close()
+
+        tc = TermCache(cachefile, prewarm_keys=0)
+        assert(tc.hot == {})
+        tc.close()
+
+
+def test_sharded():
+    "terms spread across shards survive close and reopen"
+    with scratch_directory() as directory:
+        cachefile = os.path.join(directory, 'cache')
+        tc = TermCache(cachefile, prewarm_keys=0, shards=4)
+        for i in range(100):
+            tc['term %d' % i] = 'value %d' % i
+        assert(tc['term 42'] == 'value 42')
+        tc.close()
+        assert(all(os.path.exists(shard_path(cachefile, i, 4) + '.lock')
+                   for i in range(4)))
+
+        tc = TermCache(cachefile, prewarm_keys=0, shards=4)
+        assert(len(tc.keys()) == 100)
+        assert(tc['term 99'] == 'value 99')
+        del tc['term 99']
+        assert('term 99' not in tc)
+        tc.close()
+
+
+def test_shard_overwrite():
+    "plain sets overwrite on flush, and the value survives a reopen"
+    with scratch_directory() as directory:
+        cachefile = os.path.join(directory, 'cache')
+        for resident in (False, True):
+            tc = TermCache(cachefile, prewarm_keys=0, shards=2,
+                           resident=resident)
+            tc['key'] = 'one'
+            tc.shelf.sync()
+            tc['key'] = 'two'
+            assert(tc['key'] == 'two')
+            tc.close()
+            tc = TermCache(cachefile, prewarm_keys=0, shards=2,
+                           resident=resident)
+            assert(tc['key'] == 'two')
+            del tc['key']
+            tc.close()
+
+
+def test_shard_last_writer_wins():
+    "concurrent plain sets of the same key overwrite on flush"
+    with scratch_directory() as directory:
+        path = os.path.join(directory, 'shard')
+        first, second = Shard(path, 10), Shard(path, 10)
+        first['key'] = 'first'
+        second['key'] = 'second'
+        first.sync()
+        second.sync()
+        first.close()
+        second.close()
+        reader = Shard(path, 10)
+        assert(reader['key'] == 'second')
+        reader.close()
+
+
+def test_shard_set_if_absent():
+    "set-if-absent returns the value on disk, never one still pending"
+    with scratch_directory() as directory:
+        cachefile = os.path.join(directory, 'cache')
+        first = TermCache(cachefile, prewarm_keys=0, shards=2)
+        second = TermCache(cachefile, prewarm_keys=0, shards=2)
+        assert(first.setdefault('key', 'first') == 'first')
+        assert(second.setdefault('key', 'second') == 'first')
+        assert(second.setdefault_many({'key': 'second', 'other': 'two'}) ==
+               {'key': 'first', 'other': 'two'})
+        assert(first.setdefault('other', 'one') == 'two')
+        first.close()
+        second.close()
+
+
+def test_prefetch():
+    "prefetched keys, including absent ones, spare store reads"
+    with scratch_cache(prewarm_keys=0) as tc:
+        tc['present'] = 'value'
+        tc.prefetch(['present', 'absent'])
+        assert(tc.prefetch_reads == 2)
+        assert(tc['present'] == 'value')
+        assert(tc['absent'] is None)
+        assert(tc.prefetch_hits == 2 and tc.stalls == 0)
+        assert(tc['other'] is None)
+        assert(tc.stalls == 1)
+        # stores replace prefetched values
+        tc.setdefault('absent', 'now stored')
+        assert(tc['absent'] == 'now stored')
+
+
+def test_lazy_singleton():
+    "the module singleton only opens the cache on first use"
+    lazy = termcache._LazyTermCache()
+    assert(lazy._cache is None)
+    lazy.close()
+    assert(lazy._cache is None)
@@ -32,6 +32,15 @@ setup(name='pheme.anonymize',
                     [console_scripts]
                     lookup_cached_term=pheme.anonymize.termcache:lookup_term_ep
                     store_cached_term=pheme.anonymize.termcache:store_term_ep
+                    freeze_term_cache=pheme.anonymize.snapshot:freeze_ep
+                    migrate_term_cache=pheme.anonymize.codec:migrate_ep
+                    reshard_term_cache=pheme.anonymize.termcache:reshard_ep
+                    sweep_term_cache=pheme.anonymize.retention:sweep_ep
+                    term_cache_server=pheme.anonymize.cacheserver:serve_ep
+                    scan_phi_leaks=pheme.anonymize.leakscan:scan_ep
+                    index_batch_file=pheme.anonymize.splitindex:index_ep
                     anonymize_file=pheme.anonymize.mbds_hl7:anonymize_file
+                    anonymize_db=pheme.anonymize.db_static_data:anonymize_db
+                    anonymize_benchmark=pheme.anonymize.benchmark:main
                     """),
 )